@@ -156,6 +156,27 @@ typedef struct
 } Hbridge_t;
 static Hbridge_t sHbridge = {0, 30000, 35};
 
+// ADC1/2 log selection, set with ls<hex mask>,<decimation> or l?<hex mask>,<decimation>.
+// Bit n of the mask selects column n of the log header
+#define LOG_COL_TIME		0
+#define LOG_COL_FREQ		1
+#define LOG_COL_DEADTIME	2
+#define LOG_COL_IS			3
+#define LOG_COL_VPLAL1		4
+#define LOG_COL_VPLAL2		5
+#define LOG_COL_VBRIS1		6
+#define LOG_COL_VBRIS2		7
+#define LOG_COL_TIM1		8
+#define LOG_COL_UPPER		9
+#define LOG_COL_LOWER		10
+#define LOG_CHANNELS_ALL	0x7FF
+typedef struct
+{
+	uint16_t channels;		//Columns sent in the ADC1/2 frames
+	uint16_t decimation;	//Only every decimation-th sample is sent
+} LogSelection_t;
+static LogSelection_t sLogSelection = {LOG_CHANNELS_ALL, 1};
+
 #define POWERON_SUCCEEDED 1	//Power on succeeded
 #define POWERON_FAILED 	  0	//Power on failed
 #define V500_OFF 0	//Powered off
@@ -775,11 +796,12 @@ void doneMeasuringBridgePlasmaADC12(uint32_t errorCode)
 static void printHbridgeDatalogging(uint32_t startTime, uint32_t stopTime, float upper, float lower)
 {
 	char s_output[1000];
+	uint16_t channels = sLogSelection.channels;
 	//Convert from ms to sec: time elapsed / number of adc reads
 	//This assumes that the time taken for each adc read is approx. equal
 	double interval = (double) (stopTime - startTime) / (double) sADC.nADC12Read;
 
-	for (int i=0; i<2*ADC12_NO_CHANNELS*sADC.nADC12Read; i=i+6)
+	for (int i=0; i<2*ADC12_NO_CHANNELS*sADC.nADC12Read; i=i+6*sLogSelection.decimation)
 		{
 			//calculate time of current measurement (start time + ADC sample rate)
 			//TODO: This is likely not exactly accurate. Better way to record time of measurement accounting for conversion/DMA time?
@@ -792,13 +814,118 @@ static void printHbridgeDatalogging(uint32_t startTime, uint32_t stopTime, float
 			float VbriS2 = convertADC12data(i+ADC2_VbriS2, NULL);
 			int timer1_value = convertADC12data(i+ADC1_TIM1_CH1, NULL);
 
-			sprintf(s_output, "%.2lf,%u,%u,%f,%f,%f,%f,%f, %u, %f, %f", measTime, sHbridge.frequency, sHbridge.deadtime,Is,VplaL1,VplaL2,VbriS1,VbriS2,timer1_value,upper,lower);
-			HAL_UART_Transmit(&huart3, (uint8_t *) s_output, strlen(s_output), 1000);
+			//Selected columns only. With all selected the row reads
+			//"%.2lf,%u,%u,%f,%f,%f,%f,%f, %u, %f, %f"
+			char *p = s_output;
+			if (channels & (1 << LOG_COL_TIME))		p += sprintf(p, "%.2lf,", measTime);
+			if (channels & (1 << LOG_COL_FREQ))		p += sprintf(p, "%u,", sHbridge.frequency);
+			if (channels & (1 << LOG_COL_DEADTIME))	p += sprintf(p, "%u,", sHbridge.deadtime);
+			if (channels & (1 << LOG_COL_IS))		p += sprintf(p, "%f,", Is);
+			if (channels & (1 << LOG_COL_VPLAL1))	p += sprintf(p, "%f,", VplaL1);
+			if (channels & (1 << LOG_COL_VPLAL2))	p += sprintf(p, "%f,", VplaL2);
+			if (channels & (1 << LOG_COL_VBRIS1))	p += sprintf(p, "%f,", VbriS1);
+			if (channels & (1 << LOG_COL_VBRIS2))	p += sprintf(p, "%f,", VbriS2);
+			if (channels & (1 << LOG_COL_TIM1))		p += sprintf(p, " %u,", timer1_value);
+			if (channels & (1 << LOG_COL_UPPER))	p += sprintf(p, " %f,", upper);
+			if (channels & (1 << LOG_COL_LOWER))	p += sprintf(p, " %f,", lower);
+			p--; //drop the last comma, the selection is never empty
+
+			HAL_UART_Transmit(&huart3, (uint8_t *) s_output, p - s_output, 1000);
 			printString("\n\r");
 		}
 	printString("#");
 }
 
+// Binary ADC1/2 frame, selected with lb1. All fields are little-endian (as stored by the
+// Cortex-M7), see FrameReader.py on the host for the layout
+typedef struct __attribute__((packed)) {
+	uint8_t magic[2];		//0xA5 0x5A
+	uint16_t count;			//number of samples following the header
+	uint32_t sequence;		//incremented for every frame sent, to detect lost frames
+	double startTime;		//time of the first sample, as in printHbridgeDatalogging()
+	double timeStep;		//time between two samples
+	uint32_t frequency;
+	uint32_t deadtime;
+	float upper;
+	float lower;
+	uint16_t channels;		//sLogSelection.channels, selects the sample fields below
+	uint16_t decimation;
+} binary_log_header;
+
+typedef struct __attribute__((packed)) {
+	float Is;
+	float VplaL1;
+	float VplaL2;
+	float VbriS1;
+	float VbriS2;
+	uint16_t timer1;
+} binary_log_sample;
+
+// CRC-32 as computed by zlib (reflected polynomial 0xEDB88320), one nibble at a time.
+// Pass 0 as crc for the first block. The CRC peripheral is not enabled in this project
+static uint32_t crc32_update(uint32_t crc, const uint8_t *data, uint32_t length)
+{
+	static const uint32_t table[16] = {
+		0x00000000, 0x1DB71064, 0x3B6E20C8, 0x26D930AC, 0x76DC4190, 0x6B6B51F4, 0x4DB26158, 0x5005713C,
+		0xEDB88320, 0xF00F9344, 0xD6D6A3E8, 0xCB61B38C, 0x9B64C2B0, 0x86D3D2D4, 0xA00AE278, 0xBDBDF21C
+	};
+
+	crc = ~crc;
+	for (uint32_t i = 0; i < length; i++) {
+		crc = (crc >> 4) ^ table[(crc ^ data[i]) & 0x0F];
+		crc = (crc >> 4) ^ table[(crc ^ (data[i] >> 4)) & 0x0F];
+	}
+	return ~crc;
+}
+
+// Print H-bridge data on UART3 as one binary frame: header, samples and CRC-32.
+// About 22 bytes per sample instead of about 100 for printHbridgeDatalogging().
+// Each sample holds only the fields of binary_log_sample selected in sLogSelection.channels,
+// in that order; the time, frequency, deadtime and upper/lower columns come from the header
+static void printHbridgeDataloggingBinary(uint32_t startTime, uint32_t stopTime, float upper, float lower)
+{
+	static uint32_t sequence = 0;
+	binary_log_header header;
+	uint8_t samples[ADC12_MAX_GROUP * sizeof(binary_log_sample)];
+	uint8_t *p = samples;
+	uint16_t channels = sLogSelection.channels;
+	double interval = (double) (stopTime - startTime) / (double) sADC.nADC12Read;
+
+	header.magic[0] = 0xA5;
+	header.magic[1] = 0x5A;
+	header.count = (sADC.nADC12Read + sLogSelection.decimation - 1) / sLogSelection.decimation;
+	header.sequence = sequence++;
+	//Same sample times as printHbridgeDatalogging(), whose index steps by 2*ADC12_NO_CHANNELS per sample
+	header.startTime = (double) startTime * (double) 0.5;
+	header.timeStep = interval * (double) (2*ADC12_NO_CHANNELS*sLogSelection.decimation) * (double) 0.5;
+	header.frequency = sHbridge.frequency;
+	header.deadtime = sHbridge.deadtime;
+	header.upper = upper;
+	header.lower = lower;
+	header.channels = channels;
+	header.decimation = sLogSelection.decimation;
+
+	for (int n=0; n<sADC.nADC12Read; n=n+sLogSelection.decimation)
+		{
+			int i = n * 2 * ADC12_NO_CHANNELS;
+			float value;
+			uint16_t timer1_value;
+			if (channels & (1 << LOG_COL_IS))		{ value = convertADC12data(i+ADC2_Is, NULL); memcpy(p, &value, 4); p += 4; }
+			if (channels & (1 << LOG_COL_VPLAL1))	{ value = convertADC12data(i+ADC1_VplaL1, NULL); memcpy(p, &value, 4); p += 4; }
+			if (channels & (1 << LOG_COL_VPLAL2))	{ value = convertADC12data(i+ADC2_VplaL2, NULL); memcpy(p, &value, 4); p += 4; }
+			if (channels & (1 << LOG_COL_VBRIS1))	{ value = convertADC12data(i+ADC1_VbriS1, NULL); memcpy(p, &value, 4); p += 4; }
+			if (channels & (1 << LOG_COL_VBRIS2))	{ value = convertADC12data(i+ADC2_VbriS2, NULL); memcpy(p, &value, 4); p += 4; }
+			if (channels & (1 << LOG_COL_TIM1))		{ timer1_value = (uint16_t) convertADC12data(i+ADC1_TIM1_CH1, NULL); memcpy(p, &timer1_value, 2); p += 2; }
+		}
+
+	uint32_t crc = crc32_update(0, (uint8_t *) &header, sizeof(header));
+	crc = crc32_update(crc, samples, p - samples);
+
+	HAL_UART_Transmit(&huart3, (uint8_t *) &header, sizeof(header), 1000);
+	HAL_UART_Transmit(&huart3, samples, p - samples, 1000);
+	HAL_UART_Transmit(&huart3, (uint8_t *) &crc, sizeof(crc), 1000);
+}
+
 // Automatically Correct the Drive Frequency until user presses any key
 void autoFreqAdj(void)
 {
@@ -1734,45 +1861,58 @@ static void TestModeAction(char input)
 }
 
 /**
- * Prints all of the ADC3 read supply voltages in a CSV format:
- * 3.3V,15V,HV
+ * Measures the supply voltages with ADC3, in mV
  */
-void print_supply_voltages_rc() {
+static void read_supply_voltages_rc(float *V3_3, float *V15, float *VHVDC) {
 
 	measureVoltagesTemperaturesADC3();
 	//Wait until ADC3 reading is done
 	while (sADC.adc3_reading) ;
 
-	char text[100];
-	float V3_3;
-	float V15;
-	float VHVDC;
-
 	for (int i=0; i<ADC3_DMA_REQUESTS; i++)
 	{
 
 		switch (i)
 		{
 			case ADC3_15V:
-				V15 =  1000*((30.0+120.0)/30.0)*3.3*(((float) sADC.adc3_data[ADC3_15V])/4096.0);
+				*V15 =  1000*((30.0+120.0)/30.0)*3.3*(((float) sADC.adc3_data[ADC3_15V])/4096.0);
 				break;
 
 			case ADC3_3_3V:
-				V3_3 =  1000*((30.0+3.0)/30.0)*3.3*(((float) sADC.adc3_data[ADC3_3_3V])/4096.0);
+				*V3_3 =  1000*((30.0+3.0)/30.0)*3.3*(((float) sADC.adc3_data[ADC3_3_3V])/4096.0);
 				break;
 
 			case ADC3_500VDC:
-				VHVDC =  1000*((12.0+2000.0)/12.0)*3.3*(((float) sADC.adc3_data[ADC3_500VDC])/4096.0);
+				*VHVDC =  1000*((12.0+2000.0)/12.0)*3.3*(((float) sADC.adc3_data[ADC3_500VDC])/4096.0);
 				break;
 		}
 
 
 	}
+}
+
+/**
+ * Prints all of the ADC3 read supply voltages in a CSV format:
+ * 3.3V,15V,HV
+ */
+void print_supply_voltages_rc() {
+	char text[100];
+	float V3_3;
+	float V15;
+	float VHVDC;
+
+	read_supply_voltages_rc(&V3_3, &V15, &VHVDC);
 	sprintf(text, "%7u,%7u,%7u\n\r", (int) V3_3, (int) V15, (int) VHVDC);
 	printString(text);
 }
 
 
+//Values of the log argument of adjust_plasma()
+#define LOG_NONE		0	//Do not print the ADC1/2 data
+#define LOG_POLLED		1	//Print one frame, requested with l?
+#define LOG_STREAMED	2	//Print every frame while datalogging is on (l1), prefixed with '$'
+#define LOG_BINARY		4	//Flag added to the above: print the frame in the binary format (lb1)
+
 /**
  * Auto frequency and voltage adjustment routine modified for remote control via gui
  */
@@ -1840,8 +1980,15 @@ void adjust_plasma(char log, int voltage, char auto_freq)
 
 	programHbridge();
 
-	//Print current ADC data
-	if (log == 1) {
+	//Print current ADC data. Streamed frames start with '$' so the host can tell them
+	//apart from command replies, which are sent between two frames
+	//Binary frames start with their own magic and need no prefix
+	if (log & LOG_BINARY) {
+		printHbridgeDataloggingBinary(startTime, stopTime-3, upper, lower);
+	} else if (log != LOG_NONE) {
+		if (log == LOG_STREAMED) {
+			printString("$");
+		}
 		printHbridgeDatalogging(startTime, stopTime-3, upper, lower);//stop time - 3 which is equivalent to subtracting 1.5us to account for overhead
 	}
 
@@ -1853,11 +2000,52 @@ void adjust_plasma(char log, int voltage, char auto_freq)
  * Prints the header for the csv log file
  */
 void print_log_header() {
-	printString("Time(us),Freq (Hz),Deadtime (%),Bridge I,VplaL1,VplaL2,VbriS1,VbriS2,TIM1 status,upper freq calc point, lower freq calc point");
+	//Names of the LOG_COL_ columns, printed for the ones in the log selection
+	static const char *names[] = {"Time(us)", "Freq (Hz)", "Deadtime (%)", "Bridge I", "VplaL1", "VplaL2",
+			"VbriS1", "VbriS2", "TIM1 status", "upper freq calc point", " lower freq calc point"};
+	char first = 1;
+
+	for (int column=LOG_COL_TIME; column<=LOG_COL_LOWER; column++) {
+		if (sLogSelection.channels & (1 << column)) {
+			if (!first) {
+				printString(",");
+			}
+			printString((char *) names[column]);
+			first = 0;
+		}
+	}
 	printCR();
 }
 
 
+/**
+ * Parses a log selection "<hex channel mask>,<decimation>" (decimation optional, default 1)
+ * into sLogSelection. Returns 0 and leaves the selection unchanged if it is not valid
+ */
+static char parse_log_selection(char *text)
+{
+	char *end;
+	long channels = strtol(text, &end, 16);
+	long decimation = 1;
+
+	if (end == text || channels <= 0 || channels > LOG_CHANNELS_ALL) {
+		return 0;
+	}
+	if (*end == ',') {
+		decimation = atoi(end + 1);
+	} else if (*end != '\0') {
+		return 0;
+	}
+	if (decimation < 1 || decimation > ADC12_MAX_GROUP) {
+		return 0;
+	}
+
+	sLogSelection.channels = channels;
+	sLogSelection.decimation = decimation;
+	return 1;
+}
+
+
 /**
  * Starts plasma and writes the log header if applicable
  */
@@ -1907,6 +2095,7 @@ struct rc_state {
 	char auto_freq;
 	char auto_voltage;
 	char print_log;
+	char binary_log; //ADC1/2 frames are sent in the binary format
 	int log_rate; //periods allowed to pass before updating log
 	int rate_counter; //used to count whether this period should be logged or passed
 	int voltage;
@@ -1928,6 +2117,7 @@ static rc_state init_rc_state() {
 	ret_state.rate_counter = 0;
 	ret_state.voltage = -1; //-1 means no voltage correction
 	ret_state.print_log = 0;
+	ret_state.binary_log = 0;
 
 	return ret_state;
 }
@@ -1937,9 +2127,33 @@ static rc_state init_rc_state() {
  * Print a string to UART acknowledging remote control
  */
 static void init_rc() {
+	//A new host connection starts with all log columns at full density
+	sLogSelection.channels = LOG_CHANNELS_ALL;
+	sLogSelection.decimation = 1;
 	printString("~");
 }
 
+/**
+ * Prints a snapshot of the controller state on one line, so the host needs a single
+ * round trip instead of one query per value (S?):
+ * S,<3.3V on>,<15V on>,<HV on>,<3.3V mV>,<15V mV>,<HV mV>,<freq>,<deadtime>,<plasma on>,<auto freq>,<auto voltage>,<logging>
+ * The line ends with \n\r so the host does not wait for a timeout.
+ */
+static void print_status_rc(rc_state *state) {
+	char text[120];
+	float V3_3;
+	float V15;
+	float VHVDC;
+
+	read_supply_voltages_rc(&V3_3, &V15, &VHVDC);
+	sprintf(text, "S,%u,%u,%u,%u,%u,%u,%u,%u,%u,%u,%u,%u\n\r",
+			supply_status.s3_3V, supply_status.s15V, supply_status.sHV,
+			(int) V3_3, (int) V15, (int) VHVDC,
+			sHbridge.frequency, sHbridge.deadtime,
+			state->state != IDLE, state->auto_freq, state->auto_voltage, state->logging);
+	printString(text);
+}
+
 /**
  * Checks status of queried power supply. Prints status to UART
  */
@@ -2057,6 +2271,13 @@ static void remoteControl()
 				init_rc();
 				break;
 
+				//Status snapshot query
+			case 'S':
+				if (input[1] == '?') {
+					print_status_rc(&current_state);
+				}
+				break;
+
 				//power supply related query/command
 			case 'p':
 				char supply[3];
@@ -2173,7 +2394,19 @@ static void remoteControl()
 				} else if (input[1] == 'h') {
 					print_log_header();
 				} else if (input[1] == '?') {
-					current_state.print_log = 1;
+					//l? may carry a new log selection, l?<mask>,<decimation>
+					if (input[2] == '\0' || parse_log_selection(&input[2])) {
+						current_state.print_log = 1;
+					} else {
+						printString("fail");
+					}
+				} else if (input[1] == 's') {
+					//Set the log selection without requesting a frame, ls<mask>,<decimation>
+					printString(parse_log_selection(&input[2]) ? "ok" : "fail");
+				} else if (input[1] == 'b') {
+					//Select the binary (lb1) or text (lb0) frame format, and confirm it
+					current_state.binary_log = (input[2] == '1');
+					printString(current_state.binary_log ? "1" : "0");
 				}
 				break;
 
@@ -2237,7 +2470,13 @@ static void remoteControl()
 			break;
 
 		case ACTIVE:
-				adjust_plasma(current_state.print_log, current_state.voltage, current_state.auto_freq);
+				if (current_state.print_log) {
+					adjust_plasma(LOG_POLLED | (current_state.binary_log ? LOG_BINARY : 0), current_state.voltage, current_state.auto_freq);
+				} else if (current_state.logging) {
+					adjust_plasma(LOG_STREAMED | (current_state.binary_log ? LOG_BINARY : 0), current_state.voltage, current_state.auto_freq);
+				} else {
+					adjust_plasma(LOG_NONE, current_state.voltage, current_state.auto_freq);
+				}
 				current_state.print_log = 0;
 			break;
 
@@ -0,0 +1,436 @@
+## asyncio version of PlasmaSerialInterface.
+## Reads are driven by the event loop watching the port's file descriptor (loop.add_reader),
+## so no coroutine sleeps while waiting for a reply. The firmware answers one command at a
+## time, so transactions on the wire are serialized, but any number of requests can be
+## awaited concurrently; they are served in priority order (safety first).
+## Requires a selector based event loop (POSIX).
+
+import asyncio
+import heapq
+import itertools
+import threading
+
+import serial
+
+import PlasmaException
+from FrameReader import LOG_CHANNELS_ALL
+from PlasmaSerialInterface import (FIXED_CHAR_DELAY, PACING_DELAYS, pacing_probe, pacing_probe_passed,
+                                   parse_status)
+from SerialWorker import PRIORITY_SAFETY, PRIORITY_CONTROL, PRIORITY_TELEMETRY
+
+
+class _PriorityLock:
+    """asyncio lock handing ownership to the waiter with the lowest priority number"""
+    def __init__(self):
+        self._locked = False
+        self._waiters = []
+        self._sequence = itertools.count()
+
+    async def acquire(self, priority):
+        if not self._locked and not self._waiters:
+            self._locked = True
+            return
+
+        waiter = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._sequence), waiter))
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            #Ownership was handed over just before the cancellation, pass it on
+            if waiter.done() and not waiter.cancelled():
+                self.release()
+            raise
+
+    def release(self):
+        while self._waiters:
+            _, _, waiter = heapq.heappop(self._waiters)
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self._locked = False
+
+
+class _Transaction:
+    def __init__(self, lock, priority):
+        self._lock = lock
+        self._priority = priority
+
+    async def __aenter__(self):
+        await self._lock.acquire(self._priority)
+
+    async def __aexit__(self, *exc):
+        self._lock.release()
+
+
+class AsyncPlasmaSerialInterface:
+    """The supply, H-bridge, polled logging and plasma commands of PlasmaSerialInterface as coroutines.
+    Replies are parsed the same way. Not covered: log channel selection (ls), binary frames (lb),
+    streaming, start_session(), the frames_lost/frames_corrupt counters and link_stats; the firmware
+    is left with all channels selected and text frames. set_voltage() raises, see there."""
+    def __init__(self, serialPort, pacing="adaptive"):
+        self.serial_port = serialPort
+        self.initialized = False
+        self.baud_rate = 6875000
+        self.timeout = 0.1
+        self.log_timeout = 0.5
+        self.pacing = pacing
+        self.char_delay = FIXED_CHAR_DELAY
+        self.echo = False
+        self.ser = None
+
+        self._rx = bytearray()
+        self._scanned = 0 #bytes of _rx already searched for a terminator
+        self._rx_event = None
+        self._lock = None
+        self._loop = None
+
+
+    def _transaction(self, priority):
+        return _Transaction(self._lock, priority)
+
+
+    ## Low level I/O, only called with the transaction lock held
+
+    def _on_readable(self):
+        try:
+            data = self.ser.read(self.ser.in_waiting or 1)
+        except serial.SerialException:
+            data = b""
+        if data:
+            self._rx += data
+            self._rx_event.set()
+
+    def _reset_input_buffer(self):
+        self.ser.reset_input_buffer()
+        self._rx.clear()
+        self._scanned = 0
+
+    """Waits until terminator arrives. Returns everything up to and including it and keeps the rest.
+    On timeout returns whatever has arrived, like serial.Serial.readline(), unless strict is set,
+    in which case TimeoutError is raised"""
+    async def _read_until(self, terminator, timeout, strict=False):
+        deadline = self._loop.time() + timeout
+
+        while True:
+            index = self._rx.find(terminator, max(0, self._scanned - len(terminator) + 1))
+            if index >= 0:
+                end = index + len(terminator)
+                data = bytes(self._rx[:end])
+                del self._rx[:end]
+                self._scanned = 0
+                return data
+            self._scanned = len(self._rx)
+
+            remaining = deadline - self._loop.time()
+            if remaining <= 0:
+                if strict:
+                    raise TimeoutError("No complete response received")
+                data = bytes(self._rx)
+                self._reset_input_buffer()
+                return data
+
+            self._rx_event.clear()
+            try:
+                await asyncio.wait_for(self._rx_event.wait(), remaining)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _write_paced(self, data):
+        for char in data:
+            self.ser.write(char.encode())
+
+            if self.echo:
+                if await self._read_until(char.encode(), self.timeout) == char.encode():
+                    continue
+                #Echo did not arrive, fall back to timed pacing
+                self.echo = False
+
+            if self.char_delay:
+                await asyncio.sleep(self.char_delay)
+        self.ser.write(b"\r")
+
+    async def _send(self, data, expect_reply=True):
+        self._reset_input_buffer()
+        await self._write_paced(data)
+        reply = await self._read_until(b"\n", self.timeout)
+
+        if expect_reply and not reply:
+            self._pacing_failed()
+        return reply
+
+    def _pacing_failed(self):
+        if self.pacing != "adaptive":
+            return
+        for delay in PACING_DELAYS:
+            if delay > self.char_delay:
+                self.char_delay = delay
+                return
+
+    async def _query_on(self, data):
+        return await self._send(data) == b"on"
+
+
+    ## Connection
+
+    async def initialize(self):
+        """Opens the port and initializes communication with the microcontroller.
+        Returns True if device is connected, False otherwise"""
+        self._loop = asyncio.get_running_loop()
+        self._rx_event = asyncio.Event()
+        self._lock = _PriorityLock()
+
+        #Exclusive so PortDiscovery probes (and a second instance) leave an open session alone
+        self.ser = serial.Serial(self.serial_port, self.baud_rate, timeout=0, exclusive=True)
+        self._loop.add_reader(self.ser.fileno(), self._on_readable)
+
+        async with self._transaction(PRIORITY_CONTROL):
+            self._reset_input_buffer()
+            if not await self._send("~"):
+                return False
+
+        await self.calibrate_pacing()
+
+        #put system in known state
+        await self.set_auto_freq(True)
+        await self.set_auto_voltage(False)
+        await self.set_datalogging(False)
+        async with self._transaction(PRIORITY_CONTROL):
+            await self._send("lb0") #text frames, binary ones are not parsed here
+
+        self.initialized = True
+        return True
+
+    async def close(self):
+        if self.ser is None:
+            return
+        async with self._transaction(PRIORITY_SAFETY):
+            self._loop.remove_reader(self.ser.fileno())
+            self.ser.close()
+            self.ser = None
+
+    async def calibrate_pacing(self, attempts=3):
+        """Same procedure as PlasmaSerialInterface.calibrate_pacing()"""
+        async with self._transaction(PRIORITY_CONTROL):
+            if self.pacing != "adaptive":
+                self.char_delay = FIXED_CHAR_DELAY
+                self.echo = False
+                return self.char_delay
+
+            self._reset_input_buffer()
+            self.ser.write(b"l")
+            self.echo = await self._read_until(b"l", self.timeout) == b"l"
+            await asyncio.sleep(FIXED_CHAR_DELAY)
+            self.ser.write(b"h")
+            if self.echo:
+                await self._read_until(b"h", self.timeout)
+            await asyncio.sleep(FIXED_CHAR_DELAY)
+            self.ser.write(b"\r")
+            await self._read_until(b"\n", self.timeout)
+
+            if self.echo:
+                self.char_delay = 0
+                return self.char_delay
+
+            async def probe(attempt, legacy=False):
+                await asyncio.sleep(self.char_delay)
+                self._reset_input_buffer()
+                if legacy:
+                    await self._write_paced("lh")
+                    return (await self._read_until(b"\n", self.timeout)).startswith(b"Time")
+                data, columns = pacing_probe(attempt)
+                await self._write_paced(data)
+                reply = await self._read_until(b"ok", self.timeout)
+                await asyncio.sleep(self.char_delay)
+                self._reset_input_buffer()
+                await self._write_paced("lh")
+                return pacing_probe_passed(reply, await self._read_until(b"\n", self.timeout), columns)
+
+            self.char_delay = FIXED_CHAR_DELAY
+            legacy = not await probe(0)
+
+            try:
+                shortest = len(PACING_DELAYS) #index of the shortest delay that passed
+                failed = False
+                for i in reversed(range(len(PACING_DELAYS))):
+                    self.char_delay = PACING_DELAYS[i]
+                    for attempt in range(attempts):
+                        if not await probe(attempt, legacy):
+                            failed = True
+                            break
+                    if failed:
+                        break
+                    shortest = i
+
+                self.char_delay = PACING_DELAYS[min(shortest + 1, len(PACING_DELAYS) - 1)]
+                if failed:
+                    #End the half received command and check the board still answers
+                    await asyncio.sleep(FIXED_CHAR_DELAY)
+                    self.ser.write(b"\r")
+                    if not await probe(0, legacy):
+                        self.char_delay = FIXED_CHAR_DELAY
+                return self.char_delay
+            finally:
+                if not legacy:
+                    await asyncio.sleep(self.char_delay)
+                    self._reset_input_buffer()
+                    #This interface does not select log channels, back to the firmware's default
+                    await self._write_paced("ls%x,1" % LOG_CHANNELS_ALL)
+                    await self._read_until(b"ok", self.timeout)
+
+
+    ## Supplies
+
+    async def query_3_3_supply(self):
+        async with self._transaction(PRIORITY_CONTROL):
+            return await self._query_on("p?3.3")
+
+    async def query_15_supply(self):
+        async with self._transaction(PRIORITY_CONTROL):
+            return await self._query_on("p?15")
+
+    async def query_hv_supply(self):
+        async with self._transaction(PRIORITY_CONTROL):
+            return await self._query_on("p?hv")
+
+    async def toggle_low_voltage(self):
+        async with self._transaction(PRIORITY_CONTROL):
+            return (await self._send("p!lv")).strip() == b"on"
+
+    async def toggle_high_voltage(self):
+        async with self._transaction(PRIORITY_CONTROL):
+            return (await self._send("p!hv")).strip() == b"on"
+
+    async def query_supply_voltages(self):
+        async with self._transaction(PRIORITY_TELEMETRY):
+            return await self._send("p?a")
+
+
+    ## H-bridge settings
+
+    async def set_freq(self, freq):
+        async with self._transaction(PRIORITY_CONTROL):
+            return await self._send("f!"+str(round(float(freq)*1000))) == b"ok"
+
+    async def query_freq(self):
+        async with self._transaction(PRIORITY_TELEMETRY):
+            return (await self._send("f?")).decode()
+
+    async def set_voltage(self, voltage):
+        """Not supported until the firmware's v! setter is fixed: its parse loop never advances,
+        so sending v! hangs the board. Raises PlasmaException without sending anything"""
+        raise PlasmaException.PlasmaException("Setting the voltage is not supported, v! hangs the firmware")
+
+    async def query_voltage(self):
+        async with self._transaction(PRIORITY_CONTROL):
+            return (await self._send("v?")).decode()
+
+    async def set_auto_freq(self, new_setting):
+        async with self._transaction(PRIORITY_CONTROL):
+            reply = (await self._send("mf" + ("1" if new_setting else "0"))).strip()
+        if reply == b"1":
+            return True
+        elif reply == b"0":
+            return False
+
+    async def set_auto_voltage(self, new_setting):
+        async with self._transaction(PRIORITY_CONTROL):
+            await self._send("mv" + ("1" if new_setting else "0"))
+
+
+    ## Data logging
+
+    async def set_datalogging(self, new_setting):
+        async with self._transaction(PRIORITY_CONTROL):
+            await self._send("l" + ("1" if new_setting else "0"), expect_reply=False)
+
+    async def query_log_header(self):
+        async with self._transaction(PRIORITY_CONTROL):
+            return await self._send("lh")
+
+    async def query_log_data(self):
+        """Returns the newest ADC1/2 frame without the # terminator"""
+        async with self._transaction(PRIORITY_TELEMETRY):
+            self._reset_input_buffer()
+            await self._write_paced("l?")
+            try:
+                frame = await self._read_until(b"#", self.log_timeout, strict=True)
+            except TimeoutError:
+                self._pacing_failed()
+                raise
+            return frame[:-1]
+
+
+    ## Plasma
+
+    async def system_shutdown(self):
+        async with self._transaction(PRIORITY_SAFETY):
+            await self._send("z", expect_reply=False)
+
+    async def query_plasma(self):
+        async with self._transaction(PRIORITY_CONTROL):
+            return await self._query_on("s?")
+
+    async def query_status(self):
+        async with self._transaction(PRIORITY_TELEMETRY):
+            return parse_status(await self._send("S?"))
+
+    async def start_plasma(self):
+        async with self._transaction(PRIORITY_CONTROL):
+            status = parse_status(await self._send("S?"))
+            if not status.supply_15 or not status.supply_3_3:
+                raise PlasmaException.PlasmaException('Low Voltage Supplies not on!')
+
+            if status.plasma_on:
+                raise PlasmaException.PlasmaException('System is already running')
+
+            if (await self._send("p!hv")).strip() != b"on":
+                await self._send("z", expect_reply=False)
+                raise PlasmaException.PlasmaException("High voltage in unknown state!")
+
+            await self._send("s!", expect_reply=False)
+
+    async def stop_plasma(self):
+        async with self._transaction(PRIORITY_SAFETY):
+            await self._send("q", expect_reply=False)
+
+
+#Coroutines exposed by SyncPlasmaSerialInterface
+_SYNC_METHODS = ("initialize", "calibrate_pacing", "query_3_3_supply", "query_15_supply", "query_hv_supply",
+                 "toggle_low_voltage", "toggle_high_voltage", "query_supply_voltages", "set_freq", "query_freq",
+                 "set_voltage", "query_voltage", "set_auto_freq", "set_auto_voltage", "set_datalogging",
+                 "query_log_header", "query_log_data", "system_shutdown", "query_plasma", "start_plasma",
+                 "stop_plasma", "query_status")
+
+
+class SyncPlasmaSerialInterface:
+    """Adapter running AsyncPlasmaSerialInterface on a private event loop thread. It takes the
+    PlasmaSerialInterface constructor arguments and offers the methods in _SYNC_METHODS, each
+    returning a concurrent.futures.Future. It covers only that command set, see
+    AsyncPlasmaSerialInterface: callers selecting log channels, streaming frames or reading
+    link_stats (the GUI, serialLog, DeviceManager) need PlasmaSerialInterface."""
+    def __init__(self, serialPort, plasma_active_event, pacing="adaptive"):
+        self.interface = AsyncPlasmaSerialInterface(serialPort, pacing)
+        self.plasma_active_event = plasma_active_event
+        self.loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self.loop.run_forever, name="PlasmaEventLoop " + str(serialPort), daemon=True)
+        self._thread.start()
+
+    def __getattr__(self, name):
+        #serial_port, initialized, char_delay etc. come from the async interface
+        return getattr(self.interface, name)
+
+    def close(self):
+        asyncio.run_coroutine_threadsafe(self.interface.close(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join()
+
+
+def _sync_method(name):
+    def method(self, *args, **kwargs):
+        return asyncio.run_coroutine_threadsafe(getattr(self.interface, name)(*args, **kwargs), self.loop)
+    method.__name__ = name
+    method.__doc__ = getattr(AsyncPlasmaSerialInterface, name).__doc__
+    return method
+
+for _name in _SYNC_METHODS:
+    setattr(SyncPlasmaSerialInterface, _name, _sync_method(_name))
@@ -0,0 +1,619 @@
+## Data log writers and readers for the ADC1/2 frames recorded while the plasma is active.
+##
+## Two formats are supported, picked by file extension in open_log_writer():
+##   .csv (or anything else)  the firmware's ASCII CSV, written as received (binary frames
+##                            are formatted like the firmware would have sent them)
+##   .plog                    binary columnar log: typed columns in appendable chunks
+##
+## .plog layout (all little-endian):
+##   b"PLOG" | uint16 version | uint32 header length | JSON header
+##   then any number of chunks:
+##   b"CHNK" | uint32 rows | column 0 (rows values) | column 1 | ...
+## The JSON header holds the column names and NumPy dtypes, and the CSV header reported
+## by the firmware (query_log_header) so the log can be converted back to CSV.
+##
+## CSV logs ending in .gz or .zst are compressed as they are written (.zst needs the optional
+## zstandard package) and split into segments by RotatingLogWriter, see open_log_writer().
+##
+## BackgroundLogWriter wraps either writer so disk writes happen on their own thread, off the
+## acquisition loop.
+##
+## Usage: python DataLog.py <log.plog> [out.csv]   converts a binary log to CSV
+##        python DataLog.py <log.csv> [out.plog]   converts a CSV log to binary
+
+import gzip
+import json
+import mmap
+import os
+import queue
+import struct
+import sys
+import threading
+import time
+
+import numpy as np
+
+import Tracing
+from FrameReader import is_binary_frame
+from LogFrame import LOG_COLUMNS, LogFrame, columns_from_header
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+LOG_MAGIC = b"PLOG"
+CHUNK_MAGIC = b"CHNK"
+LOG_VERSION = 1
+BINARY_LOG_EXTENSION = ".plog"
+
+_FILE_HEADER = struct.Struct("<4sHI")
+_CHUNK_HEADER = struct.Struct("<4sI")
+
+#Storage type of each column. Time stays float64: a float32 holds only ~7 digits, which
+#would lose the 0.01 us resolution after a few seconds. Unlisted columns are float32.
+COLUMN_DTYPES = {
+    "time": "<f8",
+    "freq": "<u4",
+    "deadtime": "<u4",
+    "tim1_status": "<u4",
+}
+
+#printf style formats used when converting back to CSV, matching printHbridgeDatalogging
+_CSV_FORMATS = {"<f8": "%.2f", "<u4": "%u", "<f4": "%f"}
+
+
+#Compressed CSV extensions, see open_compressed()
+COMPRESSED_EXTENSIONS = (".gz", ".zst")
+
+#Seconds BackgroundLogWriter.close() waits for the queued frames to be written
+CLOSE_TIMEOUT = 10.0
+
+#Segment limits used by open_log_writer() for compressed CSV logs
+DEFAULT_ROTATE_BYTES = 512*1024*1024 #uncompressed CSV bytes per segment
+DEFAULT_ROTATE_SECONDS = 60*60
+
+
+def column_dtype(name):
+    return COLUMN_DTYPES.get(name, "<f4")
+
+
+class _ZstdFile:
+    """Minimal file object over a zstandard stream, closing the underlying file with it"""
+    def __init__(self, path, mode):
+        self._file = open(path, mode)
+        if "r" in mode:
+            self._stream = zstandard.ZstdDecompressor().stream_reader(self._file)
+        else:
+            self._stream = zstandard.ZstdCompressor(level=3).stream_writer(self._file)
+
+    def read(self, size=-1):
+        return self._stream.read(size)
+
+    def readline(self):
+        line = bytearray()
+        while not line.endswith(b"\n"):
+            byte = self._stream.read(1)
+            if not byte:
+                break
+            line += byte
+        return bytes(line)
+
+    def write(self, data):
+        return self._stream.write(data)
+
+    def flush(self):
+        self._stream.flush(zstandard.FLUSH_BLOCK)
+        self._file.flush()
+
+    def fileno(self):
+        return self._file.fileno()
+
+    def close(self):
+        self._stream.close()
+        if not self._file.closed:
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def open_compressed(path, mode="rb"):
+    """Opens path as a binary file, compressed by gzip (.gz) or zstd (.zst) if the extension says so"""
+    lower = path.lower()
+    if lower.endswith(".gz"):
+        return gzip.open(path, mode, compresslevel=6)
+    if lower.endswith(".zst"):
+        if zstandard is None:
+            raise IOError(".zst logs need the zstandard package (pip install zstandard)")
+        return _ZstdFile(path, mode)
+    return open(path, mode)
+
+
+def _csv_bytes(raw, frame):
+    """CSV text of a received frame: text frames as received, binary frames from the parsed frame"""
+    return frame.to_csv() if is_binary_frame(raw) else raw
+
+
+class CsvLogWriter:
+    """Writes the firmware's CSV bytes unchanged. file is a path or an open binary file"""
+    def __init__(self, file):
+        if isinstance(file, str):
+            file = open_compressed(file, "wb")
+        self.file = file
+
+    def write_header(self, header):
+        self.file.write(header)
+
+    def write_frame(self, raw, frame):
+        self.file.write(_csv_bytes(raw, frame))
+
+    def write_frames(self, frames):
+        """Writes a batch of (raw, frame) pairs with a single write"""
+        self.file.write(b"".join(_csv_bytes(raw, frame) for raw, frame in frames))
+
+    def flush(self, fsync=False):
+        self.file.flush()
+        if fsync:
+            os.fsync(self.file.fileno())
+
+    def close(self):
+        self.file.close()
+
+
+class RotatingLogWriter:
+    """CSV log split into segments, each starting with the firmware CSV header.
+
+    A new segment is started before a write once the current one holds max_bytes of (uncompressed)
+    CSV or is max_seconds old; None disables that limit. Segments are named after path with a
+    sequence number, e.g. run.csv.gz -> run.0000.csv.gz, run.0001.csv.gz, ..., and compressed
+    according to that extension while they are written. Every segment start is appended to
+    <name>.index.jsonl as {"segment", "start", "frames"}: the file name, the wall clock start
+    time (seconds since the epoch) and the number of frames logged before it. Like the segments,
+    the index of an earlier log at the same path is overwritten, so it only lists this log.
+    """
+    def __init__(self, path, max_bytes=DEFAULT_ROTATE_BYTES, max_seconds=DEFAULT_ROTATE_SECONDS):
+        self.max_bytes = max_bytes
+        self.max_seconds = max_seconds
+        self._stem, self._extension = _split_log_extension(path)
+        self.index_path = self._stem + ".index.jsonl"
+        self.segments = []
+        self.frames = 0
+        self._header = b""
+        self._segment = None
+        self._open_segment()
+
+    def _open_segment(self):
+        if self._segment is not None:
+            self._segment.close()
+        path = "%s.%04d%s" % (self._stem, len(self.segments), self._extension)
+        self._segment = open_compressed(path, "wb")
+        self._segment_bytes = 0
+        self._segment_start = time.time()
+        self._segment_deadline = time.monotonic() + self.max_seconds if self.max_seconds else None
+        self.segments.append(path)
+
+        with open(self.index_path, "a" if len(self.segments) > 1 else "w") as index:
+            index.write(json.dumps({"segment": os.path.basename(path), "start": self._segment_start,
+                                    "frames": self.frames}) + "\n")
+        if self._header:
+            self._segment.write(self._header)
+            self._segment_bytes += len(self._header)
+
+    def _rotate_if_due(self):
+        if self._segment_bytes <= len(self._header):
+            return #nothing logged in this segment yet
+        if ((self.max_bytes and self._segment_bytes >= self.max_bytes)
+                or (self._segment_deadline is not None and time.monotonic() >= self._segment_deadline)):
+            self._open_segment()
+
+    def write_header(self, header):
+        self._header = bytes(header)
+        self._segment.write(self._header)
+        self._segment_bytes += len(self._header)
+
+    def write_frame(self, raw, frame):
+        self.write_frames(((raw, frame),))
+
+    def write_frames(self, frames):
+        self._rotate_if_due()
+        data = b"".join(_csv_bytes(raw, frame) for raw, frame in frames)
+        self._segment.write(data)
+        self._segment_bytes += len(data)
+        self.frames += len(frames)
+
+    def flush(self, fsync=False):
+        self._segment.flush()
+        if fsync:
+            os.fsync(self._segment.fileno())
+
+    def close(self):
+        self._segment.close()
+
+
+def _split_log_extension(path):
+    """run.csv.gz -> ("run", ".csv.gz"), run.csv -> ("run", ".csv")"""
+    stem, extension = os.path.splitext(path)
+    if extension.lower() in COMPRESSED_EXTENSIONS:
+        stem, inner = os.path.splitext(stem)
+        extension = inner + extension
+    return stem, extension
+
+
+def tagged_log_path(path, tag):
+    """Log path for one of several devices logging together: run.csv.gz -> run.<tag>.csv.gz"""
+    stem, extension = _split_log_extension(path)
+    return "%s.%s%s" % (stem, tag, extension)
+
+
+def sidecar_log_path(path, suffix):
+    """Path of a file accompanying a log: run.csv.gz, "resonance.csv" -> run.resonance.csv"""
+    stem, _ = _split_log_extension(path)
+    return "%s.%s" % (stem, suffix)
+
+
+class BinaryLogWriter:
+    """Writes parsed LogFrames to a .plog file. Rows are buffered and written as one chunk
+    every chunk_rows rows (and on close), so chunks stay large and appends stay cheap."""
+    def __init__(self, path, chunk_rows=8192):
+        self.file = open(path, "wb")
+        self.chunk_rows = chunk_rows
+        self.columns = None
+        self.dtypes = None
+        self._pending = []
+        self._pending_rows = 0
+        self._source_header = ""
+
+    def write_header(self, header):
+        """header is the CSV header line from query_log_header. The file header itself is
+        written with the first frame, once the column layout is known"""
+        if isinstance(header, (bytes, bytearray)):
+            header = header.decode(errors="replace")
+        self._source_header = header.strip()
+
+    def _write_file_header(self, columns):
+        self.columns = tuple(columns)
+        self.dtypes = tuple(np.dtype(column_dtype(name)) for name in self.columns)
+        header = json.dumps({
+            "columns": self.columns,
+            "dtypes": [dtype.str for dtype in self.dtypes],
+            "source_header": self._source_header,
+        }).encode()
+        self.file.write(_FILE_HEADER.pack(LOG_MAGIC, LOG_VERSION, len(header)))
+        self.file.write(header)
+
+    def write_frame(self, raw, frame):
+        if self.columns is None:
+            self._write_file_header(frame.columns)
+        elif frame.columns != self.columns:
+            raise ValueError("Frame columns do not match the log columns")
+
+        if not len(frame):
+            return
+        self._pending.append(frame.data)
+        self._pending_rows += len(frame)
+        if self._pending_rows >= self.chunk_rows:
+            self.flush_chunk()
+
+    def write_frames(self, frames):
+        for raw, frame in frames:
+            self.write_frame(raw, frame)
+
+    def flush(self, fsync=False):
+        """Writes the buffered rows as a chunk (if the file header is out) and flushes the file"""
+        if self.columns is not None:
+            self.flush_chunk()
+        self.file.flush()
+        if fsync:
+            os.fsync(self.file.fileno())
+
+    def flush_chunk(self):
+        if not self._pending_rows:
+            return
+        data = np.concatenate(self._pending, axis=1) if len(self._pending) > 1 else self._pending[0]
+        self.file.write(_CHUNK_HEADER.pack(CHUNK_MAGIC, data.shape[1]))
+        for values, dtype in zip(data, self.dtypes):
+            self.file.write(values.astype(dtype).tobytes())
+        self._pending = []
+        self._pending_rows = 0
+
+    def close(self):
+        if self.columns is None:
+            self._write_file_header(LOG_COLUMNS)
+        self.flush_chunk()
+        self.file.close()
+
+
+class BackgroundLogWriter:
+    """Runs a CsvLogWriter or BinaryLogWriter on a writer thread, fed through a bounded queue.
+
+    write_frame() never blocks the caller on the disk: if the queue is full the frame is dropped
+    and counted in self.dropped. The writer thread takes up to batch_size queued frames per write,
+    flushes every flush_interval seconds and, if fsync_interval is set, fsyncs that often.
+    An error on the writer thread is raised again by the next write_frame() or close(); a failed
+    write does not keep the thread from stopping.
+    """
+    _STOP = object()
+
+    def __init__(self, writer, max_queue=256, batch_size=64, flush_interval=1.0, fsync_interval=None):
+        self.writer = writer
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.fsync_interval = fsync_interval
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._error = None
+
+        self.queued = 0          #frames accepted
+        self.written = 0         #frames handed to the writer
+        self.dropped = 0         #frames refused because the queue was full
+        self.batches = 0
+        self.max_depth = 0       #deepest the queue has been
+        self.max_write_time = 0  #slowest batch write or flush, in seconds
+
+        self._thread = threading.Thread(target=self._run, name="LogWriter", daemon=True)
+        self._thread.start()
+
+    @property
+    def depth(self):
+        return self._queue.qsize()
+
+    @property
+    def capacity(self):
+        return self._queue.maxsize
+
+    def stats(self):
+        return {"queued": self.queued, "written": self.written, "dropped": self.dropped,
+                "batches": self.batches, "depth": self.depth, "max_depth": self.max_depth,
+                "capacity": self.capacity, "max_write_time": self.max_write_time}
+
+    def _raise_error(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise IOError("Log writer failed: " + str(error)) from error
+
+    def write_header(self, header):
+        self._raise_error()
+        self._queue.put((self.writer.write_header, header))
+
+    def write_frame(self, raw, frame):
+        self._raise_error()
+        try:
+            self._queue.put_nowait((None, (raw, frame)))
+        except queue.Full:
+            self.dropped += 1
+            return
+        self.queued += 1
+        self.max_depth = max(self.max_depth, self._queue.qsize())
+
+    def close(self, timeout=CLOSE_TIMEOUT):
+        """Writes everything still queued, then closes the wrapped writer. Raises IOError if the
+        writer thread has not finished within timeout seconds, e.g. on a stalled disk"""
+        deadline = time.monotonic() + timeout
+        try:
+            self._queue.put((self._STOP, None), timeout=timeout)
+        except queue.Full:
+            pass
+        self._thread.join(max(deadline - time.monotonic(), 0))
+        if self._thread.is_alive():
+            error, self._error = self._error, None
+            raise IOError("Log writer did not finish within %g s" % timeout) from error
+        self._raise_error()
+
+    def _run(self):
+        next_flush = time.monotonic() + self.flush_interval
+        next_fsync = time.monotonic() + self.fsync_interval if self.fsync_interval else None
+        stopping = False
+        while not stopping:
+            try:
+                items = [self._queue.get(timeout=max(next_flush - time.monotonic(), 0))]
+            except queue.Empty:
+                items = []
+            while len(items) < self.batch_size:
+                try:
+                    items.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            #Decided before writing, so a failing write cannot swallow the stop
+            stopping = any(method is self._STOP for method, _ in items)
+
+            try:
+                start = time.monotonic()
+                frames = []
+                for method, item in items:
+                    if method is None:
+                        frames.append(item)
+                        continue
+                    self._write(frames)
+                    frames = []
+                    if method is self._STOP:
+                        break
+                    method(item)
+                self._write(frames)
+
+                now = time.monotonic()
+                if now >= next_flush or stopping:
+                    fsync = next_fsync is not None and (now >= next_fsync or stopping)
+                    with Tracing.span("fsync" if fsync else "flush", "log"):
+                        self.writer.flush(fsync)
+                    next_flush = now + self.flush_interval
+                    if fsync:
+                        next_fsync = now + self.fsync_interval
+                self.max_write_time = max(self.max_write_time, time.monotonic() - start)
+            except Exception as e:
+                self._error = e
+
+        try:
+            self.writer.close()
+        except Exception as e:
+            self._error = self._error or e
+
+    def _write(self, frames):
+        if frames:
+            with Tracing.span("write frames", "log", frames=len(frames)):
+                self.writer.write_frames(frames)
+            self.written += len(frames)
+            self.batches += 1
+
+
+def open_log_writer(path, max_bytes=None, max_seconds=None):
+    """Returns a BinaryLogWriter for .plog paths, a CsvLogWriter otherwise.
+    Compressed CSV (.gz, .zst) is rotated by default, plain CSV only if max_bytes or max_seconds
+    is given; pass 0 for both to keep a compressed log in a single file"""
+    lower = path.lower()
+    if lower.endswith(BINARY_LOG_EXTENSION):
+        return BinaryLogWriter(path)
+    if lower.endswith(COMPRESSED_EXTENSIONS) and max_bytes is None and max_seconds is None:
+        max_bytes, max_seconds = DEFAULT_ROTATE_BYTES, DEFAULT_ROTATE_SECONDS
+    if max_bytes or max_seconds:
+        return RotatingLogWriter(path, max_bytes, max_seconds)
+    return CsvLogWriter(path)
+
+
+class BinaryLogReader:
+    """Memory-maps a .plog file. Only the chunk headers are read when opening; column data
+    is returned as views of the mapping (one chunk) or gathered for the requested rows."""
+    def __init__(self, path):
+        self._file = open(path, "rb")
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version, header_length = _FILE_HEADER.unpack_from(self._map, 0)
+        if magic != LOG_MAGIC:
+            raise ValueError(path + " is not a binary plasma log")
+        if version != LOG_VERSION:
+            raise ValueError("Unsupported binary log version %d" % version)
+
+        offset = _FILE_HEADER.size
+        header = json.loads(self._map[offset:offset + header_length])
+        self.columns = tuple(header["columns"])
+        self.dtypes = tuple(np.dtype(dtype) for dtype in header["dtypes"])
+        self.source_header = header["source_header"]
+        self._row_size = sum(dtype.itemsize for dtype in self.dtypes)
+
+        #(data offset, first row, rows) of every complete chunk
+        self.chunks = []
+        self.rows = 0
+        offset += header_length
+        while offset + _CHUNK_HEADER.size <= len(self._map):
+            magic, rows = _CHUNK_HEADER.unpack_from(self._map, offset)
+            offset += _CHUNK_HEADER.size
+            if magic != CHUNK_MAGIC or offset + rows * self._row_size > len(self._map):
+                break #Truncated tail, e.g. the logger was killed mid-write
+            self.chunks.append((offset, self.rows, rows))
+            self.rows += rows
+            offset += rows * self._row_size
+
+    def __len__(self):
+        return self.rows
+
+    def chunk_column(self, chunk, name):
+        """Zero-copy view of one column of one chunk"""
+        offset, _, rows = self.chunks[chunk]
+        index = self.columns.index(name)
+        for dtype in self.dtypes[:index]:
+            offset += rows * dtype.itemsize
+        return np.frombuffer(self._map, self.dtypes[index], rows, offset)
+
+    def read(self, name, start=0, stop=None):
+        """Returns rows start:stop of a column"""
+        stop = self.rows if stop is None else min(stop, self.rows)
+        parts = []
+        for chunk, (_, first, rows) in enumerate(self.chunks):
+            if first + rows <= start or first >= stop:
+                continue
+            values = self.chunk_column(chunk, name)
+            parts.append(values[max(start - first, 0):stop - first])
+        if not parts:
+            return np.empty(0, self.dtypes[self.columns.index(name)])
+        return parts[0] if len(parts) == 1 else np.concatenate(parts)
+
+    def close(self):
+        try:
+            self._map.close()
+        except BufferError:
+            pass #Column views are still alive, the mapping is released with them
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def binary_to_csv(source, destination):
+    """Converts a .plog file to CSV with the firmware's header and number formats"""
+    with BinaryLogReader(source) as log, open(destination, "w") as out:
+        if log.source_header:
+            out.write(log.source_header + "\n")
+        row_format = ",".join(_CSV_FORMATS.get(dtype.str, "%s") for dtype in log.dtypes)
+        for chunk in range(len(log.chunks)):
+            columns = [log.chunk_column(chunk, name) for name in log.columns]
+            np.savetxt(out, np.column_stack(columns), fmt=row_format.split(","), delimiter=",")
+
+
+def _is_row(line, columns):
+    first = line.lstrip()[:1]
+    return first != b"" and first in b"-0123456789." and line.count(b",") == columns - 1
+
+
+def csv_to_binary(source, destination, block_size=4*1024*1024, on_frame=None, progress=None):
+    """Converts a CSV log to .plog, streaming it in blocks so the CSV is never fully in memory.
+    The columns are read from the header line; a log without one is taken to hold all LOG_COLUMNS.
+    Lines without a full row of values (a frame cut short) are skipped.
+    on_frame is called with the LogFrame of every converted block, and progress with the fraction
+    of the (compressed) file read so far; either may raise to abort the conversion"""
+    log = BinaryLogWriter(destination)
+    try:
+        with open_compressed(source, "rb") as file:
+            fd = file.fileno() #the file on disk, also under a decompressor
+            size = os.fstat(fd).st_size
+            tail = b""
+            header = file.readline()
+            if not header.strip() or _is_row(header, header.count(b",") + 1):
+                columns = LOG_COLUMNS
+                tail = header #No header line, the file starts with data
+            else:
+                columns = columns_from_header(header)
+                log.write_header(header)
+
+            while True:
+                block = file.read(block_size)
+                data = tail + block
+                if block:
+                    cut = data.rfind(b"\n") + 1
+                    data, tail = data[:cut], data[cut:]
+
+                lines = [line for line in data.replace(b"\r", b"").split(b"\n") if _is_row(line, len(columns))]
+                if lines:
+                    values = np.array(b",".join(lines).split(b","), dtype=np.float64)
+                    frame = LogFrame(np.ascontiguousarray(values.reshape(-1, len(columns)).T), columns)
+                    log.write_frame(None, frame)
+                    if on_frame is not None:
+                        on_frame(frame)
+                if progress is not None:
+                    progress(min(os.lseek(fd, 0, os.SEEK_CUR) / size, 1.0) if size and block else 1.0)
+
+                if not block:
+                    break
+    finally:
+        log.close()
+
+
+if __name__ == "__main__":
+    if len(sys.argv) not in (2, 3):
+        print("Usage: python DataLog.py <log.plog> [out.csv]")
+        print("       python DataLog.py <log.csv> [out.plog]")
+        sys.exit(1)
+    source = sys.argv[1]
+    to_binary = not source.lower().endswith(BINARY_LOG_EXTENSION)
+    extension = BINARY_LOG_EXTENSION if to_binary else ".csv"
+    destination = sys.argv[2] if len(sys.argv) == 3 else source.rsplit(".", 1)[0] + extension
+    if to_binary:
+        csv_to_binary(source, destination)
+    else:
+        binary_to_csv(source, destination)
+    print("Wrote " + destination)
@@ -0,0 +1,253 @@
+## Controls a bank of plasma controllers from one process.
+## Every device keeps its own PlasmaSerialInterface, and so its own SerialWorker I/O thread.
+## Fleet-wide operations are submitted to all workers first and only then waited on, so starting,
+## stopping or polling N boards takes about as long as one. A single acquisition loop collects the
+## streamed frames and status of every device into per-device logs and one snapshot for dashboards.
+##
+## Usage: python DeviceManager.py [/dev/ttyACM0 /dev/ttyACM1 ...] [--output run.plog] [--duration s]
+##        logs to run.ttyACM0.plog, run.ttyACM1.plog, ... and prints a status table every second.
+##        Without ports, every board found by PortDiscovery is used.
+
+import argparse
+import os
+import signal
+import sys
+import threading
+import time
+
+from FrameReader import LOG_CHANNELS_ALL
+from PlasmaSerialInterface import PlasmaSerialInterface
+from Scheduler import Scheduler
+from SerialWorker import PRIORITY_CONTROL
+
+
+class Device:
+    """One controller of the fleet, with the latest telemetry received from it"""
+    def __init__(self, port, **interface_options):
+        self.port = port
+        self.name = os.path.basename(port)
+        self.interface = PlasmaSerialInterface(port, threading.Event(), **interface_options)
+
+        self.status = None      #latest PlasmaStatus
+        self.last_frame = None  #latest parsed LogFrame
+        self.frames = 0
+        self.error = None       #last failure, as text
+        self.log = None
+        self.columns = None
+
+    @property
+    def ready(self):
+        return self.interface.initialized
+
+    def snapshot(self):
+        status = self.status
+        return {"device": self.name, "port": self.port, "ready": self.ready, "frames": self.frames,
+                "plasma_on": status.plasma_on if status else None,
+                "frequency": status.frequency if status else None,
+                "supply_hv": status.voltage_hv if status else None,
+                "frames_lost": self.interface.frames_lost, "frames_corrupt": self.interface.frames_corrupt,
+                "not_logged": self.log.dropped if self.log is not None else 0,
+                "error": self.error}
+
+
+class DeviceManager:
+    """Holds one Device per serial port. Fleet-wide methods return {device name: result}; a device
+    that fails gets its exception as result and its error text in device.error, the others go on."""
+    def __init__(self, ports, **interface_options):
+        self.devices = [Device(port, **interface_options) for port in ports]
+        self.timeout = 5
+
+    def ready(self):
+        return [device for device in self.devices if device.ready]
+
+    def submit(self, fn, devices=None, priority=PRIORITY_CONTROL):
+        """Queues fn(interface) on the worker of every device, so they all run at the same time.
+        Returns {device: Future}"""
+        devices = self.ready() if devices is None else devices
+        return {device: device.interface.worker.submit(priority, fn, device.interface) for device in devices}
+
+    def gather(self, futures):
+        """Waits for {device: Future}, at most self.timeout for all of them together, and returns
+        {device name: result or exception}"""
+        results = {}
+        deadline = time.monotonic() + self.timeout
+        for device, future in futures.items():
+            try:
+                results[device.name] = future.result(max(deadline - time.monotonic(), 0))
+            except Exception as e:
+                device.error = str(e) or type(e).__name__
+                results[device.name] = e
+        return results
+
+    def initialize(self):
+        results = self.gather({device: device.interface.initialize() for device in self.devices})
+        for device in self.devices:
+            if results[device.name] is False:
+                device.error = "device not found"
+        return results
+
+    def start_all(self, freq=None):
+        #start_session() sets freq once the plasma runs, starting it resets the frequency
+        return self.gather({device: device.interface.start_session(freq) for device in self.ready()})
+
+    def stop_all(self):
+        #stop_plasma is queued at safety priority, ahead of anything else pending on each worker
+        return self.gather({device: device.interface.stop_plasma() for device in self.ready()})
+
+    def shutdown_all(self):
+        self.stop_all()
+        return self.gather({device: device.interface.system_shutdown() for device in self.ready()})
+
+    def poll_status(self, devices=None):
+        """Queries the status of all devices at once and keeps it in device.status"""
+        devices = self.ready() if devices is None else devices
+        statuses = self.gather({device: device.interface.query_status() for device in devices})
+        for device in devices:
+            if not isinstance(statuses[device.name], Exception):
+                device.status = statuses[device.name]
+        return statuses
+
+    def open_logs(self, path, channels=LOG_CHANNELS_ALL):
+        """Opens one log per ready device, named after path and the device (run.plog -> run.ttyACM0.plog),
+        and selects the logged columns. The writers run on their own threads (BackgroundLogWriter)"""
+        from DataLog import BackgroundLogWriter, open_log_writer, tagged_log_path
+        from LogFrame import mask_columns
+        self.gather(self.submit(lambda interface: interface.set_log_selection(channels)))
+        headers = self.gather(self.submit(lambda interface: interface.query_log_header()))
+        for device in self.ready():
+            device.log = BackgroundLogWriter(open_log_writer(tagged_log_path(path, device.name)), fsync_interval=10)
+            device.log.write_header(headers[device.name])
+            device.columns = mask_columns(device.interface.log_channels)
+
+    def acquire(self, stop_event, status_interval=0.1, frame_interval=10/1000):
+        """Streams frames from every ready device until stop_event is set. Frames go to the device
+        logs (if open_logs() was called); the newest frame and status are kept for snapshot().
+        Devices that fail to start streaming are left out, with their error in device.error"""
+        from LogFrame import mask_columns, parse_log_frame
+        ready = self.ready()
+        started = self.gather({device: device.interface.start_streaming() for device in ready})
+        devices = [device for device in ready if not isinstance(started[device.name], Exception)]
+        for device in devices:
+            if device.columns is None:
+                device.columns = mask_columns(device.interface.log_channels)
+
+        def collect_frames(timeout=0, deadline=None):
+            for device in devices:
+                for data in device.interface.stream_frames(timeout):
+                    try:
+                        frame = parse_log_frame(data, device.columns)
+                    except ValueError as e:
+                        device.error = str(e)
+                        continue
+                    if device.log is not None:
+                        device.log.write_frame(data, frame)
+                    device.last_frame = frame
+                    device.frames += 1
+                    if deadline is not None and time.monotonic() >= deadline:
+                        break
+
+        #Status queries are only submitted here and picked up on a later run, so a device that does
+        #not answer never holds up the frames of the others. Each device has one query at a time
+        pending = {}
+        def poll_status():
+            for device in devices:
+                future = pending.get(device)
+                if future is not None:
+                    if not future.done():
+                        continue
+                    try:
+                        device.status = future.result()
+                    except Exception as e:
+                        device.error = str(e) or type(e).__name__
+                pending[device] = device.interface.query_status()
+
+        scheduler = Scheduler(stop_event)
+        scheduler.add("frames", frame_interval, collect_frames, priority=0)
+        scheduler.add("status", status_interval, poll_status, priority=1)
+        scheduler.run()
+
+        #Also the devices that failed to start, in case they did start after the timeout
+        self.gather({device: device.interface.stop_streaming() for device in ready})
+        #The frames still on the way end with the marker stop_streaming() queues; a device whose
+        #stop failed is read until the timeout
+        collect_frames(self.timeout, time.monotonic() + self.timeout)
+        return scheduler
+
+    def snapshot(self):
+        return [device.snapshot() for device in self.devices]
+
+    def close(self):
+        for device in self.devices:
+            try:
+                if device.log is not None:
+                    device.log.close()
+            finally:
+                device.interface.close()
+
+
+def format_table(snapshot):
+    lines = ["%-12s %-5s %-6s %9s %9s %8s %6s %s" % ("device", "ready", "plasma", "freq (Hz)", "HV (V)", "frames",
+                                                    "lost", "error")]
+    for row in snapshot:
+        lines.append("%-12s %-5s %-6s %9s %9s %8d %6d %s" % (
+            row["device"], "yes" if row["ready"] else "no",
+            "-" if row["plasma_on"] is None else ("on" if row["plasma_on"] else "off"),
+            "-" if row["frequency"] is None else row["frequency"],
+            "-" if row["supply_hv"] is None else "%.1f" % (row["supply_hv"] / 1000),
+            row["frames"], row["frames_lost"] + row["frames_corrupt"], row["error"] or ""))
+    return "\n".join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run several plasma controllers from one process")
+    parser.add_argument("ports", nargs="*", help="serial ports of the controllers, default all boards found")
+    parser.add_argument("--output", help="log path, one log per device is written next to it")
+    parser.add_argument("--duration", type=float, default=0, help="seconds to run, 0 runs until stopped")
+    parser.add_argument("--freq", type=float, help="fixed frequency in kHz for all devices")
+    parser.add_argument("--no-start", action="store_true", help="only monitor, do not start or stop the plasmas")
+    args = parser.parse_args(argv)
+
+    stop_event = threading.Event()
+    def request_stop(signum, frame):
+        stop_event.set()
+    signal.signal(signal.SIGINT, request_stop)
+    signal.signal(signal.SIGTERM, request_stop)
+
+    ports = args.ports
+    if not ports:
+        from PortDiscovery import discover
+        ports = [board.port for board in discover()]
+        if not ports:
+            print("no controller found", file=sys.stderr)
+            return 1
+    manager = DeviceManager(ports)
+    try:
+        manager.initialize()
+        if not manager.ready():
+            print(format_table(manager.snapshot()), file=sys.stderr)
+            return 1
+        if args.output:
+            manager.open_logs(args.output)
+        if not args.no_start:
+            manager.start_all(args.freq)
+
+        def report():
+            end_time = time.monotonic() + args.duration if args.duration else None
+            while not stop_event.wait(1):
+                print(format_table(manager.snapshot()) + "\n", file=sys.stderr, flush=True)
+                if end_time is not None and time.monotonic() >= end_time:
+                    stop_event.set()
+        threading.Thread(target=report, daemon=True).start()
+
+        manager.acquire(stop_event)
+        return 0
+
+    finally:
+        if not args.no_start:
+            manager.shutdown_all()
+        manager.close()
+        print(format_table(manager.snapshot()), file=sys.stderr)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,141 @@
+## One window for a bank of controllers run by DeviceManager: a row per device with its state,
+## frequency, HV supply and frame counts, and buttons that start or stop all of them at once.
+## Only Qt widgets are used (no matplotlib), so the dashboard starts quickly for any number of boards.
+##
+## Usage: python main.py --devices /dev/ttyACM0 /dev/ttyACM1 ... [--log run.plog]
+
+import threading
+
+from PySide6.QtCore import QTimer, Signal
+from PySide6.QtWidgets import (QHBoxLayout, QMainWindow, QMessageBox, QPushButton, QTableWidget,
+                               QTableWidgetItem, QVBoxLayout, QWidget)
+
+from DeviceManager import DeviceManager
+
+
+COLUMNS = (("Device", "device"), ("Ready", "ready"), ("Plasma", "plasma_on"), ("Freq (kHz)", "frequency"),
+           ("HV (V)", "supply_hv"), ("Frames", "frames"), ("Lost", "frames_lost"), ("Corrupt", "frames_corrupt"),
+           ("Not logged", "not_logged"), ("Error", "error"))
+
+
+def _cell_text(key, value):
+    if value is None:
+        return "-"
+    if key == "ready":
+        return "yes" if value else "no"
+    if key == "plasma_on":
+        return "on" if value else "off"
+    if key == "frequency":
+        return "%.3f" % (value / 1000)
+    if key == "supply_hv":
+        return "%.1f" % (value / 1000)
+    return str(value)
+
+
+class FleetDashboard(QMainWindow):
+    #Results of fleet operations run off the GUI thread, as (title, {device: result})
+    operation_done = Signal(object)
+
+    refresh_interval_ms = 500
+    acquisition_join_timeout = 10 #seconds the acquisition thread gets to log the last frames when stopping
+
+    def __init__(self, ports, log_path=None):
+        super().__init__()
+        self.setWindowTitle("Plasma Control - %d devices" % len(ports))
+        self.resize(900, 120 + 30 * len(ports))
+
+        self.manager = DeviceManager(ports)
+        self.log_path = log_path
+        self.stop_event = threading.Event()
+        self.acquisition_thread = None
+
+        self.table = QTableWidget(len(ports), len(COLUMNS), self)
+        self.table.setHorizontalHeaderLabels([title for title, _ in COLUMNS])
+        self.table.horizontalHeader().setStretchLastSection(True)
+        self.start_button = QPushButton("Start all", self)
+        self.stop_button = QPushButton("Stop all", self)
+        self.start_button.clicked.connect(self.handle_start_all)
+        self.stop_button.clicked.connect(self.handle_stop_all)
+        self.start_button.setEnabled(False)
+
+        buttons = QHBoxLayout()
+        buttons.addWidget(self.start_button)
+        buttons.addWidget(self.stop_button)
+        buttons.addStretch()
+        widget = QWidget(self)
+        layout = QVBoxLayout(widget)
+        layout.addLayout(buttons)
+        layout.addWidget(self.table)
+        self.setCentralWidget(widget)
+
+        self.operation_done.connect(self.handle_operation_done)
+        self.refresh_timer = QTimer(self)
+        self.refresh_timer.setInterval(self.refresh_interval_ms)
+        self.refresh_timer.timeout.connect(self.refresh)
+        self.refresh_timer.start()
+
+        def initialize():
+            results = self.manager.initialize()
+            if self.log_path and self.manager.ready():
+                self.manager.open_logs(self.log_path)
+            self.manager.poll_status()
+            return results
+        self._run_in_background("Initialize", initialize)
+
+    """Runs a fleet operation on a plain thread so the window stays responsive, and reports it through operation_done"""
+    def _run_in_background(self, title, operation):
+        def run():
+            self.operation_done.emit((title, operation()))
+        threading.Thread(target=run, daemon=True).start()
+
+    def handle_operation_done(self, result):
+        title, results = result
+        if title == "Initialize":
+            self.start_button.setEnabled(bool(self.manager.ready()))
+        elif title == "Start" and self.acquisition_thread is None:
+            self.stop_event.clear()
+            self.acquisition_thread = threading.Thread(target=self.manager.acquire, args=(self.stop_event,), daemon=True)
+            self.acquisition_thread.start()
+        elif title == "Stop":
+            self.acquisition_thread = None
+
+        failed = {name: value for name, value in results.items() if isinstance(value, Exception)}
+        if failed:
+            QMessageBox.warning(self, "Warning", "%s failed on:\n%s" % (
+                title, "\n".join("%s: %s" % (name, error) for name, error in failed.items())))
+        self.refresh()
+
+    def handle_start_all(self):
+        self._run_in_background("Start", self.manager.start_all)
+
+    def handle_stop_all(self):
+        acquisition_thread = self.acquisition_thread
+        def stop():
+            results = self.manager.stop_all()
+            self.stop_event.set()
+            if acquisition_thread is not None:
+                acquisition_thread.join(self.acquisition_join_timeout)
+            self.manager.poll_status()
+            return results
+        self._run_in_background("Stop", stop)
+
+    def refresh(self):
+        for row, snapshot in enumerate(self.manager.snapshot()):
+            for column, (_, key) in enumerate(COLUMNS):
+                text = _cell_text(key, snapshot[key])
+                item = self.table.item(row, column)
+                if item is None:
+                    self.table.setItem(row, column, QTableWidgetItem(text))
+                elif item.text() != text:
+                    item.setText(text)
+
+    """Stops every plasma, waits for the acquisition to end and shuts the supplies down. Every wait
+    is bounded (acquisition_join_timeout, DeviceManager.timeout per fleet operation), so an
+    unresponsive board cannot keep the window from closing"""
+    def shutdown_system(self):
+        self.refresh_timer.stop()
+        self.stop_event.set()
+        if self.acquisition_thread is not None:
+            self.acquisition_thread.join(self.acquisition_join_timeout)
+        self.manager.shutdown_all()
+        self.manager.close()
@@ -0,0 +1,282 @@
+## Terminator-delimited frame reader for the ADC1/2 log replies.
+## Bytes are read with readinto() into one preallocated buffer, only newly arrived bytes are
+## searched for the terminator, and frames are returned as memoryview slices of the buffer.
+## The reader blocks in select() until data arrives instead of polling on a sleep tick.
+## StreamReader does the same for frames the firmware pushes on its own (l1), keeping the
+## command replies sent in between apart from them.
+##
+## Binary frames (lb1, see printHbridgeDataloggingBinary() in the firmware) are length prefixed
+## instead of terminated, all fields little-endian:
+##   header   magic, sample count, sequence number, time of the first sample and time step (us),
+##            frequency (Hz), deadtime, upper and lower frequency calculation points,
+##            channel mask and decimation of the log selection (ls)
+##   samples  count x (Bridge I, VplaL1, VplaL2, VbriS1, VbriS2 as float32, TIM1 status as uint16),
+##            each field only if its column is in the channel mask
+##   crc      CRC-32 (as zlib.crc32) of the header and the samples
+
+import select
+import struct
+import time
+import zlib
+
+
+#Channel mask selecting every column of LogFrame.LOG_COLUMNS, bit n is column n
+LOG_CHANNELS_ALL = 0x7FF
+
+BINARY_MAGIC = b"\xa5\x5a"
+BINARY_HEADER = struct.Struct("<2sHIddIIffHH")
+#(column, struct format) of the per-sample fields, in the order they are sent
+BINARY_SAMPLE_FIELDS = ((3, "f"), (4, "f"), (5, "f"), (6, "f"), (7, "f"), (8, "H"))
+BINARY_CRC = struct.Struct("<I")
+BINARY_MAX_SAMPLES = 4096 #larger counts are taken as a corrupted header
+
+
+def binary_sample_size(channels):
+    """Bytes per sample of a binary frame with the given channel mask"""
+    return sum(struct.calcsize(code) for column, code in BINARY_SAMPLE_FIELDS if channels >> column & 1)
+
+
+def is_binary_frame(frame):
+    return bytes(frame[:len(BINARY_MAGIC)]) == BINARY_MAGIC
+
+
+def check_binary_frame(frame):
+    """Returns the sequence number of a complete binary frame. Raises ValueError if its CRC does not match"""
+    (crc,) = BINARY_CRC.unpack_from(frame, len(frame) - BINARY_CRC.size)
+    if zlib.crc32(frame[:len(frame) - BINARY_CRC.size]) != crc:
+        raise ValueError("Binary log frame failed its CRC check")
+    return BINARY_HEADER.unpack_from(frame)[2]
+
+
+class FrameReader:
+    """Reads frames ending in terminator (single byte) from a serial.Serial port.
+
+    The memoryview returned by read_frame() points into the receive buffer and is only
+    valid until the next call to read_frame() or reset(). Copy it (bytes(frame)) if it
+    has to outlive that, e.g. when handing it to another thread.
+    """
+    def __init__(self, ser, terminator=b"#", size=64*1024):
+        self.ser = ser
+        self.terminator = terminator
+        self._buffer = bytearray(size)
+        self._view = memoryview(self._buffer)
+        self._start = 0   #first byte not yet returned
+        self._end = 0     #end of received data
+        self._scanned = 0 #bytes before this offset are known not to hold a terminator
+
+        try:
+            self._fd = ser.fileno()
+        except (AttributeError, OSError, NotImplementedError):
+            self._fd = None #no selectable descriptor (e.g. Windows), fall back to short sleeps
+
+
+    """Discards everything buffered. Call after ser.reset_input_buffer()"""
+    def reset(self):
+        self._start = self._end = self._scanned = 0
+
+
+    """Returns the next frame (without terminator) as a memoryview.
+    Raises TimeoutError if no complete frame arrives within timeout seconds"""
+    def read_frame(self, timeout):
+        self._compact()
+        deadline = time.monotonic() + timeout
+
+        while True:
+            index = self._buffer.find(self.terminator, self._scanned, self._end)
+            if index >= 0:
+                frame = self._view[self._start:index]
+                self._start = self._scanned = index + 1
+                return frame
+            self._scanned = self._end
+
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise TimeoutError("No complete response received")
+            if self._wait(remaining):
+                self._fill()
+
+
+    """Returns the next binary frame (header, samples and CRC) as a memoryview, skipping
+    anything received before it. Raises TimeoutError if it does not arrive within timeout seconds"""
+    def read_binary_frame(self, timeout):
+        self._compact()
+        deadline = time.monotonic() + timeout
+
+        while True:
+            index = self._buffer.find(BINARY_MAGIC, self._start, self._end)
+            if index >= 0:
+                self._start = self._scanned = index
+                length = self._binary_length(index)
+                if length == 0:
+                    self._start = self._scanned = index + 1 #not a frame after all, look further
+                    continue
+                if length is not None and self._end - index >= length:
+                    self._start = self._scanned = index + length
+                    return self._view[index:index + length]
+            else:
+                #Keep a byte that may be the first half of the magic
+                self._start = self._scanned = max(self._start, self._end - len(BINARY_MAGIC) + 1)
+
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise TimeoutError("No complete response received")
+            if self._wait(remaining):
+                self._fill()
+
+
+    """Length of the binary frame starting at offset. None while its header is incomplete,
+    0 if the header cannot be valid"""
+    def _binary_length(self, offset):
+        if self._end - offset < BINARY_HEADER.size:
+            return None
+        header = BINARY_HEADER.unpack_from(self._buffer, offset)
+        count, channels = header[1], header[9]
+        if count > BINARY_MAX_SAMPLES or not channels or channels > LOG_CHANNELS_ALL:
+            return 0
+        return BINARY_HEADER.size + count * binary_sample_size(channels) + BINARY_CRC.size
+
+
+    """Moves unreturned bytes to the front of the buffer. Only copies when a previous
+    read left a partial frame behind"""
+    def _compact(self):
+        if self._start == 0:
+            return
+        leftover = self._end - self._start
+        if leftover:
+            self._buffer[:leftover] = bytes(self._view[self._start:self._end])
+        self._scanned -= self._start
+        self._start = 0
+        self._end = leftover
+
+
+    def _wait(self, timeout):
+        if self._fd is None:
+            if self.ser.in_waiting:
+                return True
+            time.sleep(min(timeout, 1/1000))
+            return bool(self.ser.in_waiting)
+
+        readable, _, _ = select.select([self._fd], [], [], timeout)
+        return bool(readable)
+
+
+    def _fill(self):
+        waiting = self.ser.in_waiting
+        if not waiting:
+            return
+
+        free = len(self._buffer) - self._end
+        if waiting > free:
+            self._grow(waiting - free)
+
+        self._end += self.ser.readinto(self._view[self._end:self._end + waiting])
+
+
+    """Frames larger than the buffer: allocate a bigger one. Rare, sized by the largest frame seen"""
+    def _grow(self, needed):
+        size = len(self._buffer)
+        while size - self._end < needed:
+            size *= 2
+        buffer = bytearray(size)
+        buffer[:self._end] = self._view[:self._end]
+        self._buffer = buffer
+        self._view = memoryview(buffer)
+
+
+class StreamReader(FrameReader):
+    """Separates the frames pushed by the firmware while datalogging is on (start byte '$',
+    terminated by '#', or binary frames) from the command replies that arrive between two frames.
+
+    Frames are returned as bytes, since they are handed to other threads. Bytes outside
+    a frame are collected in self.replies and consumed by read_reply().
+    """
+    def __init__(self, ser, start=b"$", terminator=b"#", size=64*1024):
+        super().__init__(ser, terminator, size)
+        self.start = start
+        self.replies = bytearray()
+        self._in_frame = False
+
+
+    def reset(self):
+        super().reset()
+        self.replies.clear()
+        self._in_frame = False
+
+
+    """Reads what arrives within timeout seconds and returns the frames completed by it"""
+    def poll(self, timeout):
+        self._compact()
+        if self._wait(timeout):
+            self._fill()
+        return self._split()
+
+
+    """True while a frame has been started but has not been received completely"""
+    def in_frame(self):
+        return bool(self._in_frame)
+
+
+    """Returns the next reply up to and including its newline. Frames arriving in the meantime
+    are passed to frame_sink. Replies the firmware sends without a newline ("on", "ok") are
+    returned as received once timeout expires, like serial.Serial.readline() does"""
+    def read_reply(self, timeout, frame_sink):
+        deadline = time.monotonic() + timeout
+        while True:
+            index = self.replies.find(b"\n")
+            if index >= 0:
+                reply = bytes(self.replies[:index + 1])
+                del self.replies[:index + 1]
+                return reply
+
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                reply = bytes(self.replies)
+                self.replies.clear()
+                return reply
+            for frame in self.poll(remaining):
+                frame_sink(frame)
+
+
+    def _split(self):
+        frames = []
+        while True:
+            if not self._in_frame:
+                text = self._buffer.find(self.start, self._start, self._end)
+                binary = self._buffer.find(BINARY_MAGIC, self._start, self._end)
+                if text < 0 and binary < 0:
+                    #Keep a byte that may be the first half of the magic
+                    end = self._end
+                    if end > self._start and self._buffer[end - 1] == BINARY_MAGIC[0]:
+                        end -= 1
+                    self.replies += self._view[self._start:end]
+                    self._start = self._scanned = end
+                    return frames
+                if binary >= 0 and (text < 0 or binary < text):
+                    self.replies += self._view[self._start:binary]
+                    self._start = self._scanned = binary
+                    self._in_frame = "binary"
+                else:
+                    self.replies += self._view[self._start:text]
+                    self._start = self._scanned = text + 1
+                    self._in_frame = "text"
+
+            if self._in_frame == "binary":
+                length = self._binary_length(self._start)
+                if length == 0:
+                    self._start = self._scanned = self._start + 1
+                    self._in_frame = False
+                    continue
+                if length is None or self._end - self._start < length:
+                    return frames
+                frames.append(bytes(self._view[self._start:self._start + length]))
+                self._start = self._scanned = self._start + length
+                self._in_frame = False
+                continue
+
+            index = self._buffer.find(self.terminator, self._scanned, self._end)
+            if index < 0:
+                self._scanned = self._end
+                return frames
+            frames.append(bytes(self._view[self._start:index]))
+            self._start = self._scanned = index + 1
+            self._in_frame = False
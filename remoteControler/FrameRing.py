@@ -0,0 +1,73 @@
+## Bounded hand-off of parsed frames from the acquisition thread to the GUI thread.
+## The producer never blocks: when the ring is full the oldest frame is overwritten.
+## The consumer only ever takes the newest frame and discards the rest, so a slow
+## renderer shows the latest data instead of falling further behind.
+
+import collections
+import threading
+
+
+class FrameRing:
+    def __init__(self, capacity=8):
+        self._frames = collections.deque(maxlen=capacity)
+        self._lock = threading.Lock()
+        self.pushed = 0        #frames produced
+        self.consumed = 0      #frames handed to the consumer
+        self.overwritten = 0   #dropped because the ring was full
+        self.stale = 0         #dropped because a newer frame was available
+        self.skipped = 0       #handed to the consumer but not shown by it, see skip()
+
+
+    """Adds a frame, overwriting the oldest one if the ring is full. Never blocks on the consumer"""
+    def push(self, frame):
+        with self._lock:
+            if len(self._frames) == self._frames.maxlen:
+                self.overwritten += 1
+            self._frames.append(frame)
+            self.pushed += 1
+
+
+    """Returns the newest frame and drops the older ones, or None if no new frame has arrived"""
+    def pop_latest(self):
+        with self._lock:
+            if not self._frames:
+                return None
+            frame = self._frames.pop()
+            self.stale += len(self._frames)
+            self._frames.clear()
+            self.consumed += 1
+            return frame
+
+
+    """Counts a frame returned by pop_latest() that the consumer did not show, e.g. because
+    of a frame rate cap"""
+    def skip(self):
+        with self._lock:
+            self.skipped += 1
+
+
+    """Number of frames the consumer showed"""
+    @property
+    def shown(self):
+        return self.consumed - self.skipped
+
+
+    """Total number of frames that were never shown"""
+    @property
+    def dropped(self):
+        return self.overwritten + self.stale + self.skipped
+
+
+    """Empties the ring and resets the counters, for a new session"""
+    def clear(self):
+        with self._lock:
+            self._frames.clear()
+            self.pushed = 0
+            self.consumed = 0
+            self.overwritten = 0
+            self.stale = 0
+            self.skipped = 0
+
+
+    def __len__(self):
+        return len(self._frames)
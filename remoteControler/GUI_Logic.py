@@ -3,18 +3,64 @@
 import tempfile
 import threading
 import time
-import operator
-from PySide6.QtWidgets import QMainWindow, QMessageBox, QFileDialog
+import traceback
+from PySide6.QtCore import Qt, QTimer, Signal
+from PySide6.QtWidgets import QMainWindow, QMessageBox, QFileDialog, QProgressBar, QLabel
 from plasma_control_GUI import Ui_MainWindow
 from PlasmaSerialInterface import PlasmaSerialInterface
+from FrameReader import LOG_CHANNELS_ALL
+from LogFrame import channel_mask, mask_columns, parse_log_frame
+from FrameRing import FrameRing
+from DataLog import BackgroundLogWriter, CsvLogWriter, open_log_writer, sidecar_log_path
+from TrendHistory import TrendHistory
+from Resonance import ANALYSIS_COLUMNS, ResonanceAnalyzer
+from Scheduler import Scheduler
+import Tracing
+
+#Log columns used by update_plot(), all that is requested from the firmware when no log is saved
+PLOT_COLUMNS = ("time", "bridge_i", "vpla_l1", "vpla_l2", "upper", "lower")
 
 ## This class extends QMainWindow and integrates the generated UI.
 ## It connects UI elements such as buttons, line edits, and checkboxes to functions
 ## Currently functions are limited to outputing text tne console
 class GUILogic(QMainWindow, Ui_MainWindow):
-    def __init__(self):
+    #PlasmaStatus snapshots queried on the acquisition thread, delivered to the GUI thread as a queued signal
+    status_ready = Signal(object)
+    #Future of PlasmaSerialInterface.initialize(), delivered once the device is set up
+    device_ready = Signal(object)
+
+    #How often the GUI thread takes the newest frame from frame_ring. At least 1000/max_fps of the
+    #PlotCanvas (30 fps), or the canvas drops every other frame
+    plot_interval_ms = 34
+    trend_interval_ms = 1000 #How often the trend panel is redrawn
+    link_stats_interval_ms = 1000 #How often the link statistics in the status bar (and link_stats_path) are updated
+
+    #TrendHistory series, in the order of trend_series_selection, with their display scale
+    trend_series = (("freq", 1/1000), ("supply_3v3", 1/1000), ("supply_15v", 1/1000), ("supply_hv", 1/1000))
+
+    def __init__(self, serial_port=None, link_stats_path=None):
         super().__init__()
         self.setupUi(self)
+
+        #Parsed frames from the acquisition thread, drawn by plot_timer on the GUI thread
+        self.frame_ring = FrameRing(capacity=8)
+        self.plot_timer = QTimer(self)
+        self.plot_timer.setInterval(self.plot_interval_ms)
+        self.plot_timer.setTimerType(Qt.PreciseTimer) #a coarse timer may fire up to 5% early
+
+        #Fixed-memory history of the readouts for the trend panel
+        self.trend_history = TrendHistory([name for name, _ in self.trend_series])
+        self.trend_timer = QTimer(self)
+        self.trend_timer.setInterval(self.trend_interval_ms)
+
+        #Latency, throughput and timeouts of the serial link, see LinkStats
+        self.link_stats_path = link_stats_path #also written there, as JSON or Prometheus text
+        self.link_stats_label = QLabel(self)
+        self.resonance = None #ResonanceAnalyzer of the running session
+        self.resonance_label = QLabel(self)
+        self.link_stats_timer = QTimer(self)
+        self.link_stats_timer.setInterval(self.link_stats_interval_ms)
+
         self.setup_connections()
         self.system_on = False # Track power status
         self.manual_voltage_allowed = False # Can auto control be turned off?
@@ -23,19 +69,45 @@ class GUILogic(QMainWindow, Ui_MainWindow):
         self.save_location = ""
         self.plasma_thread = None
         self.logging_thread = None
+        self.data_log = None #BackgroundLogWriter of the running session
+        self.scheduler = None #Scheduler of the running session
         self.stop_event = threading.Event()
-        self.serial_lock = threading.Lock()
         self.plasma_active_event = threading.Event()
         self.auto_freq_adjust_enabled = True
 
      # Initialize the PlasmaSerialInterface
+     # initialize() runs on the serial worker so the window is shown right away. The controls stay
+     # disabled, with a busy indicator in the status bar, until handle_device_ready gets the result
+        self.frame_q1.setEnabled(False)
+        self.frame_q3.setEnabled(False)
+        self.init_progress = QProgressBar(self)
+        self.init_progress.setRange(0, 0) # busy indicator
+        self.init_progress.setMaximumWidth(120)
+        self.statusbar.addPermanentWidget(self.init_progress)
+        self.statusbar.showMessage("Connecting to the controller...")
+
+        # Adjust the serial port as needed (e.g., "COM3" on Windows or "/dev/ttyACM0" on Linux)
+        self.plasma_interface = PlasmaSerialInterface(serial_port, self.plasma_active_event)
+        self.plasma_interface.initialize().add_done_callback(self.device_ready.emit)
+
+    """Runs on the GUI thread once initialize() has finished"""
+    def handle_device_ready(self, initialized):
+        self.statusbar.removeWidget(self.init_progress)
+        self.statusbar.clearMessage()
         try:
-            # Adjust the serial port as needed (e.g., "COM3" on Windows or "/dev/ttyACM0" on Linux)
-            self.plasma_interface = PlasmaSerialInterface('/dev/ttyACM0', self.serial_lock, self.plasma_active_event)
-            if not self.plasma_interface.initialize():
+            if not initialized.result():
                 self.show_warning_popup("Microcontroller not responding. Check connection.")
+                return
         except Exception as e:
             self.show_warning_popup("Error initializing plasma interface: " + str(e))
+            return
+
+        self.frame_q1.setEnabled(True)
+        self.frame_q3.setEnabled(True)
+        self.statusbar.showMessage("Controller ready", 3000)
+        self.statusbar.addPermanentWidget(self.resonance_label)
+        self.statusbar.addPermanentWidget(self.link_stats_label)
+        self.link_stats_timer.start()
 
     ## Connects UI elements to respective event handlers
     def setup_connections(self):
@@ -57,6 +129,16 @@ class GUILogic(QMainWindow, Ui_MainWindow):
         self.enable_auto_frequency_correction.toggled.connect(self.handle_enable_auto_frequency_correction)
         self.enable_data_logging.toggled.connect(self.handle_enable_data_logging)
 
+        ## Acquisition thread -> GUI thread
+        self.status_ready.connect(self.show_status)
+        self.device_ready.connect(self.handle_device_ready)
+        self.plot_timer.timeout.connect(self.consume_frames)
+        self.trend_timer.timeout.connect(self.update_trend)
+        self.link_stats_timer.timeout.connect(self.update_link_stats)
+        self.link_stats_timer.timeout.connect(self.update_resonance)
+        self.trend_series_selection.currentIndexChanged.connect(self.update_trend)
+        self.trend_window_selection.currentIndexChanged.connect(self.update_trend)
+
 ## Defines functions for UI elements
  ## TODO Add dedicated methods instead of printing to console. 
     def handle_power_on(self):
@@ -64,7 +146,7 @@ class GUILogic(QMainWindow, Ui_MainWindow):
         if self.system_on:
             return
         
-        if (not self.plasma_interface.toggle_low_voltage()):
+        if (not self.plasma_interface.toggle_low_voltage().result()):
             print("Power on unsucessful")
             return
 
@@ -80,7 +162,7 @@ class GUILogic(QMainWindow, Ui_MainWindow):
             return
         self.handle_plasma_off()
 
-        if (self.plasma_interface.toggle_low_voltage()):
+        if (self.plasma_interface.toggle_low_voltage().result()):
             print("system is in undefined state. Power off unsuccessful")
             return
 
@@ -92,77 +174,86 @@ class GUILogic(QMainWindow, Ui_MainWindow):
         self.system_on = False
         print("Power Off button was pushed")
 
-    def update_freq_readout(self):
-        self.plasma_interface.ser.reset_input_buffer()
-        new_freq = self.plasma_interface.query_freq()
-        new_freq = str(round(float(new_freq)/1000, 3))
-        self.manual_frequency_selection.setText(new_freq)
-
-    """Queries the current ADC3 supply voltages and updates the GUI accordingly.
-        Assumes the following format: 3.3V,15V,HVDC
-    """
-    def update_supply_readout(self):
-        self.plasma_interface.ser.reset_input_buffer()
-        supply_update = self.plasma_interface.query_supply_voltages()
-
-        voltages = supply_update.split()
-        if len(voltages) != 3:
+    """Queries the frequency and supply voltages in one S? round trip. Called from the acquisition
+    thread, the display is updated on the GUI thread by show_status"""
+    def update_status(self):
+        try:
+            status = self.plasma_interface.query_status().result()
+        except Exception:
+            #A bad or missing S? reply is counted, and reported once per kind, the next poll may succeed
+            if self.plasma_interface.link_stats.error("status") == 1:
+                traceback.print_exc()
+            return
+        now = time.time()
+        self.trend_history.add("freq", status.frequency, now)
+        self.trend_history.add("supply_3v3", status.voltage_3_3, now)
+        self.trend_history.add("supply_15v", status.voltage_15, now)
+        self.trend_history.add("supply_hv", status.voltage_hv, now)
+        self.status_ready.emit(status)
+
+    """Updates the supply voltage readouts, and the frequency while auto frequency is on"""
+    def show_status(self, status):
+        self._3_3V_supply_readout.setText(str(status.voltage_3_3/1000))
+        self._15V_supply_readout.setText(str(status.voltage_15/1000))
+        self.high_V_supply_readout.setText(str(status.voltage_hv/1000))
+        if self.auto_freq_adjust_enabled:
+            self.manual_frequency_selection.setText(str(round(status.frequency/1000, 3)))
+
+    """Redraws the trend panel with the selected series and history level"""
+    def update_trend(self):
+        self.setupCanvases()
+        name, scale = self.trend_series[self.trend_series_selection.currentIndex()]
+        t, low, mean, high = self.trend_history.snapshot(name, self.trend_window_selection.currentIndex())
+        self.trend_canvas.update_trend(t, low * scale, mean * scale, high * scale,
+                                       self.trend_series_selection.currentText())
+
+
+    """Runs on the GUI thread from plot_timer. Plots the newest frame from the acquisition thread;
+    older frames that were not drawn in time are dropped and counted by frame_ring"""
+    def consume_frames(self):
+        frame = self.frame_ring.pop_latest()
+        if frame is None:
             return
-        self._3_3V_supply_readout.setText(str(float(voltages[0].decode().replace(",", ""))/1000))
-        self._15V_supply_readout.setText(str(float(voltages[1].decode().replace(",", ""))/1000))
-        self.high_V_supply_readout.setText(str((float(voltages[2].decode()))/1000))
-
-
-    """Updates the plot displaying the system parameters"""
-    def update_plot(self, data):
-        #parse the csv formatted data into usable lists
-        rows = data.strip().split("\n\r") 
-        rows = [row.split(",") for row in rows]
-        rows = [[float(cell) for cell in row] for row in rows]
-
-
-        columns = list(zip(*rows))
-        
-        #Subtract the initial time value from all subsequent values to get relative timing
-        columns[0] = [x - columns[0][0] for x in columns[0]]
-        
-        #                  0          1              2             3         4          5         6        7            8           9        10
-        #Columns layout: [Time], [Freq (Hz)], [Deadtime (%)], [Bridge I], [VplaL1], [VplaL2], [VbriS1], [VbriS2], [TIM1 status], [upper], [lower]
-
-
-        
-        time = columns[0]
-        bridgeI = columns[3]
-        #Subtract L1 and L2 to get differential voltage across array
-        plasmaV = list(map(operator.sub, columns[4], columns[5]))
-        
-        upper = columns[9]
-        lower = columns[10]
-
-
-
-        self.canvas.ax1.clear()
-        self.canvas.ax2.clear()
-        #plot bridge current
-        color = "tab:red"
-        self.canvas.ax1.set_xlabel('Time (us)')
-        self.canvas.ax1.set_ylabel('Bridge Current (mA)', color = color) 
-        self.canvas.ax1.plot(time,bridgeI, color = color)
-        
-        if (self.auto_freq_adjust_enabled):
-            uppercursorline = self.canvas.ax1.axhline(y=upper[1], color='green', linestyle='--')
-            lowercursorline = self.canvas.ax1.axhline(y=lower[1], color='green', linestyle='--')
-        
-        #plot plasma voltage
-        color = 'tab:blue'
-        self.canvas.ax2.set_ylabel('Plasma Voltage', color = color) 
-        self.canvas.ax2.plot(time, plasmaV, color = color) 
-        self.canvas.ax2.yaxis.set_label_position("right")
-        #self.canvas.ax2.tick_params(axis ='y', labelcolor = color) 
-
-        self.canvas.draw()
 
-        return
+        with Tracing.span("plot", "gui"):
+            if not self.update_plot(frame):
+                self.frame_ring.skip()
+        message = "Frames received: %d  shown: %d  dropped: %d" % (
+            self.frame_ring.pushed, self.frame_ring.shown, self.frame_ring.dropped)
+        if self.plasma_interface.frames_dropped:
+            #Streamed frames the log task did not take off the receive queue in time
+            message += "  not received: %d" % self.plasma_interface.frames_dropped
+        if self.data_log is not None:
+            message += "  log queue: %d/%d  not logged: %d" % (
+                self.data_log.depth, self.data_log.capacity, self.data_log.dropped)
+        self.statusbar.showMessage(message)
+
+    """Shows the link statistics in the status bar, and writes them to link_stats_path if one was given"""
+    def update_link_stats(self):
+        self.link_stats_label.setText(self.plasma_interface.link_stats.summary())
+        if self.link_stats_path:
+            try:
+                self.plasma_interface.write_link_stats(self.link_stats_path)
+            except OSError as e:
+                self.link_stats_path = None
+                self.show_warning_popup("Could not write the link statistics: " + str(e))
+
+    """Shows the resonance estimated from the streamed frames, the frequency the plasma should be driven at"""
+    def update_resonance(self):
+        if self.resonance is not None:
+            self.resonance_label.setText(self.resonance.summary())
+
+    """Updates the plot displaying the system parameters from a parsed LogFrame.
+    The canvas drops updates beyond its frame rate cap, so this returns quickly when rendering is behind.
+    Returns False if the frame was not drawn"""
+    def update_plot(self, frame):
+        upper = None
+        lower = None
+        if self.auto_freq_adjust_enabled and len(frame) > 1:
+            upper = frame.upper[1]
+            lower = frame.lower[1]
+
+        return self.canvas.update_traces(frame.relative_time, frame.bridge_i, frame.plasma_v, upper, lower)
 
     
 
@@ -170,75 +261,84 @@ class GUILogic(QMainWindow, Ui_MainWindow):
     is active. The function continuously polls the serial buffer for data to log, checks supply voltages,
     and updates the frequency display"""
     def live_plasma_actions(self, datalog_filepath):
-        supply_query_rate = 0.5 #defines how often ADC3 readings are queried in number of read cycles
-        freq_query_rate = .1 #defines how often current freq is queried in number of read cycles
-        logging_rate = 1/1000
+        status_query_rate = .1 #defines how often the status (freq and ADC3 readings) is queried in seconds
+        logging_rate = 10/1000 #how often streamed frames are taken off the receive queue
         
 
         time.sleep(0.1)
 
         if (datalog_filepath == "temp"):
-            file = tempfile.TemporaryFile(mode="w+b")
+            log = CsvLogWriter(tempfile.TemporaryFile(mode="w+b"))
         else:
             try:
-                file = open(datalog_filepath, 'wb')
+                log = open_log_writer(datalog_filepath)
             except:
                 raise IOError
 
-
-        #get header for csv file
-        file.write(self.plasma_interface.query_log_header())
-
-        next_supplies_time = time.time() + supply_query_rate
-        next_freq_time = time.time() + freq_query_rate
-        next_log_time = time.time() + logging_rate
-
-        while not self.stop_event.is_set():
-            current_time = time.time()
-
-            if current_time >= next_supplies_time:
-                next_supplies_time = current_time + supply_query_rate
-                self.update_supply_readout()
-            
-            if current_time >= next_freq_time and self.auto_freq_adjust_enabled:
-                next_freq_time = current_time + freq_query_rate
-                self.update_freq_readout() 
-
-            if current_time >= next_log_time:
-                next_log_time = current_time + logging_rate
-                try:
-                    new_data = self.plasma_interface.query_log_data()
-                    file.write(new_data)
-
-                    self.update_plot(new_data.decode())
-
-                except:
-                    continue
-
-
+        #Disk writes happen on the log writer thread, so a slow disk never delays the next l?
+        log = BackgroundLogWriter(log)
+        self.data_log = log
 
 
+        resonance = None
+        streaming = False
+        try:
+            #Without a log file only the plotted and analyzed columns are requested, which shortens every frame
+            channels = LOG_CHANNELS_ALL if datalog_filepath != "temp" else channel_mask(set(PLOT_COLUMNS + ANALYSIS_COLUMNS))
+            if not self.plasma_interface.set_log_selection(channels).result():
+                channels = LOG_CHANNELS_ALL #firmware without log selection
+            columns = mask_columns(channels)
+
+            #get header for csv file
+            log.write_header(self.plasma_interface.query_log_header().result())
+
+            #Resonance estimates run on their own thread, logged next to a saved log
+            resonance = ResonanceAnalyzer(sidecar_log_path(datalog_filepath, "resonance.csv")
+                                          if datalog_filepath != "temp" else None)
+            self.resonance = resonance
+
+            #The firmware pushes every frame while datalogging is on, so nothing is polled with l?
+            self.plasma_interface.start_streaming().result()
+            streaming = True
+
+            link_stats = self.plasma_interface.link_stats
+            def log_frame(timeout=0):
+                for new_data in self.plasma_interface.stream_frames(timeout):
+                    try:
+                        with Tracing.span("parse", "acquisition", bytes=len(new_data)):
+                            frame = parse_log_frame(new_data, columns)
+                        log.write_frame(new_data, frame)
+
+                        self.frame_ring.push(frame)
+                        resonance.submit(frame)
+
+                    except ValueError:
+                        link_stats.error("bad_frame") #malformed frame, skipped
+                    except Exception as e:
+                        #Counted and reported (once per kind) instead of ending the session with the plasma on
+                        if link_stats.error(type(e).__name__) == 1:
+                            traceback.print_exc()
+
+            #Fixed-rate polls, sleeping until the next one is due. When both are due at once,
+            #ADC1/2 frames go first, then the status
+            self.scheduler = Scheduler(self.stop_event)
+            self.scheduler.add("log", logging_rate, log_frame, priority=0)
+            self.scheduler.add("status", status_query_rate, self.update_status, priority=1,
+                               start_delay=status_query_rate)
+            self.scheduler.run()
+
+        finally:
+            #Also when the loop failed: streaming is turned off, and the log and the analysis are completed
+            if streaming:
+                #Log the frames still on the way, stream_frames() ends once streaming is stopped
+                self.plasma_interface.stop_streaming().result()
+                log_frame(None)
 
-
-                     
-
-            #with self.serial_lock:
-                #data = self.plasma_interface.ser.readline()
-
-            ##ADC1/2 data recieved
-            #if b"log" in data:
-                #data = data[3:]
-                #file.write(data)
-
-            #extract period number
-            #is this line the start of a new period?
-            #if yes, read in all of the matching data points, plot, then continue
-
-            #else, is this line describing adc3 readings? 
-            #then update supply voltage readout
-
-
-        file.close()
+            try:
+                log.close()
+            finally:
+                if resonance is not None:
+                    resonance.close()
     
 
     def handle_strike_plasma(self):
@@ -248,7 +348,7 @@ class GUILogic(QMainWindow, Ui_MainWindow):
 
 
         try:
-            self.plasma_interface.start_plasma()
+            self.plasma_interface.start_plasma().result()
         
         except Exception as e:
             self.handle_plasma_off()
@@ -265,8 +365,13 @@ class GUILogic(QMainWindow, Ui_MainWindow):
         self.stop_event.clear()
         self.plasma_active_event.clear()
 
+        self.frame_ring.clear()
+        self.scheduler = None
+        self.setupCanvases()
         self.logging_thread = threading.Thread(target=self.live_plasma_actions, args=((self.save_location,)), daemon=True)
         self.logging_thread.start()
+        self.plot_timer.start()
+        self.trend_timer.start()
 
         self.led_plasma_status.setStyleSheet("background-color: green; border-radius: 40px;")
         self.label_plasma_status_value.setText("On")
@@ -274,6 +379,9 @@ class GUILogic(QMainWindow, Ui_MainWindow):
     
     def handle_plasma_off(self):
         ## TODO Change system indicators to update on ADC measurment not button press
+        #Queued at safety priority, so it is sent ahead of any pending telemetry polls
+        stopped = self.plasma_interface.stop_plasma()
+
         if self.logging_thread is not None and self.logging_thread.is_alive():
             self.stop_event.set()
             self.plasma_active_event.clear()
@@ -281,8 +389,19 @@ class GUILogic(QMainWindow, Ui_MainWindow):
             time.sleep(0.5)
             self.logging_thread.join()#timeout=3)
             print("hereher")
+
+        self.plot_timer.stop()
+        self.trend_timer.stop()
+        self.update_trend()
+        if self.scheduler is not None and not self.logging_thread.is_alive():
+            #Timing of the session's polls, the acquisition thread has ended
+            message = "Session: " + self.scheduler.summary("; ")
+            if self.plasma_interface.frames_dropped:
+                message = "%d streamed frames dropped, the log task did not keep up. %s" % (
+                    self.plasma_interface.frames_dropped, message)
+            self.statusbar.showMessage(message)
             
-        self.plasma_interface.stop_plasma()
+        stopped.result()
         self.led_plasma_status.setStyleSheet("background-color: red; border-radius: 40px;")
         self.label_plasma_status_value.setText("Off")
 
@@ -301,7 +420,7 @@ class GUILogic(QMainWindow, Ui_MainWindow):
         
         self.manual_voltage_allowed = True
         self.text_entered("V", self.manual_voltage_selection.text())
-        self.plasma_interface.set_voltage(self.manual_voltage_selection.text())
+        self.plasma_interface.set_voltage(self.manual_voltage_selection.text()).result()
     
     def handle_manual_frequency_selection(self):
         try:
@@ -316,7 +435,7 @@ class GUILogic(QMainWindow, Ui_MainWindow):
 
         self.manual_frequency_allowed = True
         self.text_entered("kHz", self.manual_frequency_selection.text())
-        if not self.plasma_interface.set_freq(self.manual_frequency_selection.text()):
+        if not self.plasma_interface.set_freq(self.manual_frequency_selection.text()).result():
             self.handle_power_off()
             self.show_warning_popup("Error writing frequency. Shutting down system")
             
@@ -334,7 +453,7 @@ class GUILogic(QMainWindow, Ui_MainWindow):
                 return
                 
         self.checkbox_toggled("Voltage Auto Control", state)
-        self.plasma_interface.set_auto_voltage(self.enable_auto_frequency_correction.checkState())
+        self.plasma_interface.set_auto_voltage(self.enable_auto_frequency_correction.checkState()).result()
         #clear input box if enabling automatic control
         if not state:
             self.manual_frequency_selection.clear()
@@ -355,7 +474,7 @@ class GUILogic(QMainWindow, Ui_MainWindow):
         self.checkbox_toggled("Frequency Auto Control", state)
 
         #send the command and verify the condition is set within the STM 
-        if self.plasma_interface.set_auto_freq(state) != state: 
+        if self.plasma_interface.set_auto_freq(state).result() != state: 
             self.enable_auto_frequency_correction.setChecked(not state)
             return
 
@@ -366,7 +485,7 @@ class GUILogic(QMainWindow, Ui_MainWindow):
         self.auto_freq_adjust_enabled = state
 
     def handle_data_logging_save(self):
-        file_path, _ = QFileDialog.getSaveFileName(self, "Save File", "", "All Files (*);;Text Files (*.txt);;Python Files (*.py)")
+        file_path, _ = QFileDialog.getSaveFileName(self, "Save File", "", "All Files (*);;CSV Log (*.csv);;Binary Log (*.plog);;Compressed CSV, rotated hourly (*.csv.gz *.csv.zst)")
         
         if file_path:
             self.save_location = file_path
@@ -390,9 +509,13 @@ class GUILogic(QMainWindow, Ui_MainWindow):
         
     """Shuts down plasma and power supplies, leaving system in a known state on exit"""
     def shutdown_system(self):
+        if not self.plasma_interface.initialized:
+            self.plasma_interface.close() #Never connected, nothing to put in a known state
+            return
         self.handle_power_off()
         self.handle_enable_auto_frequency_correction(True)
         self.handle_enable_auto_voltage_correction(False)
+        self.plasma_interface.close()
 
             
     
@@ -0,0 +1,212 @@
+## Instrumentation of the serial link to a controller.
+## PlasmaSerialInterface records every command it sends here: latency, bytes out and in, and
+## whether the reply timed out, grouped by command prefix (l?, p?a, f!, ...), plus every ADC1/2
+## frame received. The counters can be shown live (summary()) or exported as JSON or in the
+## Prometheus text format, e.g. for the node_exporter textfile collector (write()).
+
+import bisect
+import collections
+import json
+import os
+import re
+import threading
+import time
+
+
+#Upper bounds of the latency histogram buckets in seconds. Commands take 1-20 ms with adaptive
+#pacing and ~10 ms per character with fixed pacing; timeouts end up in the last ones
+LATENCY_BUCKETS = (0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0)
+
+#Seconds over which the byte and frame rates are averaged
+RATE_WINDOW = 2.0
+
+#Arguments are stripped from commands to group them: f!42000 -> f!, ls7ff,1 -> ls, l1 -> l.
+#The p? and p! supply commands keep their name (p?3.3, p?hv, p!lv)
+_PREFIX = re.compile(r"p[?!][\w.]+|.[?!a-z]?")
+
+
+def command_prefix(command):
+    match = _PREFIX.match(command)
+    return match.group() if match else command
+
+
+class LatencyHistogram:
+    def __init__(self):
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1) #the last one counts the rest (+Inf)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+        self.timeouts = 0
+        self.bytes_out = 0
+        self.bytes_in = 0
+
+    def add(self, seconds):
+        self.buckets[bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+        self.max = max(self.max, seconds)
+
+    def quantile(self, q):
+        """Estimates the q-quantile by linear interpolation inside its bucket, like Prometheus' histogram_quantile"""
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for i, n in enumerate(self.buckets):
+            if seen + n >= rank and n:
+                if i == len(LATENCY_BUCKETS):
+                    return self.max
+                low = LATENCY_BUCKETS[i - 1] if i else 0.0
+                return low + (LATENCY_BUCKETS[i] - low) * (rank - seen) / n
+            seen += n
+        return self.max
+
+    def to_dict(self):
+        return {"count": self.count, "sum": self.sum, "max": self.max, "timeouts": self.timeouts,
+                "bytes_out": self.bytes_out, "bytes_in": self.bytes_in,
+                "p50": self.quantile(0.5), "p99": self.quantile(0.99),
+                "buckets": dict(zip([str(bound) for bound in LATENCY_BUCKETS] + ["+Inf"], self.buckets))}
+
+
+class LinkStats:
+    """Counters of one serial link. Recorded on the SerialWorker thread and read from any other,
+    so every access takes the lock; recording is a few additions and a bisect."""
+    def __init__(self, clock=time.monotonic):
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.commands = collections.defaultdict(LatencyHistogram)
+        self.bytes_out = 0
+        self.bytes_in = 0
+        self.frames = 0
+        self.frame_bytes = 0
+        self.errors = collections.Counter() #failures outside of commands, by kind
+        self.started = clock()
+        #(time, bytes out, bytes in, frames) of the last RATE_WINDOW seconds, for the rates
+        self._recent = collections.deque()
+
+    def command(self, prefix, seconds, bytes_out, bytes_in, timed_out=False):
+        """Records one command. prefix should come from command_prefix()"""
+        with self.lock:
+            histogram = self.commands[prefix]
+            histogram.add(seconds)
+            histogram.bytes_out += bytes_out
+            histogram.bytes_in += bytes_in
+            if timed_out:
+                histogram.timeouts += 1
+            self._traffic(bytes_out, bytes_in, 0)
+
+    def frame(self, nbytes, polled=False):
+        """Records an ADC1/2 frame. The bytes of polled frames were already counted with their l?"""
+        with self.lock:
+            self.frames += 1
+            self.frame_bytes += nbytes
+            self._traffic(0, 0 if polled else nbytes, 1)
+
+    def error(self, kind):
+        """Counts a failure outside of a command, e.g. a frame that could not be parsed. Returns its count"""
+        with self.lock:
+            self.errors[kind] += 1
+            return self.errors[kind]
+
+    def _traffic(self, bytes_out, bytes_in, frames):
+        now = self.clock()
+        self.bytes_out += bytes_out
+        self.bytes_in += bytes_in
+        self._recent.append((now, bytes_out, bytes_in, frames))
+        while self._recent[0][0] < now - RATE_WINDOW:
+            self._recent.popleft()
+
+    def rates(self):
+        """(bytes out/s, bytes in/s, frames/s) over the last RATE_WINDOW seconds"""
+        with self.lock:
+            now = self.clock()
+            recent = [sample for sample in self._recent if sample[0] >= now - RATE_WINDOW]
+        window = min(RATE_WINDOW, now - self.started) or RATE_WINDOW
+        return tuple(sum(sample[i] for sample in recent) / window for i in (1, 2, 3))
+
+    def snapshot(self, **counters):
+        """All counters as a dict, for JSON. counters adds the interface's own, e.g. frames_lost"""
+        bytes_out_rate, bytes_in_rate, frame_rate = self.rates()
+        with self.lock:
+            return {"uptime": self.clock() - self.started,
+                    "bytes_out": self.bytes_out, "bytes_in": self.bytes_in,
+                    "frames": self.frames, "frame_bytes": self.frame_bytes,
+                    "bytes_out_rate": bytes_out_rate, "bytes_in_rate": bytes_in_rate, "frame_rate": frame_rate,
+                    "errors": dict(self.errors), "counters": counters,
+                    "commands": {prefix: histogram.to_dict() for prefix, histogram in sorted(self.commands.items())}}
+
+    def summary(self, prefix="l?"):
+        """One line for a status bar: rates, latency of prefix (l? by default) and the timeouts"""
+        bytes_out_rate, bytes_in_rate, frame_rate = self.rates()
+        with self.lock:
+            histogram = self.commands.get(prefix)
+            p50 = histogram.quantile(0.5) if histogram else None
+            p99 = histogram.quantile(0.99) if histogram else None
+            timeouts = sum(histogram.timeouts for histogram in self.commands.values())
+            errors = sum(self.errors.values())
+        text = "%.0f frames/s  in %.1f kB/s  out %.2f kB/s" % (frame_rate, bytes_in_rate / 1000, bytes_out_rate / 1000)
+        if p50 is not None:
+            text += "  %s p50 %.1f ms p99 %.1f ms" % (prefix, 1000 * p50, 1000 * p99)
+        text += "  timeouts: %d" % timeouts
+        return text + ("  errors: %d" % errors if errors else "")
+
+    def to_json(self, **counters):
+        return json.dumps(self.snapshot(**counters), indent=1)
+
+    def to_prometheus(self, labels=None, **counters):
+        """Prometheus text exposition format. labels (e.g. {"device": "ttyACM0"}) are added to every sample"""
+        snapshot = self.snapshot(**counters)
+        base = "".join(',%s="%s"' % (name, _escape(value)) for name, value in sorted((labels or {}).items()))
+        lines = []
+
+        def metric(name, kind, help, samples):
+            lines.append("# HELP plasma_%s %s" % (name, help))
+            lines.append("# TYPE plasma_%s %s" % (name, kind))
+            for suffix, sample_labels, value in samples:
+                label_text = (sample_labels + base).lstrip(",")
+                lines.append("plasma_%s%s%s %s" % (name, suffix, "{%s}" % label_text if label_text else "", _number(value)))
+
+        histogram_samples = []
+        for prefix, histogram in snapshot["commands"].items():
+            command = ',command="%s"' % _escape(prefix)
+            cumulative = 0
+            for bound, n in histogram["buckets"].items():
+                cumulative += n
+                histogram_samples.append(("_bucket", command + ',le="%s"' % bound, cumulative))
+            histogram_samples.append(("_sum", command, histogram["sum"]))
+            histogram_samples.append(("_count", command, histogram["count"]))
+        commands = snapshot["commands"].items()
+        metric("command_latency_seconds", "histogram", "Time from sending a command to its complete reply.",
+               histogram_samples)
+        metric("command_timeouts_total", "counter", "Commands whose reply did not arrive in time.",
+               [("", ',command="%s"' % _escape(prefix), histogram["timeouts"]) for prefix, histogram in commands])
+        metric("command_sent_bytes_total", "counter", "Bytes sent per command.",
+               [("", ',command="%s"' % _escape(prefix), histogram["bytes_out"]) for prefix, histogram in commands])
+        metric("command_received_bytes_total", "counter", "Reply bytes received per command.",
+               [("", ',command="%s"' % _escape(prefix), histogram["bytes_in"]) for prefix, histogram in commands])
+        metric("sent_bytes_total", "counter", "Bytes sent to the controller.", [("", "", snapshot["bytes_out"])])
+        metric("received_bytes_total", "counter", "Bytes received from the controller.", [("", "", snapshot["bytes_in"])])
+        metric("frames_total", "counter", "ADC1/2 frames received.", [("", "", snapshot["frames"])])
+        metric("frame_rate", "gauge", "ADC1/2 frames per second over the last %g s." % RATE_WINDOW,
+               [("", "", snapshot["frame_rate"])])
+        metric("errors_total", "counter", "Failures outside of commands, by kind.",
+               [("", ',kind="%s"' % _escape(kind), n) for kind, n in sorted(snapshot["errors"].items())])
+        for name, value in sorted(counters.items()):
+            metric(name + "_total", "counter", name.replace("_", " ").capitalize() + ".", [("", "", value)])
+        return "\n".join(lines) + "\n"
+
+    def write(self, path, labels=None, **counters):
+        """Writes the statistics to path, as JSON if it ends in .json and in the Prometheus text
+        format otherwise. The file is replaced atomically, so a collector never reads half of it"""
+        text = self.to_json(**counters) if path.endswith(".json") else self.to_prometheus(labels, **counters)
+        with open(path + ".tmp", "w") as file:
+            file.write(text)
+        os.replace(path + ".tmp", path)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
@@ -0,0 +1,165 @@
+## Vectorized parser for the ADC1/2 log frames returned by l?
+## One frame is turned into a columnar NumPy array in a single pass, and the derived
+## columns used by the plot are computed once, so the plot and the data logger can
+## share the same parsed result. Binary frames (lb1) are decoded with np.frombuffer.
+
+import numpy as np
+
+from FrameReader import (BINARY_CRC, BINARY_HEADER, BINARY_SAMPLE_FIELDS, LOG_CHANNELS_ALL, binary_sample_size,
+                         check_binary_frame, is_binary_frame)
+
+
+#                  0          1              2             3         4          5         6        7            8           9        10
+#Columns layout: [Time], [Freq (Hz)], [Deadtime (%)], [Bridge I], [VplaL1], [VplaL2], [VbriS1], [VbriS2], [TIM1 status], [upper], [lower]
+LOG_COLUMNS = ("time", "freq", "deadtime", "bridge_i", "vpla_l1", "vpla_l2",
+               "vbri_s1", "vbri_s2", "tim1_status", "upper", "lower")
+assert LOG_CHANNELS_ALL == (1 << len(LOG_COLUMNS)) - 1
+
+#Names print_log_header() (lh) gives the LOG_COLUMNS
+LOG_HEADER_NAMES = ("Time(us)", "Freq (Hz)", "Deadtime (%)", "Bridge I", "VplaL1", "VplaL2",
+                    "VbriS1", "VbriS2", "TIM1 status", "upper freq calc point", "lower freq calc point")
+
+#Cell formats of printHbridgeDatalogging(), used to write binary frames to CSV logs
+CSV_COLUMN_FORMATS = ("%.2f", "%u", "%u", "%f", "%f", "%f", "%f", "%f", " %u", " %f", " %f")
+CSV_ROW_FORMAT = ",".join(CSV_COLUMN_FORMATS)
+
+_binary_dtypes = {}
+
+
+def channel_mask(columns):
+    """Channel mask (ls, l?) selecting the named columns of LOG_COLUMNS"""
+    return sum(1 << LOG_COLUMNS.index(name) for name in columns)
+
+
+def mask_columns(channels):
+    """Names of the columns a channel mask selects, in the order the firmware sends them"""
+    return tuple(name for i, name in enumerate(LOG_COLUMNS) if channels >> i & 1)
+
+
+def columns_from_header(header):
+    """Names of the columns a CSV header line (an lh reply) lists, in its order.
+    Raises ValueError if it names a column the firmware does not log"""
+    if isinstance(header, (bytes, bytearray)):
+        header = header.decode(errors="replace")
+    names = [name.strip() for name in header.strip().split(",")]
+    unknown = [name for name in names if name not in LOG_HEADER_NAMES]
+    if unknown:
+        raise ValueError("Unknown log columns in the header: " + ", ".join(unknown))
+    return tuple(LOG_COLUMNS[LOG_HEADER_NAMES.index(name)] for name in names)
+
+
+def binary_sample_dtype(channels):
+    """Per-sample record of a binary frame with the given channel mask. The other columns
+    are sent once in the frame header"""
+    if channels not in _binary_dtypes:
+        codes = {"f": "<f4", "H": "<u2"}
+        dtype = np.dtype([(LOG_COLUMNS[column], codes[code]) for column, code in BINARY_SAMPLE_FIELDS
+                          if channels >> column & 1])
+        assert dtype.itemsize == binary_sample_size(channels)
+        _binary_dtypes[channels] = dtype
+    return _binary_dtypes[channels]
+
+
+class LogFrame:
+    """One parsed l? reply.
+
+    data holds one contiguous row per column (shape: columns x samples), so
+    frame.column("bridge_i") and the properties below are cheap views.
+    sequence is the frame number sent by the firmware with binary frames, None for text frames.
+    columns can be any subset of LOG_COLUMNS (see the ls log selection). relative_time and
+    plasma_v are None when the columns they are derived from were not selected.
+    """
+    def __init__(self, data, columns=LOG_COLUMNS, sequence=None):
+        self.data = data
+        self.columns = tuple(columns)
+        self.sequence = sequence
+        self._index = {name: i for i, name in enumerate(self.columns)}
+
+        #Time relative to the first sample of the frame
+        self.relative_time = None
+        if "time" in self._index:
+            self.relative_time = self.time - self.time[0] if len(self) else self.time
+        #Differential voltage across the array
+        self.plasma_v = None
+        if "vpla_l1" in self._index and "vpla_l2" in self._index:
+            self.plasma_v = self.column("vpla_l1") - self.column("vpla_l2")
+
+    def __len__(self):
+        return self.data.shape[1]
+
+    def column(self, name):
+        return self.data[self._index[name]]
+
+    @property
+    def time(self):
+        return self.column("time")
+
+    @property
+    def freq(self):
+        return self.column("freq")
+
+    @property
+    def bridge_i(self):
+        return self.column("bridge_i")
+
+    @property
+    def upper(self):
+        return self.column("upper")
+
+    @property
+    def lower(self):
+        return self.column("lower")
+
+    """The frame as the firmware's CSV rows (each followed by \\n\\r), as in a text l? reply"""
+    def to_csv(self):
+        #One formatting call for the whole frame, about twice as fast as np.savetxt
+        row = CSV_ROW_FORMAT if self.columns == LOG_COLUMNS else ",".join(
+            CSV_COLUMN_FORMATS[LOG_COLUMNS.index(name)] for name in self.columns)
+        return ((row + "\n\r") * len(self) % tuple(self.data.T.ravel().tolist())).encode()
+
+
+def parse_log_frame(payload, columns=LOG_COLUMNS):
+    """Parses one l? payload (bytes, bytearray, memoryview or str, without the # terminator)
+    into a LogFrame. Raises ValueError if the payload is not a whole number of rows.
+    columns are the ones in the log selection of a text frame, see mask_columns().
+    Binary frames are recognized by their magic and passed to parse_binary_frame()."""
+    if isinstance(payload, str):
+        payload = payload.encode()
+    if is_binary_frame(payload):
+        return parse_binary_frame(payload)
+
+    #Rows are separated by \n\r, cells by ',' (some with a leading space). Turning the row
+    #separators into cell separators lets NumPy convert the whole frame in one call
+    text = bytes(payload).strip().replace(b"\n\r", b",")
+    if not text:
+        return LogFrame(np.empty((len(columns), 0)), columns)
+
+    values = np.array(text.split(b","), dtype=np.float64)
+    if values.size % len(columns):
+        raise ValueError("Log frame has %d values, not a multiple of %d columns" % (values.size, len(columns)))
+
+    return LogFrame(np.ascontiguousarray(values.reshape(-1, len(columns)).T), columns)
+
+
+def parse_binary_frame(payload):
+    """Decodes one binary frame (header, samples and CRC) into a LogFrame. The samples are read
+    in place with np.frombuffer. Raises ValueError if the frame is truncated or fails its CRC check."""
+    (_, count, sequence, start_time, time_step, freq, deadtime, upper, lower,
+     channels, _) = BINARY_HEADER.unpack_from(payload)
+    dtype = binary_sample_dtype(channels)
+    if len(payload) != BINARY_HEADER.size + count * dtype.itemsize + BINARY_CRC.size:
+        raise ValueError("Binary log frame has %d bytes, its header announces %d samples" % (len(payload), count))
+    check_binary_frame(payload)
+
+    samples = np.frombuffer(payload, dtype, count, BINARY_HEADER.size)
+    header_columns = {"freq": freq, "deadtime": deadtime, "upper": upper, "lower": lower}
+    columns = mask_columns(channels)
+    data = np.empty((len(columns), count))
+    for row, name in enumerate(columns):
+        if name == "time":
+            data[row] = start_time + time_step * np.arange(count)
+        elif name in header_columns:
+            data[row] = header_columns[name]
+        else:
+            data[row] = samples[name]
+    return LogFrame(data, columns, sequence)
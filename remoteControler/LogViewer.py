@@ -0,0 +1,337 @@
+## Offline viewer for recorded data logs.
+## The log is memory-mapped (.plog) or streamed into a temporary .plog (CSV), and the overview
+## of the plotted traces is built, on a background thread while the window shows the progress;
+## afterwards only the rows needed for the current view are ever read. Each redraw is min/max downsampled to the pixel width of the plot; zooming in
+## re-fetches the visible window at full resolution.
+##
+## Usage: python LogViewer.py [log.plog|log.csv]
+##        python main.py --view [log]
+
+import os
+import sys
+import tempfile
+import threading
+
+import numpy as np
+from PySide6.QtCore import QTimer
+from PySide6.QtWidgets import QApplication, QFileDialog, QLabel, QMainWindow, QProgressBar, QVBoxLayout, QWidget
+from matplotlib.backends.backend_qtagg import FigureCanvasQTAgg as FigureCanvas
+from matplotlib.backends.backend_qtagg import NavigationToolbar2QT as NavigationToolbar
+from matplotlib.figure import Figure
+
+from DataLog import BINARY_LOG_EXTENSION, BinaryLogReader, column_dtype, csv_to_binary
+
+
+#Rows summarized by one entry of the overview used for wide views
+OVERVIEW_BLOCK = 1024
+
+#Traces plotted by LogCanvas, their overviews are built while a CSV log is converted
+PLOTTED_TRACES = ("bridge_i", "plasma_v")
+
+
+def minmax_downsample(first_row, values, buckets):
+    """Reduces values (rows first_row...) to the min and max of each of buckets bins.
+    Returns (rows, values) with two points per bin, or the input if it is already small"""
+    if len(values) <= 2 * buckets:
+        return np.arange(first_row, first_row + len(values)), values
+
+    edges = np.unique(np.linspace(0, len(values), buckets + 1).astype(np.int64)[:-1])
+    return _interleave(first_row + edges, np.minimum.reduceat(values, edges), np.maximum.reduceat(values, edges),
+                       np.diff(np.append(edges, len(values))))
+
+
+def _interleave(starts, mins, maxs, widths):
+    rows = np.empty(2 * len(starts))
+    rows[0::2] = starts
+    rows[1::2] = starts + widths / 2
+    values = np.empty(2 * len(starts), dtype=np.result_type(mins, maxs))
+    values[0::2] = mins
+    values[1::2] = maxs
+    return rows, values
+
+
+class _OverviewBuilder:
+    """Per-block (min, max) of a trace fed in pieces of any length"""
+    def __init__(self):
+        self.mins, self.maxs = [], []
+        self._rest = np.empty(0)
+
+    def add(self, values):
+        values = np.concatenate((self._rest, values)) if len(self._rest) else values
+        whole = len(values) - len(values) % OVERVIEW_BLOCK
+        if whole:
+            edges = np.arange(0, whole, OVERVIEW_BLOCK)
+            self.mins.append(np.minimum.reduceat(values[:whole], edges))
+            self.maxs.append(np.maximum.reduceat(values[:whole], edges))
+        self._rest = values[whole:]
+
+    def finish(self):
+        if len(self._rest):
+            self.mins.append(self._rest.min(keepdims=True))
+            self.maxs.append(self._rest.max(keepdims=True))
+        empty = np.empty(0)
+        return (np.concatenate(self.mins) if self.mins else empty, np.concatenate(self.maxs) if self.maxs else empty)
+
+
+class _Cancelled(Exception):
+    pass
+
+
+def _frame_trace(frame, name):
+    """A trace of a LogFrame as LogSource.trace() reads it back from the .plog, in its stored type"""
+    if name == "plasma_v":
+        return _frame_trace(frame, "vpla_l1") - _frame_trace(frame, "vpla_l2")
+    return frame.column(name).astype(column_dtype(name))
+
+
+class LogSource:
+    """Row access to a recorded log for plotting. The overviews of PLOTTED_TRACES are built on a
+    background thread, for CSV logs while converting them to a temporary .plog; progress tells how
+    far it got and loaded is set once the source is usable (or loading failed, see error).
+    The temporary file is removed on close()"""
+    def __init__(self, path):
+        self.path = path
+        self.log = None
+        self.progress = 0.0
+        self.error = None
+        self.loaded = threading.Event()
+        self._temporary = None
+        self._closed = False
+        self._overviews = {}
+
+        if path.lower().endswith(BINARY_LOG_EXTENSION):
+            self.log = BinaryLogReader(path) #reads only the chunk headers
+            load = self._index
+        else:
+            fd, self._temporary = tempfile.mkstemp(suffix=BINARY_LOG_EXTENSION)
+            os.close(fd)
+            load = self._convert
+        self._thread = threading.Thread(target=load, name="LogLoading", daemon=True)
+        self._thread.start()
+
+    def _index(self):
+        builders = {name: _OverviewBuilder() for name in PLOTTED_TRACES if self.has_trace(name)}
+        try:
+            for _, first, rows in self.log.chunks:
+                if self._closed:
+                    return
+                for name, builder in builders.items():
+                    builder.add(self.trace(name, first, first + rows))
+                self.progress = (first + rows) / len(self)
+            self._overviews = {name: builder.finish() for name, builder in builders.items()}
+            self.progress = 1.0
+        except Exception as e:
+            self.error = e
+        finally:
+            self.loaded.set()
+
+    def _convert(self):
+        builders = {name: _OverviewBuilder() for name in PLOTTED_TRACES}
+
+        def on_frame(frame):
+            if self._closed:
+                raise _Cancelled()
+            for name, builder in list(builders.items()):
+                try:
+                    builder.add(_frame_trace(frame, name))
+                except KeyError:
+                    del builders[name] #not in this log
+
+        def progress(fraction):
+            if self._closed:
+                raise _Cancelled()
+            self.progress = fraction
+
+        try:
+            csv_to_binary(self.path, self._temporary, on_frame=on_frame, progress=progress)
+            self._overviews = {name: builder.finish() for name, builder in builders.items()}
+            self.log = BinaryLogReader(self._temporary)
+        except _Cancelled:
+            pass
+        except Exception as e:
+            self.error = e
+        self.loaded.set()
+
+    def __len__(self):
+        return len(self.log)
+
+    """True if the log holds the columns of a trace"""
+    def has_trace(self, name):
+        if name == "plasma_v":
+            return "vpla_l1" in self.log.columns and "vpla_l2" in self.log.columns
+        return name in self.log.columns
+
+    """Rows start:stop of a plotted trace. plasma_v is derived like in LogFrame"""
+    def trace(self, name, start, stop):
+        if name == "plasma_v":
+            return self.log.read("vpla_l1", start, stop) - self.log.read("vpla_l2", start, stop)
+        return self.log.read(name, start, stop)
+
+    """Per-block (min, max) of a trace over the whole log. Those of PLOTTED_TRACES are built while
+    loading, others once a chunk at a time on first use"""
+    def overview(self, name):
+        if name not in self._overviews:
+            mins, maxs = [], []
+            for start in range(0, len(self), OVERVIEW_BLOCK * 256):
+                values = self.trace(name, start, start + OVERVIEW_BLOCK * 256)
+                edges = np.arange(0, len(values), OVERVIEW_BLOCK)
+                mins.append(np.minimum.reduceat(values, edges))
+                maxs.append(np.maximum.reduceat(values, edges))
+            empty = np.empty(0)
+            self._overviews[name] = (np.concatenate(mins) if mins else empty, np.concatenate(maxs) if maxs else empty)
+        return self._overviews[name]
+
+    """Downsampled rows start:stop of a trace, at most about 2*buckets points"""
+    def downsampled(self, name, start, stop, buckets):
+        start, stop = max(0, start), min(len(self), stop)
+        if stop <= start:
+            return np.empty(0), np.empty(0)
+
+        #Wide views come from the overview, so the whole log is never read per redraw
+        if (stop - start) // OVERVIEW_BLOCK > 2 * buckets:
+            mins, maxs = self.overview(name)
+            first, last = start // OVERVIEW_BLOCK, -(-stop // OVERVIEW_BLOCK)
+            mins, maxs = mins[first:last], maxs[first:last]
+            edges = np.unique(np.linspace(0, len(mins), buckets + 1).astype(np.int64)[:-1])
+            widths = np.diff(np.append(edges, len(mins))) * OVERVIEW_BLOCK
+            return _interleave((first + edges) * OVERVIEW_BLOCK, np.minimum.reduceat(mins, edges),
+                               np.maximum.reduceat(maxs, edges), widths)
+
+        return minmax_downsample(start, self.trace(name, start, stop), buckets)
+
+    def close(self):
+        self._closed = True
+        self._thread.join()
+        if self.log is not None:
+            self.log.close()
+        if self._temporary:
+            os.remove(self._temporary)
+
+
+# Plot of a recorded log, laid out like MplCanvas: bridge current on the left axis and
+# plasma voltage on the right, against the sample number
+class LogCanvas(FigureCanvas):
+    def __init__(self, source, parent=None, width=8, height=5, dpi=100):
+        fig = Figure(figsize=(width, height), dpi=dpi)
+        self.ax1 = fig.add_subplot(111)
+        self.ax2 = self.ax1.twinx()
+        super().__init__(fig)
+        self.setParent(parent)
+
+        self.source = source
+        self.fetches = 0
+
+        color = "tab:red"
+        self.ax1.set_xlabel('Sample')
+        self.ax1.set_ylabel('Bridge Current (mA)', color = color)
+        self.current_line, = self.ax1.plot([], [], color = color, linewidth = 0.8)
+
+        color = 'tab:blue'
+        self.ax2.set_ylabel('Plasma Voltage', color = color)
+        self.ax2.yaxis.set_label_position("right")
+        self.voltage_line, = self.ax2.plot([], [], color = color, linewidth = 0.8)
+
+        #Refetching is deferred so a drag or scroll only reads the log once it settles
+        self._refetch_timer = QTimer(self)
+        self._refetch_timer.setSingleShot(True)
+        self._refetch_timer.setInterval(50)
+        self._refetch_timer.timeout.connect(self.refetch)
+        self.ax1.callbacks.connect('xlim_changed', lambda ax: self._refetch_timer.start())
+
+        self.refetch()
+        self._autoscale_y()
+        self.ax1.set_xlim(0, max(len(source) - 1, 1))
+
+    def _autoscale_y(self):
+        for ax, line in ((self.ax1, self.current_line), (self.ax2, self.voltage_line)):
+            values = line.get_ydata()
+            if len(values):
+                low, high = np.min(values), np.max(values)
+                margin = (high - low) * 0.1 or 1
+                ax.set_ylim(low - margin, high + margin)
+
+    """Reads the visible window of the log, downsampled to the plot width in pixels"""
+    def refetch(self):
+        low, high = self.ax1.get_xlim() if self.fetches else (0, len(self.source))
+        start, stop = int(np.floor(low)), int(np.ceil(high)) + 1
+        buckets = max(int(self.ax1.bbox.width), 100)
+
+        for name, line in (("bridge_i", self.current_line), ("plasma_v", self.voltage_line)):
+            if self.source.has_trace(name):
+                line.set_data(*self.source.downsampled(name, start, stop, buckets))
+        self.fetches += 1
+        self.draw_idle()
+
+    def resizeEvent(self, event):
+        super().resizeEvent(event)
+        self._refetch_timer.start()
+
+
+class LogViewer(QMainWindow):
+    def __init__(self, path):
+        super().__init__()
+        self.path = path
+        self.source = LogSource(path)
+        self.canvas = None
+        self.setWindowTitle("Plasma Log Viewer - %s (loading)" % os.path.basename(path))
+        self.resize(1000, 600)
+
+        #Progress of loading the log, replaced by the plot once it is loaded
+        widget = QWidget(self)
+        layout = QVBoxLayout(widget)
+        self.loading_label = QLabel("Loading %s" % os.path.basename(path), widget)
+        self.loading_bar = QProgressBar(widget)
+        self.loading_bar.setRange(0, 1000)
+        layout.addStretch()
+        layout.addWidget(self.loading_label)
+        layout.addWidget(self.loading_bar)
+        layout.addStretch()
+        self.setCentralWidget(widget)
+
+        self.loading_timer = QTimer(self)
+        self.loading_timer.setInterval(100)
+        self.loading_timer.timeout.connect(self.update_loading)
+        self.loading_timer.start()
+        self.update_loading()
+
+    def update_loading(self):
+        self.loading_bar.setValue(int(self.source.progress * 1000))
+        if not self.source.loaded.is_set():
+            return
+        self.loading_timer.stop()
+        if self.source.error is not None:
+            self.setWindowTitle("Plasma Log Viewer - %s" % os.path.basename(self.path))
+            self.loading_label.setText("Could not read %s: %s" % (os.path.basename(self.path), self.source.error))
+            return
+
+        self.setWindowTitle("Plasma Log Viewer - %s (%d samples)" % (os.path.basename(self.path), len(self.source)))
+        self.canvas = LogCanvas(self.source, self)
+        widget = QWidget(self)
+        layout = QVBoxLayout(widget)
+        layout.addWidget(NavigationToolbar(self.canvas, self))
+        layout.addWidget(self.canvas)
+        self.setCentralWidget(widget)
+
+    def closeEvent(self, event):
+        self.loading_timer.stop()
+        self.source.close()
+        super().closeEvent(event)
+
+
+"""Opens the viewer for path, asking for a file if path is None. Returns the window or None"""
+def open_viewer(path=None, parent=None):
+    if path is None:
+        path, _ = QFileDialog.getOpenFileName(parent, "Open Log", "", "Logs (*.plog *.csv *.csv.gz *.csv.zst);;All Files (*)")
+        if not path:
+            return None
+    viewer = LogViewer(path)
+    viewer.show()
+    return viewer
+
+
+if __name__ == "__main__":
+    app = QApplication(sys.argv)
+    window = open_viewer(sys.argv[1] if len(sys.argv) > 1 else None)
+    if window is None:
+        sys.exit(0)
+    sys.exit(app.exec())
@@ -1,55 +1,302 @@
-import threading
+import collections
+import queue
 import serial
 import time
 
 import PlasmaException
+import Tracing
+from FrameReader import LOG_CHANNELS_ALL, FrameReader, StreamReader, check_binary_frame, is_binary_frame
+from LinkStats import LinkStats, command_prefix
+from SerialWorker import SerialWorker, command, PRIORITY_SAFETY, PRIORITY_CONTROL, PRIORITY_TELEMETRY
+
+#Delay between characters used by the "fixed" pacing mode, and the upper limit for "adaptive" pacing
+FIXED_CHAR_DELAY = 10/1000
+
+#Candidate delays of "adaptive" pacing, shortest first. Calibration steps down from the longest.
+#The firmware takes characters into a 10 byte buffer without FIFO or UART error callback, an
+#overrun silently ends reception, so the delay never goes down to 0
+PACING_DELAYS = (0.1/1000, 0.5/1000, 1/1000, 2/1000, 5/1000, FIXED_CHAR_DELAY)
+
+#Log channel masks selected by the calibration probes. Every hex digit is nonzero and they differ
+#in their number of channels, so a dropped character shows up in the header read back
+PACING_PROBE_MASKS = (0x5a5, 0x3b6, 0x6d9)
+
+#Streamed frames held for stream_frames() before the oldest are dropped
+STREAM_QUEUE_FRAMES = 256
+
+#Longest the worker reads the stream before looking for queued commands again
+STREAM_POLL_INTERVAL = 5/1000
+
+#Largest decimation the firmware accepts (ADC12_MAX_GROUP)
+MAX_LOG_DECIMATION = 100
+
+#Reply to S?, see print_status_rc() in the firmware. Supply voltages are in mV, frequency in Hz
+PlasmaStatus = collections.namedtuple("PlasmaStatus", (
+    "supply_3_3", "supply_15", "supply_hv",
+    "voltage_3_3", "voltage_15", "voltage_hv",
+    "frequency", "deadtime", "plasma_on", "auto_freq", "auto_voltage", "logging"))
+
+
+def pacing_probe(attempt):
+    """The calibration probe of an attempt: an ls command as long as the longest the host sends
+    (9 characters, the receive buffer holds 9 and the terminator) and the number of columns lh
+    has to report afterwards"""
+    mask = PACING_PROBE_MASKS[attempt % len(PACING_PROBE_MASKS)]
+    return "ls%03x,%u" % (mask, MAX_LOG_DECIMATION), bin(mask).count("1")
+
+
+def pacing_probe_passed(reply, header, columns):
+    """True if the firmware accepted a pacing_probe() and its lh header has the selected columns"""
+    return reply.strip() == b"ok" and len(header.strip().split(b",")) == columns
+
+
+def parse_status(reply):
+    """Parses an S? reply into a PlasmaStatus. Raises PlasmaException if it is malformed"""
+    fields = reply.strip().split(b",")
+    if fields[0] != b"S" or len(fields) != len(PlasmaStatus._fields) + 1:
+        raise PlasmaException.PlasmaException("Invalid status reply: " + repr(reply))
+    try:
+        values = [int(field) for field in fields[1:]]
+    except ValueError:
+        raise PlasmaException.PlasmaException("Invalid status reply: " + repr(reply))
+
+    flags = ("supply_3_3", "supply_15", "supply_hv", "plasma_on", "auto_freq", "auto_voltage", "logging")
+    return PlasmaStatus(*(bool(value) if name in flags else value
+                          for name, value in zip(PlasmaStatus._fields, values)))
 
 class PlasmaSerialInterface:
-    def __init__(self, serialPort, serial_lock, plasma_active_event):
+    """All serial I/O runs on a dedicated SerialWorker thread that owns self.ser. Public queries and
+    commands are queued to it and return a concurrent.futures.Future; call .result() to wait for the
+    reply. Safety commands (stop_plasma, system_shutdown) are served ahead of telemetry polls.
+
+    pacing selects how characters are spaced when sending a command:
+        "fixed"     sleep FIXED_CHAR_DELAY after every character
+        "adaptive"  wait for the echo of each character if the firmware echoes input, otherwise
+                    use the shortest delay the firmware was measured to accept in calibrate_pacing()
+
+    binary_frames requests the binary ADC1/2 frame format (lb1) in initialize(). Firmware that does
+    not know it keeps sending text frames; binary_log tells which format is in use. Binary frames
+    are checked here: failed CRCs are counted in frames_corrupt and dropped, gaps in their sequence
+    numbers are counted in frames_lost.
+
+    log_channels and log_decimation hold the log selection (see set_log_selection()): the columns
+    sent in each frame as a mask over LogFrame.LOG_COLUMNS, and the sample decimation. Text frames
+    are parsed with LogFrame.mask_columns(log_channels); binary frames carry their selection.
+
+    link_stats (LinkStats) records the latency, timeouts and bytes of every command by prefix,
+    and the frames received; see write_link_stats() to export them.
+    """
+    def __init__(self, serialPort, plasma_active_event, pacing="adaptive", binary_frames=True):
         self.serial_port = serialPort
         self.initialized = False
         self.baud_rate = 6875000
         self.timeout = 0.1
-        self.serial_lock = serial_lock
+        self.log_timeout = 0.5
         self.plasma_active_event = plasma_active_event
+        self.pacing = pacing
+        self.char_delay = FIXED_CHAR_DELAY
+        self.echo = False
+        self.ser = None
+        self.frame_reader = None
+
+        self.binary_frames = binary_frames
+        self.binary_log = False
+        self.frames_corrupt = 0
+        self.frames_lost = 0
+        self._last_sequence = None
+        self.log_channels = LOG_CHANNELS_ALL
+        self.log_decimation = 1
+
+        #Push-mode telemetry, see start_streaming()
+        self.streaming = False
+        self.stream_reader = None
+        self.frames_dropped = 0
+        self._frames = queue.Queue(maxsize=STREAM_QUEUE_FRAMES)
+
+        self.link_stats = LinkStats()
+
+        self.worker = SerialWorker(name="PlasmaSerialWorker " + str(serialPort))
+        self.worker.start()
 
 
     """The microcontroller does not have a uart buffer. 
-    Must send each char with a slight delay to allow stm to process the command
+    Must send each char with a slight delay to allow stm to process the command.
+    Set expect_reply to False for commands the firmware does not answer, so an empty
+    reply is not taken as a sign of lost characters.
+    Runs on the worker thread only.
     """
-    def _send(self, data):
-        self.ser.reset_input_buffer()
-        with self.serial_lock:
-            for char in data:
-                self.ser.write(char.encode())
-                time.sleep(10/1000)
-            #self.ser.write(data.encode() + b"\r")
-            self.ser.write(b"\r")
-            return self.ser.readline()
+    def _send(self, data, expect_reply=True):
+        prefix = command_prefix(data)
+        start = time.perf_counter()
+        with Tracing.span(prefix, "serial", command=data):
+            if self.streaming:
+                #The input holds streamed frames, so it is not flushed and the reply is picked out of it
+                self._write_paced(data)
+                reply = self.stream_reader.read_reply(self.timeout, self._stream_frame) if expect_reply else b""
+            else:
+                self.ser.reset_input_buffer()
+                self._write_paced(data)
+                reply = self.ser.readline()
+
+        timed_out = expect_reply and not reply
+        self.link_stats.command(prefix, time.perf_counter() - start, len(data) + 1, len(reply), timed_out)
+        if timed_out:
+            self._pacing_failed()
+        return reply
+
+
+    """Writes data followed by a carriage return, pacing each character according to the pacing mode.
+    Runs on the worker thread only.
+    """
+    def _write_paced(self, data):
+        for char in data:
+            self.ser.write(char.encode())
+
+            if self.echo:
+                if self.ser.read(1) == char.encode():
+                    continue
+                #Echo did not arrive, fall back to timed pacing
+                self.echo = False
+
+            if self.char_delay:
+                time.sleep(self.char_delay)
+        self.ser.write(b"\r")
 
 
+    """An expected reply never arrived. In adaptive mode move to the next longer character delay,
+    ending up at fixed pacing if the firmware keeps dropping characters.
+    """
+    def _pacing_failed(self):
+        if self.pacing != "adaptive":
+            return
+        for delay in PACING_DELAYS:
+            if delay > self.char_delay:
+                self.char_delay = delay
+                return
+
+
+    @command(PRIORITY_CONTROL)
+    def calibrate_pacing(self, attempts=3):
+        """Measures how fast the firmware accepts characters. First checks whether the firmware echoes
+        input, then steps down from FIXED_CHAR_DELAY through PACING_DELAYS while a full length log
+        selection (see pacing_probe()) is applied correctly attempts times in a row, as read back
+        with lh. Stepping stops at the first failure, so at most one delay that is too short is ever
+        sent; the delay one step above the shortest that passed is kept as a safety margin, and the
+        log selection is restored afterwards. Firmware without ls is calibrated with lh alone.
+        Returns the selected character delay in seconds."""
+        if self.pacing != "adaptive":
+            self.char_delay = FIXED_CHAR_DELAY
+            self.echo = False
+            return self.char_delay
+
+        self.ser.reset_input_buffer()
+        self.ser.write(b"l")
+        self.echo = self.ser.read(1) == b"l"
+        time.sleep(FIXED_CHAR_DELAY)
+        self.ser.write(b"h")
+        if self.echo:
+            self.ser.read(1)
+        time.sleep(FIXED_CHAR_DELAY)
+        self.ser.write(b"\r")
+        self.ser.readline()
+
+        if self.echo:
+            self.char_delay = 0
+            return self.char_delay
+
+        #Each command goes out at least a character delay after the previous one ended, since the
+        #replies arrive faster than that
+        def probe(attempt, legacy=False):
+            time.sleep(self.char_delay)
+            self.ser.reset_input_buffer()
+            if legacy:
+                self._write_paced("lh")
+                return self.ser.readline().startswith(b"Time")
+            data, columns = pacing_probe(attempt)
+            self._write_paced(data)
+            reply = self.ser.read(2) #ok or fa(il), without a line end
+            time.sleep(self.char_delay)
+            self.ser.reset_input_buffer()
+            self._write_paced("lh")
+            return pacing_probe_passed(reply, self.ser.readline(), columns)
+
+        #Firmware without ls fails the probe even at the fixed delay
+        self.char_delay = FIXED_CHAR_DELAY
+        legacy = not probe(0)
+
+        try:
+            shortest = len(PACING_DELAYS) #index of the shortest delay that passed
+            failed = False
+            for i in reversed(range(len(PACING_DELAYS))):
+                self.char_delay = PACING_DELAYS[i]
+                if not all(probe(attempt, legacy) for attempt in range(attempts)):
+                    failed = True
+                    break
+                shortest = i
+
+            self.char_delay = PACING_DELAYS[min(shortest + 1, len(PACING_DELAYS) - 1)]
+            if failed:
+                #End the command the lost characters left half received (an empty command does
+                #nothing), then make sure the board still answers at the delay kept
+                time.sleep(FIXED_CHAR_DELAY)
+                self.ser.write(b"\r")
+                if not probe(0, legacy):
+                    self.char_delay = FIXED_CHAR_DELAY
+            return self.char_delay
+        finally:
+            if not legacy:
+                time.sleep(self.char_delay)
+                self.ser.reset_input_buffer()
+                self._write_paced("ls" + self._log_selection(self.log_channels, self.log_decimation))
+                self.ser.read(2)
+
+
+    @command(PRIORITY_CONTROL)
     def initialize(self):
         """Initializes communication with the microcontroller. Returns True if 
-        device is connected, False otherwise"""
-        self.ser = serial.Serial(self.serial_port, self.baud_rate, timeout=self.timeout)
+        device is connected, False otherwise.
+        Without a serial port the first board found by PortDiscovery is used"""
+        if self.serial_port is None:
+            from PortDiscovery import find_board
+            self.serial_port = find_board()
+            if self.serial_port is None:
+                return False
+        #Exclusive so PortDiscovery probes (and a second instance) leave an open session alone
+        self.ser = serial.Serial(self.serial_port, self.baud_rate, timeout=self.timeout, exclusive=True)
         self.ser.reset_input_buffer()
+        self.frame_reader = FrameReader(self.ser)
+        self.stream_reader = StreamReader(self.ser)
 
         data = self._send("~")
 
         if not data:
             return False
+        #~ also resets the log selection
+        self.log_channels = LOG_CHANNELS_ALL
+        self.log_decimation = 1
+
+        self.calibrate_pacing()
         
         #put system in known state
         self.set_auto_freq(True)
         self.set_auto_voltage(False)
         self.set_datalogging(False)
+        self.set_binary_log(self.binary_frames)
         
         self.initialized = True
         return True
+
+
+    """Stops the worker thread after the commands already queued and closes the port"""
+    def close(self):
+        self.worker.stop()
+        if self.ser is not None:
+            self.ser.close()
     
 
     """Queries whether the 3.3V supply is active
     returns True is active, False otherwise"""
+    @command(PRIORITY_CONTROL)
     def query_3_3_supply(self):
 
         reply = self._send("p?3.3")
@@ -61,6 +308,7 @@ class PlasmaSerialInterface:
 
     """Queries whether the 15V supply is active
     returns True is active, False otherwise"""
+    @command(PRIORITY_CONTROL)
     def query_15_supply(self):
 
         reply = self._send("p?15")
@@ -72,6 +320,7 @@ class PlasmaSerialInterface:
 
     """Queries whether the high voltage supply is active
     returns True is active, False otherwise"""
+    @command(PRIORITY_CONTROL)
     def query_hv_supply(self):
 
         reply = self._send("p?hv")
@@ -83,6 +332,7 @@ class PlasmaSerialInterface:
 
     """Toggles the low voltage (15v and 3.3V supplies)
     returns True if supplies are turrned on, False otherwise"""
+    @command(PRIORITY_CONTROL)
     def toggle_low_voltage(self):
         
         reply = self._send("p!lv")
@@ -95,6 +345,7 @@ class PlasmaSerialInterface:
 
     """Toggles the high voltage (500V supply)
     returns True if supply are turrned on, False otherwise"""
+    @command(PRIORITY_CONTROL)
     def toggle_high_voltage(self):
         reply = self._send("p!hv")
 
@@ -107,6 +358,7 @@ class PlasmaSerialInterface:
     """Sets the frequency based on a input in kHz
     returns True if freq was set, False otherwise
     """
+    @command(PRIORITY_CONTROL)
     def set_freq(self, freq):
 
         reply = self._send("f!"+str(round(float(freq)*1000)))
@@ -120,18 +372,22 @@ class PlasmaSerialInterface:
     """Queries the current frequency. Returns answer in Hz as 
     a str
     """
+    @command(PRIORITY_TELEMETRY)
     def query_freq(self):
         return self._send("f?").decode()
 
 
 
     """Sets voltage setpoint"""
+    @command(PRIORITY_CONTROL)
     def set_voltage(self, voltage):
         self._send("v!".encode + voltage.encode())
 
+    @command(PRIORITY_CONTROL)
     def query_voltage(self):
         return self._send("v?").decode()
     
+    @command(PRIORITY_CONTROL)
     def set_auto_freq(self, new_setting):
         send_flag = 0
 
@@ -145,6 +401,7 @@ class PlasmaSerialInterface:
         elif reply.strip() == b"0":
             return False
     
+    @command(PRIORITY_CONTROL)
     def set_auto_voltage(self, new_setting):
         send_flag = 0
 
@@ -154,6 +411,7 @@ class PlasmaSerialInterface:
         self._send("mv"+str(send_flag))
         
 
+    @command(PRIORITY_CONTROL)
     def set_datalogging(self, new_setting):
         send_flag = 0
 
@@ -161,55 +419,237 @@ class PlasmaSerialInterface:
             send_flag = 1
 
 
-        self._send("l"+str(send_flag))
+        self._send("l"+str(send_flag), expect_reply=False)
+
+
+    """Selects the binary (True) or text ADC1/2 frame format.
+    Returns True if the firmware confirmed the binary format"""
+    @command(PRIORITY_CONTROL)
+    def set_binary_log(self, new_setting):
+        reply = self._send("lb" + ("1" if new_setting else "0"), expect_reply=False)
+        self.binary_log = reply.strip() == b"1"
+        self._last_sequence = None
+        return self.binary_log
+
+
+    """Validates a log selection and returns it as the argument of ls and l?"""
+    def _log_selection(self, channels, decimation):
+        if not 0 < channels <= LOG_CHANNELS_ALL:
+            raise PlasmaException.PlasmaException("Invalid log channel mask: %#x" % channels)
+        if not 1 <= decimation <= MAX_LOG_DECIMATION:
+            raise PlasmaException.PlasmaException("Log decimation must be 1 to %d" % MAX_LOG_DECIMATION)
+        return "%x,%u" % (channels, decimation)
+
+
+    """Selects the columns (mask over LogFrame.LOG_COLUMNS, see LogFrame.channel_mask()) and the
+    decimation (every n-th sample) of the frames sent from now on, for l? and streaming alike.
+    query_log_header() then describes the selected columns. Returns True if the firmware accepted it"""
+    @command(PRIORITY_CONTROL)
+    def set_log_selection(self, channels=LOG_CHANNELS_ALL, decimation=1):
+        if self._send("ls" + self._log_selection(channels, decimation)).strip() != b"ok":
+            return False
+        self.log_channels = channels
+        self.log_decimation = decimation
+        return True
+
+
+    """Checks a binary frame and counts frames lost before it. Returns the frame, or None if it is corrupted"""
+    def _check_frame(self, frame):
+        if not is_binary_frame(frame):
+            return frame
+        try:
+            sequence = check_binary_frame(frame)
+        except ValueError:
+            self.frames_corrupt += 1
+            return None
+
+        if self._last_sequence is not None:
+            self.frames_lost += (sequence - self._last_sequence - 1) & 0xFFFFFFFF
+        self._last_sequence = sequence
+        return frame
 
 
     """Queries the microcontroller for the csv log header
     describing the logged parameters
     """
+    @command(PRIORITY_CONTROL)
     def query_log_header(self):
         return self._send("lh")
 
 
-    """Queries the microcontroller for the newest available ADC1/2 data
+    """Queries the microcontroller for the newest available ADC1/2 data.
+    The frame is read zero-copy by FrameReader and copied once here, since the
+    result is handed to another thread through the Future.
+    channels and decimation change the log selection (see set_log_selection()) with the same
+    command, when they differ from the current one.
     """
-    def query_log_data(self):
+    @command(PRIORITY_TELEMETRY)
+    def query_log_data(self, channels=None, decimation=None):
+        if self.streaming:
+            raise PlasmaException.PlasmaException("Log data is being streamed, use stream_frames()")
+        channels = self.log_channels if channels is None else channels
+        decimation = self.log_decimation if decimation is None else decimation
+        request = "l?"
+        if (channels, decimation) != (self.log_channels, self.log_decimation):
+            request += self._log_selection(channels, decimation)
+
+        start = time.perf_counter()
         self.ser.reset_input_buffer()
-        with self.serial_lock:
-            for char in "l?":
-                self.ser.write(char.encode())
-                time.sleep(10/1000)
-            #self.ser.write(data.encode() + b"\r")
-            self.ser.write(b"\r")
-            response = b""
-            start_time = time.time()
-            timeout = 0.5  # seconds
-
-            while True:
-                if self.ser.in_waiting > 0:
-                    response += self.ser.read(self.ser.in_waiting)
-                    if b"#" in response:
-                        idx = response.index(b"#")
-                        return bytes(response[:idx])  # exclude terminator
-                if time.time() - start_time > timeout:
-                    raise TimeoutError("No complete response received")
-                time.sleep(0.01)  # Yield CPU
+        self.frame_reader.reset()
+        self._write_paced(request)
+        self.log_channels = channels
+        self.log_decimation = decimation
+
+        try:
+            with Tracing.span("l? frame", "serial", command=request):
+                if self.binary_log:
+                    frame = self.frame_reader.read_binary_frame(self.log_timeout)
+                else:
+                    frame = self.frame_reader.read_frame(self.log_timeout)
+        except TimeoutError:
+            self.link_stats.command("l?", time.perf_counter() - start, len(request) + 1, 0, timed_out=True)
+            self._pacing_failed()
+            raise
+
+        self.link_stats.command("l?", time.perf_counter() - start, len(request) + 1, len(frame))
+        self.link_stats.frame(len(frame), polled=True)
+        frame = self._check_frame(bytes(frame)) # exclude terminator
+        if frame is None:
+            raise PlasmaException.PlasmaException("Log frame failed its CRC check")
+        return frame
+
+
+    @command(PRIORITY_CONTROL)
+    def start_streaming(self):
+        """Turns on datalogging (l1). While the plasma is active the firmware then sends every
+        ADC1/2 frame on its own, which replaces polling with query_log_data(). The worker reads
+        the stream whenever no command is queued, and other commands can still be sent:
+        their replies are separated from the frames. Read the frames with stream_frames()."""
+        if self.streaming:
+            return
+        if self.echo:
+            #Waiting for echoed characters would read streamed data instead
+            raise PlasmaException.PlasmaException("Streaming is not supported by firmware that echoes input")
+
+        while not self._frames.empty():
+            self._frames.get_nowait()
+        self.frames_dropped = 0
+        self._last_sequence = None
+        self.ser.reset_input_buffer()
+        self.stream_reader.reset()
+
+        self.streaming = True
+        self._send("l1", expect_reply=False)
+        self.worker.idle_error = None
+        self.worker.idle = self._poll_stream
+
+
+    @command(PRIORITY_CONTROL)
+    def stop_streaming(self):
+        """Turns off datalogging (l0) and ends the generators returned by stream_frames()
+        once they have yielded the frames that were still on the way"""
+        if not self.streaming:
+            return
+        self.worker.idle = None
+        self._send("l0", expect_reply=False)
+
+        #Read until the frame in progress is complete and the line is quiet
+        deadline = time.monotonic() + self.log_timeout
+        while time.monotonic() < deadline:
+            frames = self.stream_reader.poll(STREAM_POLL_INTERVAL * 4)
+            for frame in frames:
+                self._stream_frame(frame)
+            if not frames and not self.stream_reader.in_frame():
+                break
+
+        self.streaming = False
+        self.stream_reader.reset()
+        self._push_frame(None)
+
+
+    """Yields streamed frames (bytes: text without '$' and '#', or whole binary frames) as they
+    arrive, until stop_streaming().
+    timeout: seconds to wait for the next frame before returning, None waits indefinitely.
+    stream_frames(0) yields the frames already received and returns."""
+    def stream_frames(self, timeout=None):
+        while True:
+            try:
+                frame = self._frames.get(block=timeout != 0, timeout=timeout or None)
+            except queue.Empty:
+                return
+            if frame is None:
+                return
+            yield frame
+
+
+    """Worker idle hook while streaming"""
+    def _poll_stream(self):
+        start = time.perf_counter_ns()
+        frames = self.stream_reader.poll(STREAM_POLL_INTERVAL)
+        tracer = Tracing.tracer()
+        if frames and tracer is not None:
+            #Polls that return nothing are not recorded, they would fill the trace with 5 ms waits
+            tracer.complete("stream poll", "serial", start, time.perf_counter_ns(), {"frames": len(frames)})
+        for frame in frames:
+            self._stream_frame(frame)
+
+
+    def _stream_frame(self, frame):
+        self.link_stats.frame(len(frame))
+        if self._check_frame(frame) is not None:
+            self._push_frame(frame)
+
+
+    """Queues a streamed frame for stream_frames(). When the reader falls behind the oldest
+    frame is dropped, so the newest data is always available to it"""
+    def _push_frame(self, frame):
+        while True:
+            try:
+                self._frames.put_nowait(frame)
+                return
+            except queue.Full:
+                try:
+                    self._frames.get_nowait()
+                    self.frames_dropped += 1
+                except queue.Empty:
+                    pass
+
+
+    """Frame counters kept by the interface itself, exported along with link_stats"""
+    def frame_counters(self):
+        return {"frames_lost": self.frames_lost, "frames_corrupt": self.frames_corrupt,
+                "frames_dropped": self.frames_dropped}
+
+
+    """Writes link_stats and frame_counters() to path, as JSON (.json) or in the Prometheus text format.
+    labels, e.g. {"device": "ttyACM0"}, are added to every Prometheus sample"""
+    def write_link_stats(self, path, labels=None):
+        self.link_stats.write(path, labels, **self.frame_counters())
 
 
     """ Queries the ADC3 to read the current supply voltages
     returns the voltages in the following format: 3.3V, 15V, HVDC
     """
+    @command(PRIORITY_TELEMETRY)
     def query_supply_voltages(self):
-        self.ser.reset_input_buffer()
         return self._send("p?a")
         
 
     """Send the system shutdown command. Stops plasma (if running) shutsdown all supplies"""
+    @command(PRIORITY_SAFETY)
     def system_shutdown(self):
-        self._send("z")
+        self._send("z", expect_reply=False)
+
+
+    """Queries the whole controller state (supplies, supply voltages, frequency, plasma and
+    auto modes) in a single round trip. Returns a PlasmaStatus"""
+    @command(PRIORITY_TELEMETRY)
+    def query_status(self):
+        return parse_status(self._send("S?"))
 
 
     """Query whether plasma is active or not. Returns True if active, False otherwise"""
+    @command(PRIORITY_CONTROL)
     def query_plasma(self):
         return self._send("s?") == "on"
 
@@ -217,22 +657,38 @@ class PlasmaSerialInterface:
 
 
 
+    @command(PRIORITY_CONTROL)
     def start_plasma(self):
         """Activates the plasma depending on the boolean flag parameters"""
-        if not self.query_15_supply() or not self.query_3_3_supply():
+        status = self.query_status()
+        if not status.supply_15 or not status.supply_3_3:
             raise PlasmaException.PlasmaException('Low Voltage Supplies not on!')
 
-        if self.query_plasma():
+        if status.plasma_on:
             raise PlasmaException.PlasmaException('System is already running')
         
         if not self.toggle_high_voltage():
             self.system_shutdown()
             raise PlasmaException.PlasmaException("High voltage in unknown state!")
         
-        self._send("s!")
-
+        self._send("s!", expect_reply=False)
+
+    @command(PRIORITY_CONTROL)
+    def start_session(self, freq=None):
+        """Turns the low voltage supplies on if they are off and starts the plasma. With freq (kHz)
+        auto frequency is turned off and freq is set once the plasma runs: starting it resets the
+        frequency to 45 kHz, so a frequency set before would be lost."""
+        if not self.query_status().supply_15 and not self.toggle_low_voltage():
+            raise PlasmaException.PlasmaException("Low voltage supplies did not turn on")
+        self.start_plasma()
+        if freq is not None:
+            self.set_auto_freq(False)
+            if not self.set_freq(freq):
+                raise PlasmaException.PlasmaException("Frequency %s kHz was not accepted" % freq)
+
+    @command(PRIORITY_SAFETY)
     def stop_plasma(self):
-        self._send("q")
+        self._send("q", expect_reply=False)
 
 
         
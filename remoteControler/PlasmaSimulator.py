@@ -0,0 +1,477 @@
+## Software stand-in for the PlasmaDriver firmware running on the Nucleo-H723ZG.
+## Opens a Linux pseudo-terminal and answers the remote control command set used by
+## PlasmaSerialInterface, so throughput and latency changes can be measured without
+## a bench and live high voltage.
+##
+## Usage: python PlasmaSimulator.py [--resonance 42000] [--latency 0.0005]
+## then point PlasmaSerialInterface (or the GUI) at the printed port.
+
+import argparse
+import math
+import os
+import pty
+import select
+import struct
+import threading
+import time
+import tty
+import zlib
+
+
+#Log columns of print_log_header() and their cell formats in printHbridgeDatalogging().
+#Bit n of the log selection (ls, l?) selects column n
+LOG_HEADER_NAMES = (b"Time(us)", b"Freq (Hz)", b"Deadtime (%)", b"Bridge I", b"VplaL1", b"VplaL2",
+                    b"VbriS1", b"VbriS2", b"TIM1 status", b"upper freq calc point", b" lower freq calc point")
+LOG_CELL_FORMATS = (b"%.2f", b"%u", b"%u", b"%f", b"%f", b"%f", b"%f", b"%f", b" %u", b" %f", b" %f")
+LOG_CHANNELS_ALL = 0x7FF
+
+#Binary frame layout of printHbridgeDataloggingBinary(), see FrameReader.py
+BINARY_MAGIC = b"\xa5\x5a"
+BINARY_HEADER = struct.Struct("<2sHIddIIffHH")
+BINARY_SAMPLE_FORMATS = ((3, "f"), (4, "f"), (5, "f"), (6, "f"), (7, "f"), (8, "H")) #(column, format)
+
+RX_BUFFER_SIZE = 10 #Same command buffer size as the firmware (RX_BUFFER_SIZE)
+ADC12_MAX_GROUP = 100
+ADC12_GROUP_READTIME = 1.0E-6
+MIN_FREQUENCY = 15000
+MAX_AUTO_FREQUENCY = 46000 #adjust_plasma clamps the auto frequency loop here
+
+
+class PlasmaSimulator:
+    """Emulates the remoteControl() state machine of PlasmaDriver.c on a pty.
+
+    Replies are byte-for-byte what the firmware prints (including the missing line
+    terminators on short replies), so host side timing matches the real board.
+
+    resonance       resonant frequency of the simulated load (Hz)
+    q_factor        quality factor of the simulated load
+    latency         delay between a complete command and its reply (s)
+    cycle_time      duration of one adjust_plasma() cycle while the plasma is active (s).
+                    l? is answered at the end of the next cycle.
+    baud_rate       used to throttle writes to the speed of the real UART. None disables throttling
+    char_gap        bytes arriving closer than this to the previous byte are dropped,
+                    modelling a receiver without a FIFO (s)
+    noise           relative amplitude of the noise added to the ADC1/2 channels
+    echo            echo every accepted command character (not the terminating carriage return)
+
+    d! and v! mirror the firmware's broken setters rather than what they were meant to do: d!
+    is ignored (the firmware sums atoi() of single chars into an uninitialized variable) and v!
+    leaves the simulator unresponsive (the firmware's parse loop never advances), see hung.
+    """
+
+    def __init__(self, resonance=42000, q_factor=8, latency=0.0005, cycle_time=0.0002,
+                 baud_rate=6875000, char_gap=0, noise=0.01, echo=False):
+        self.resonance = resonance
+        self.q_factor = q_factor
+        self.latency = latency
+        self.cycle_time = cycle_time
+        self.baud_rate = baud_rate
+        self.char_gap = char_gap
+        self.noise = noise
+        self.echo = echo
+
+        self.port = None
+        self._master = None
+        self._slave = None
+        self._thread = None
+        self._stop_event = threading.Event()
+
+        #counters used when benchmarking the host
+        self.commands_received = 0
+        self.frames_sent = 0
+        self.bytes_sent = 0
+        self.bytes_dropped = 0
+
+        #Set by v!: like the board stuck in its parse loop, no further input is handled and
+        #nothing is sent, not even the frames of a running plasma
+        self.hung = False
+
+        self._reset_state()
+
+    def _reset_state(self):
+        #supply_struct
+        self.s3_3V = 0
+        self.s15V = 0
+        self.sHV = 0
+
+        #sHbridge
+        self.hbridge_on = 0
+        self.frequency = 30000
+        self.deadtime = 35
+
+        #rc_state
+        self.remote = False
+        self.state = "IDLE"
+        self.logging = 0
+        self.auto_freq = 1
+        self.auto_voltage = 1
+        self.print_log = 0
+        self.binary_log = 0
+        self.voltage = -1
+        self._sequence = 0
+
+        #sLogSelection
+        self.log_channels = LOG_CHANNELS_ALL
+        self.log_decimation = 1
+
+        self._command_buffer = bytearray()
+        self._last_byte_time = 0
+        self._timer_us = 0.0
+
+    ## Lifecycle
+
+    def start(self):
+        """Opens the pty and starts serving it. Returns the name of the slave device"""
+        self._master, self._slave = pty.openpty()
+        tty.setraw(self._slave)
+        self.port = os.ttyname(self._slave)
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self.port
+
+    def stop(self):
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        for fd in (self._master, self._slave):
+            if fd is not None:
+                os.close(fd)
+        self._master = None
+        self._slave = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    ## Main loop
+
+    def _run(self):
+        next_cycle = time.perf_counter()
+
+        while not self._stop_event.is_set():
+            timeout = 0.05
+            if self.state == "ACTIVE" and not self.hung:
+                timeout = max(0, next_cycle - time.perf_counter())
+
+            ready, _, _ = select.select([self._master], [], [], timeout)
+            if ready:
+                try:
+                    data = os.read(self._master, 4096)
+                except OSError:
+                    #Host closed the port. Wait for it to be reopened
+                    time.sleep(0.01)
+                    continue
+                self._receive(data)
+
+            if self.hung:
+                continue #remoteControl() never gets past the command, nothing is sent anymore
+
+            #Act on current state, like the bottom half of remoteControl()
+            if self.state == "STOP":
+                self._stop_plasma()
+                self.state = "IDLE"
+            elif self.state == "STRIKE":
+                self._start_plasma()
+                self.state = "ACTIVE"
+                next_cycle = time.perf_counter()
+
+            if self.state == "ACTIVE" and time.perf_counter() >= next_cycle:
+                next_cycle += self.cycle_time
+                self._adjust_plasma()
+
+    def _receive(self, data):
+        """Emulates HAL_UART_RxCpltCallback, one byte at a time"""
+        now = time.perf_counter()
+
+        if self.hung:
+            self.bytes_dropped += len(data)
+            return
+
+        for byte in data:
+            if self.char_gap and now - self._last_byte_time < self.char_gap:
+                self.bytes_dropped += 1
+                continue
+            self._last_byte_time = now
+
+            #In the menu a single '~' switches the board into remote control
+            if not self.remote:
+                if byte == ord("~"):
+                    self.remote = True
+                    self._write(b"~")
+                continue
+
+            if byte == ord("\r"):
+                command = bytes(self._command_buffer)
+                self._command_buffer.clear()
+                if self.latency:
+                    time.sleep(self.latency)
+                self._execute(command.decode(errors="replace"))
+            elif len(self._command_buffer) < RX_BUFFER_SIZE - 1:
+                self._command_buffer.append(byte)
+                if self.echo:
+                    self._write(bytes((byte,)))
+            else:
+                #Buffer overflow. Likely recieving garbage
+                self._command_buffer.clear()
+
+    def _write(self, data):
+        if self.baud_rate:
+            #10 bits per byte on the wire (start + 8 data + stop)
+            time.sleep(len(data) * 10 / self.baud_rate)
+        self.bytes_sent += len(data)
+        view = memoryview(data)
+        while view:
+            written = os.write(self._master, view)
+            view = view[written:]
+
+    ## Command handling, mirrors the switch statement in remoteControl()
+
+    def _execute(self, command):
+        self.commands_received += 1
+        if not command:
+            return
+
+        if command[0] == "~":
+            self.log_channels = LOG_CHANNELS_ALL
+            self.log_decimation = 1
+            self._write(b"~")
+
+        elif command[0] == "S":
+            if command[1:2] == "?":
+                self._write(b"S,%u,%u,%u,%u,%u,%u,%u,%u,%u,%u,%u,%u\n\r" % (
+                    (self.s3_3V, self.s15V, self.sHV) + self._supply_voltages() +
+                    (self.frequency, self.deadtime, self.state != "IDLE", self.auto_freq,
+                     self.auto_voltage, self.logging)))
+
+        elif command[0] == "p":
+            supply = command[2:5]
+            if command[1:2] == "?":
+                self._query_supply(supply)
+            elif command[1:2] == "!":
+                self._write(b"on" if self._toggle_supply(supply) else b"off")
+
+        elif command[0] == "s":
+            if command[1:2] == "?":
+                self._write(b"on" if self.state != "IDLE" else b"off")
+            elif command[1:2] == "!":
+                self.state = "STRIKE" if self.state == "IDLE" else "STOP"
+
+        elif command[0] == "d":
+            if command[1:2] == "?":
+                self._write(str(self.deadtime).encode())
+            #d! does not set a usable dead time in the firmware, it is not modelled
+
+        elif command[0] == "v":
+            if command[1:2] == "?":
+                self._write(str(self.voltage).encode())
+            else:
+                #The firmware's setter loops forever on any input
+                self.hung = True
+
+        elif command[0] == "f":
+            if command[1:2] == "?":
+                self._write(str(self.frequency).encode())
+            elif command[1:2] == "!":
+                try:
+                    self.frequency = int(command[2:]) & 0xFFFF #sHbridge.frequency is a uint16_t
+                except ValueError:
+                    self.frequency = 0
+                self._write(b"ok")
+
+        elif command[0] == "l":
+            if command[1:2] == "1":
+                self.logging = 1
+            elif command[1:2] == "0":
+                self.logging = 0
+            elif command[1:2] == "h":
+                self._write(b",".join(name for i, name in enumerate(LOG_HEADER_NAMES)
+                                      if self.log_channels >> i & 1) + b"\n\r")
+            elif command[1:2] == "?":
+                if not command[2:] or self._parse_log_selection(command[2:]):
+                    self.print_log = 1
+                else:
+                    self._write(b"fail")
+            elif command[1:2] == "s":
+                self._write(b"ok" if self._parse_log_selection(command[2:]) else b"fail")
+            elif command[1:2] == "b":
+                self.binary_log = 1 if command[2:3] == "1" else 0
+                self._write(str(self.binary_log).encode())
+
+        elif command[0] == "m":
+            flag = 1 if command[2:3] == "1" else 0
+            if command[1:2] == "f":
+                self.auto_freq = flag
+                self._write(str(flag).encode())
+            elif command[1:2] == "v":
+                self.auto_voltage = flag
+                self._write(str(flag).encode())
+
+        elif command[0] == "q":
+            self.state = "STOP"
+
+        elif command[0] == "z":
+            self._stop_plasma()
+            self.s3_3V = 0
+            self.s15V = 0
+
+    def _parse_log_selection(self, text):
+        """parse_log_selection(): "<hex mask>,<decimation>", returns False if it is not valid"""
+        mask, _, decimation = text.partition(",")
+        try:
+            channels = int(mask, 16)
+            decimation = int(decimation) if decimation else 1
+        except ValueError:
+            return False
+        if not 0 < channels <= LOG_CHANNELS_ALL or not 1 <= decimation <= ADC12_MAX_GROUP:
+            return False
+        self.log_channels, self.log_decimation = channels, decimation
+        return True
+
+    def _query_supply(self, supply):
+        if "15" in supply:
+            self._write(b"on" if self.s15V else b"off")
+        elif "3.3" in supply:
+            self._write(b"on" if self.s3_3V else b"off")
+        elif "hv" in supply:
+            self._write(b"on" if self.sHV else b"off")
+        elif "a" in supply:
+            self._write(b"%7u,%7u,%7u\n\r" % self._supply_voltages())
+
+    def _supply_voltages(self):
+        """ADC3 readings in mV as print_supply_voltages_rc() reports them"""
+        v3_3 = 3300 if self.s3_3V else 0
+        v15 = 15000 if self.s15V else 0
+        vhv = 450000 if self.sHV else 0
+        return tuple(int(v * (1 + self.noise * _noise())) for v in (v3_3, v15, vhv))
+
+    def _toggle_supply(self, supply):
+        if "lv" in supply:
+            if self.s3_3V:
+                self.s3_3V = self.s15V = self.sHV = 0
+                return 0
+            self.s3_3V = self.s15V = 1
+            return 1
+        if "hv" in supply:
+            if self.sHV:
+                self.sHV = 0
+                return 0
+            self.sHV = 1
+            return 1
+        return 0
+
+    def _start_plasma(self):
+        if not self.sHV:
+            self._write(b"fail")
+            return
+        self.deadtime = 1
+        self.frequency = 45000
+        self.hbridge_on = 1
+
+    def _stop_plasma(self):
+        self.hbridge_on = 0
+        self.sHV = 0
+
+    ## Plasma model
+
+    def _adjust_plasma(self):
+        upper, lower = 0, 0
+        if self.auto_freq:
+            #Step part of the way towards resonance, clamped like adjust_plasma()
+            correction = int((self.resonance - self.frequency) * 0.2)
+            self.frequency = max(MIN_FREQUENCY, min(MAX_AUTO_FREQUENCY, self.frequency + correction))
+            upper, lower = self._cursor_values()
+
+        if self.print_log:
+            self.print_log = 0
+            self._write(self._datalogging_frame(upper, lower))
+            self.frames_sent += 1
+        elif self.logging:
+            #Streamed text frames are prefixed with '$', see LOG_STREAMED
+            frame = self._datalogging_frame(upper, lower)
+            self._write(frame if self.binary_log else b"$" + frame)
+            self.frames_sent += 1
+
+    def _response(self):
+        """Amplitude and phase of the bridge current for a series resonant load"""
+        if not self.frequency:
+            return 0, 0
+        detune = self.q_factor * (self.frequency / self.resonance - self.resonance / self.frequency)
+        return 1 / math.sqrt(1 + detune * detune), -math.atan(detune)
+
+    def _cursor_values(self):
+        gain, phase = self._response()
+        amplitude = 20000 * gain
+        return amplitude * math.sin(phase + 0.2), amplitude * math.sin(phase + math.pi - 0.2)
+
+    def _datalogging_frame(self, upper, lower):
+        """Builds one reply in the same format as printHbridgeDatalogging(), or
+        printHbridgeDataloggingBinary() when the binary format is selected"""
+        n_samples = min(ADC12_MAX_GROUP, int((1 / self.frequency) / ADC12_GROUP_READTIME) * 2 + 2)
+        gain, phase = self._response()
+        omega = 2 * math.pi * self.frequency * 1E-6
+        current = 20000 * gain
+        voltage = 400000 * gain
+
+        selected = [i for i in range(len(LOG_HEADER_NAMES)) if self.log_channels >> i & 1]
+        row_format = b",".join(LOG_CELL_FORMATS[i] for i in selected)
+        sample_format = struct.Struct("<" + "".join(code for i, code in BINARY_SAMPLE_FORMATS if i in selected))
+
+        rows = []
+        for i in range(0, n_samples, self.log_decimation):
+            t = self._timer_us + i * ADC12_GROUP_READTIME * 1E6
+            wave = omega * (t - self._timer_us)
+            Is = current * math.sin(wave + phase) * (1 + self.noise * _noise())
+            VplaL1 = 0.5 * voltage * math.sin(wave) * (1 + self.noise * _noise())
+            VplaL2 = -VplaL1
+            VbriS1 = 250000 * (1 + math.copysign(1, math.sin(wave)))
+            VbriS2 = 500000 - VbriS1
+            timer1 = 65535 if math.sin(wave) >= 0 else 0
+            values = (t, self.frequency, self.deadtime, Is, VplaL1, VplaL2, VbriS1, VbriS2, timer1, upper, lower)
+            if self.binary_log:
+                rows.append(sample_format.pack(*(values[i] for i, _ in BINARY_SAMPLE_FORMATS if i in selected)))
+            else:
+                rows.append(row_format % tuple(values[i] for i in selected))
+
+        start_time = self._timer_us
+        self._timer_us += n_samples * ADC12_GROUP_READTIME * 1E6 + self.cycle_time * 1E6
+        if not self.binary_log:
+            return b"\n\r".join(rows) + b"\n\r#"
+
+        frame = BINARY_HEADER.pack(BINARY_MAGIC, len(rows), self._sequence, start_time,
+                                   ADC12_GROUP_READTIME * 1E6 * self.log_decimation, self.frequency, self.deadtime,
+                                   upper, lower, self.log_channels, self.log_decimation) + b"".join(rows)
+        self._sequence = (self._sequence + 1) & 0xFFFFFFFF
+        return frame + struct.pack("<I", zlib.crc32(frame))
+
+
+def _noise():
+    #cheap uniform noise in [-1, 1)
+    return 2 * (int.from_bytes(os.urandom(2), "little") / 65536) - 1
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="PlasmaDriver firmware simulator on a pseudo-terminal")
+    parser.add_argument("--resonance", type=float, default=42000, help="resonant frequency of the load (Hz)")
+    parser.add_argument("--q-factor", type=float, default=8)
+    parser.add_argument("--latency", type=float, default=0.0005, help="command to reply latency (s)")
+    parser.add_argument("--cycle-time", type=float, default=0.0002, help="adjust_plasma() cycle time (s)")
+    parser.add_argument("--baud", type=int, default=6875000, help="UART speed to emulate, 0 for unthrottled")
+    parser.add_argument("--char-gap", type=float, default=0, help="minimum gap between received bytes (s)")
+    parser.add_argument("--noise", type=float, default=0.01)
+    parser.add_argument("--echo", action="store_true", help="echo received command characters")
+    args = parser.parse_args()
+
+    simulator = PlasmaSimulator(args.resonance, args.q_factor, args.latency, args.cycle_time,
+                                args.baud or None, args.char_gap, args.noise, args.echo)
+    print("Simulated PlasmaDriver on " + simulator.start())
+    print("press control+C to exit")
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        simulator.stop()
@@ -0,0 +1,141 @@
+## Matplotlib canvases of the main window: the live plot (MplCanvas) and the trend panel
+## (TrendCanvas). Kept out of plasma_control_GUI so matplotlib is only imported when
+## Ui_MainWindow.setupCanvases() is first called.
+
+from matplotlib.backends.backend_qtagg import FigureCanvasQTAgg as FigureCanvas
+from matplotlib.figure import Figure
+from time import perf_counter
+import numpy as np
+
+# Class for Matplotlib integration
+# The bridge current, plasma voltage and cursor artists are created once and updated in place.
+# Only those artists are redrawn (blitted) over a cached background; the axes are only redrawn
+# in full when the data leaves the current limits or the widget is resized.
+class MplCanvas(FigureCanvas):
+    def __init__(self, parent=None, width=4, height=3, dpi=100, max_fps=30):
+        fig = Figure(figsize=(width, height), dpi=dpi)
+        self.ax1 = fig.add_subplot(111)
+        self.ax2 = self.ax1.twinx()
+        super().__init__(fig)
+        self.setParent(parent)
+
+        self.max_fps = max_fps
+        self.frames_drawn = 0
+        self.frames_skipped = 0
+        self.full_redraws = 0
+        self._last_draw = 0
+        self._background = None
+
+        #plot bridge current
+        color = "tab:red"
+        self.ax1.set_xlabel('Time (us)')
+        self.ax1.set_ylabel('Bridge Current (mA)', color = color)
+        self.current_line, = self.ax1.plot([], [], color = color, animated = True)
+        self.upper_cursor = self.ax1.axhline(y = 0, color = 'green', linestyle = '--', animated = True, visible = False)
+        self.lower_cursor = self.ax1.axhline(y = 0, color = 'green', linestyle = '--', animated = True, visible = False)
+
+        #plot plasma voltage
+        color = 'tab:blue'
+        self.ax2.set_ylabel('Plasma Voltage', color = color)
+        self.ax2.yaxis.set_label_position("right")
+        self.voltage_line, = self.ax2.plot([], [], color = color, animated = True)
+
+        self._artists = (self.current_line, self.upper_cursor, self.lower_cursor, self.voltage_line)
+        self.mpl_connect('draw_event', self._on_draw)
+
+    """Full redraws (limits changed, resize, first show) cache the static background and
+    then draw the animated artists on top of it"""
+    def _on_draw(self, event):
+        self._background = self.copy_from_bbox(self.figure.bbox)
+        self._draw_artists()
+
+    def _draw_artists(self):
+        for artist in self._artists:
+            self.figure.draw_artist(artist)
+
+    """Widens (or shrinks, if the data uses less than a quarter of the range) the limits
+    of an axis. Returns True if they changed"""
+    @staticmethod
+    def _rescale(set_limits, limits, low, high):
+        span = high - low
+        current_span = limits[1] - limits[0]
+        if low >= limits[0] and high <= limits[1] and span > current_span / 4:
+            return False
+
+        margin = span * 0.1 or 1
+        set_limits(low - margin, high + margin)
+        return True
+
+    """Updates the traces with a new frame. upper/lower are the auto frequency cursors,
+    None hides them. Returns False if the update was dropped by the frame rate cap"""
+    def update_traces(self, time, bridge_i, plasma_v, upper=None, lower=None):
+        now = perf_counter()
+        if now - self._last_draw < 1 / self.max_fps:
+            self.frames_skipped += 1
+            return False
+        self._last_draw = now
+
+        self.current_line.set_data(time, bridge_i)
+        self.voltage_line.set_data(time, plasma_v)
+        for cursor, value in ((self.upper_cursor, upper), (self.lower_cursor, lower)):
+            cursor.set_visible(value is not None)
+            if value is not None:
+                cursor.set_ydata([value, value])
+
+        if not len(time):
+            return True
+
+        current_low, current_high = np.min(bridge_i), np.max(bridge_i)
+        if upper is not None:
+            current_low = min(current_low, upper, lower)
+            current_high = max(current_high, upper, lower)
+
+        #Evaluate all three so every axis is updated before redrawing
+        rescaled = [self._rescale(self.ax1.set_xlim, self.ax1.get_xlim(), time[0], time[-1]),
+                    self._rescale(self.ax1.set_ylim, self.ax1.get_ylim(), current_low, current_high),
+                    self._rescale(self.ax2.set_ylim, self.ax2.get_ylim(), np.min(plasma_v), np.max(plasma_v))]
+
+        if self._background is None or any(rescaled):
+            self.full_redraws += 1
+            self.draw()
+        else:
+            self.restore_region(self._background)
+            self._draw_artists()
+            self.blit(self.figure.bbox)
+
+        self.frames_drawn += 1
+        return True
+
+# Trend panel for the TrendHistory levels: a min/max band with the mean on top.
+# Redrawn in full, but only about once a second, so no blitting is needed
+class TrendCanvas(FigureCanvas):
+    def __init__(self, parent=None, width=2, height=2, dpi=50):
+        fig = Figure(figsize=(width, height), dpi=dpi)
+        self.ax = fig.add_subplot(111)
+        super().__init__(fig)
+        self.setParent(parent)
+
+        self.mean_line, = self.ax.plot([], [], color = "tab:blue")
+        self.band = None
+        self.ax.set_xlabel('Time (min)')
+        fig.tight_layout()
+
+    """time, low, mean and high as returned by TrendHistory.snapshot(). Time is shown in
+    minutes relative to the newest point"""
+    def update_trend(self, time, low, mean, high, ylabel):
+        if self.band is not None:
+            self.band.remove()
+            self.band = None
+
+        self.ax.set_ylabel(ylabel)
+        if len(time):
+            minutes = (time - time[-1]) / 60
+            self.mean_line.set_data(minutes, mean)
+            self.band = self.ax.fill_between(minutes, low, high, color = "tab:blue", alpha = 0.25, linewidth = 0)
+            low, high = np.nanmin(low), np.nanmax(high)
+            margin = (high - low) * 0.1 or 1
+            self.ax.set_xlim(min(minutes[0], -1/60), 0)
+            self.ax.set_ylim(low - margin, high + margin)
+        else:
+            self.mean_line.set_data([], [])
+        self.draw_idle()
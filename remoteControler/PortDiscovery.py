@@ -0,0 +1,127 @@
+## Finds PlasmaDriver boards among the serial ports of the host.
+## Candidate ports are probed with the ~ handshake all at once, each on its own thread with a short
+## timeout, so discovery takes about one probe regardless of the number of ports. Boards are
+## remembered by USB serial number in a small JSON cache, so a board that comes back as ttyACM1
+## instead of ttyACM0 is found by trying its last known port first and rediscovering only if that fails.
+##
+## Usage: python PortDiscovery.py [port ...]   probes the given ports, or all candidates, and lists the boards
+
+import collections
+import json
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import serial
+import serial.tools.list_ports
+
+from PlasmaSerialInterface import FIXED_CHAR_DELAY
+
+
+#Seconds to wait for the ~ reply. The firmware answers within a few ms
+PROBE_TIMEOUT = 0.05
+
+BAUD_RATE = 6875000
+
+DEFAULT_CACHE_PATH = os.path.join(os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"),
+                                  "plasmacontrol", "boards.json")
+
+#serial_number is None for ports that do not report one (no USB descriptor)
+Board = collections.namedtuple("Board", ("port", "serial_number", "description"))
+
+
+def candidate_ports():
+    """USB serial ports (the ST-LINK virtual COM port of the Nucleo is one), as serial ListPortInfo"""
+    return [info for info in serial.tools.list_ports.comports() if info.vid is not None]
+
+
+def probe(port, timeout=PROBE_TIMEOUT):
+    """Runs the ~ handshake on port. True if a PlasmaDriver answered.
+    The port is opened exclusively, so a port already in use by a running interface fails the probe
+    instead of having a ~ injected into its session"""
+    try:
+        with serial.Serial(port, BAUD_RATE, timeout=timeout, write_timeout=timeout, exclusive=True) as ser:
+            ser.reset_input_buffer()
+            #Paced like PlasmaSerialInterface before calibration, for firmware that polls its UART
+            ser.write(b"~")
+            time.sleep(FIXED_CHAR_DELAY)
+            ser.write(b"\r")
+            return ser.read(1) == b"~"
+    except (serial.SerialException, OSError):
+        return False #busy, gone, or not a serial device
+
+
+def discover(ports=None, timeout=PROBE_TIMEOUT, cache_path=DEFAULT_CACHE_PATH):
+    """Probes ports (names or ListPortInfo, default candidate_ports()) concurrently.
+    Returns the Boards found, in the order of ports, and records them in the cache"""
+    infos = candidate_ports() if ports is None else [_port_info(port) for port in ports]
+    if not infos:
+        return []
+
+    with ThreadPoolExecutor(max_workers=len(infos), thread_name_prefix="PortProbe") as executor:
+        answered = list(executor.map(lambda info: probe(info.device, timeout), infos))
+
+    boards = [Board(info.device, info.serial_number, info.description)
+              for info, found in zip(infos, answered) if found]
+    if cache_path:
+        _update_cache(cache_path, boards)
+    return boards
+
+
+def find_board(serial_number=None, timeout=PROBE_TIMEOUT, cache_path=DEFAULT_CACHE_PATH):
+    """Returns the port of a board, the one with serial_number if given, or None if none answers.
+    The cached ports are probed first, full discovery only runs if none of them answers"""
+    cache = _read_cache(cache_path) if cache_path else {}
+    present = {info.device: info for info in candidate_ports()}
+    #A cached port that now belongs to another device is not probed
+    known = [present[entry["port"]] for number, entry in cache.items()
+             if serial_number in (None, number) and entry["port"] in present
+             and present[entry["port"]].serial_number == number]
+
+    for ports in ([known] if known else []) + [None]:
+        for board in discover(ports, timeout, cache_path):
+            if serial_number is None or board.serial_number == serial_number:
+                return board.port
+    return None
+
+
+def _port_info(port):
+    if not isinstance(port, str):
+        return port
+    for info in serial.tools.list_ports.comports():
+        if info.device == port:
+            return info
+    return serial.tools.list_ports_common.ListPortInfo(port, skip_link_detection=True)
+
+
+def _read_cache(cache_path):
+    try:
+        with open(cache_path) as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return {}
+
+
+def _update_cache(cache_path, boards):
+    boards = [board for board in boards if board.serial_number]
+    if not boards:
+        return
+    cache = _read_cache(cache_path)
+    for board in boards:
+        cache[board.serial_number] = {"port": board.port, "description": board.description, "last_seen": time.time()}
+    try:
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        with open(cache_path + ".tmp", "w") as file:
+            json.dump(cache, file, indent=1)
+        os.replace(cache_path + ".tmp", cache_path)
+    except OSError:
+        pass #the cache only saves time, discovery works without it
+
+
+if __name__ == "__main__":
+    start = time.perf_counter()
+    boards = discover(sys.argv[1:] or None)
+    for board in boards:
+        print("%s  serial %s  %s" % (board.port, board.serial_number or "-", board.description))
+    print("%d board(s) found in %.3f s" % (len(boards), time.perf_counter() - start), file=sys.stderr)
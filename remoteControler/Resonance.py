@@ -0,0 +1,242 @@
+## Host-side resonance estimation from the ADC1/2 frames.
+## The firmware's auto frequency loop (mf1) only sees the upper/lower current cursors. Here every
+## frame is fitted with the drive frequency and its harmonics (a least-squares DFT at exactly f,
+## 2f, ..., since a frame holds only about two periods and FFT bins would be f/2 wide), giving
+## the phase of the bridge current against the plasma voltage and the harmonic content.
+## For a series resonant load tan(phase) = -Q (f/f0 - f0/f), so the resonant frequency f0 follows
+## from the phase: fitted over the recent frames when they cover a range of frequencies, otherwise
+## from the latest phase with the last fitted (or assumed) Q.
+## The analysis runs on its own thread and is fed without blocking, so it never delays acquisition.
+
+import collections
+import math
+import queue
+import threading
+import time
+
+import numpy as np
+
+import Tracing
+
+
+#Columns the analysis needs, see LogFrame.LOG_COLUMNS
+ANALYSIS_COLUMNS = ("time", "freq", "bridge_i", "vpla_l1", "vpla_l2")
+
+#Harmonics fitted per frame, the fundamental included. Fewer are used when the samples do not allow them
+HARMONICS = 5
+
+#Frames whose phase and frequency are kept for the resonance fit
+HISTORY_FRAMES = 200
+
+#Relative frequency range the history must cover before Q and f0 are fitted from it
+MIN_FIT_SPREAD = 0.005
+
+#Phases closer than this to +-90 degrees are not used, their tangent is dominated by noise
+MAX_FIT_PHASE = math.radians(80)
+
+#Quality factor assumed until the history allows a fit
+DEFAULT_Q = 8
+
+#Frequency range the drive mode keeps the set-point in (Hz), the range the GUI accepts
+MIN_DRIVE_FREQ = 20000
+MAX_DRIVE_FREQ = 65000
+
+#The drive mode only follows frames whose current fit leaves less than this RMS residual,
+#relative to the RMS of the fundamental, and whose current amplitude is at least this fraction
+#of the largest one in the history (a plasma that went out, or a noisy window)
+MAX_DRIVE_FIT_ERROR = 0.2
+MIN_DRIVE_AMPLITUDE = 0.1
+
+#Columns of the sidecar log written next to the data log
+SIDECAR_HEADER = ("time_us,sequence,freq_hz,phase_deg,resonance_hz,q_factor,current_amplitude,voltage_amplitude,fit_error,"
+                  + ",".join("h%d" % k for k in range(2, HARMONICS + 1)))
+
+#Result of one frame. phase is the bridge current against the plasma voltage in radians, positive
+#below resonance (capacitive); harmonics are the current amplitudes of 2f, 3f, ... relative to f;
+#fit_error is the RMS residual of the current fit relative to the RMS of its fundamental
+FrameAnalysis = collections.namedtuple("FrameAnalysis", (
+    "time", "sequence", "freq", "phase", "current_amplitude", "voltage_amplitude", "harmonics", "fit_error"))
+
+#f0 in Hz and Q, with fitted telling whether both came from the history or Q was assumed
+ResonanceEstimate = collections.namedtuple("ResonanceEstimate", ("analysis", "resonance", "q_factor", "fitted"))
+
+
+def analyze_frame(frame, harmonics=HARMONICS):
+    """Fits the bridge current and plasma voltage of a LogFrame with the drive frequency and its
+    harmonics. Returns a FrameAnalysis, or None if the frame lacks the columns or the samples"""
+    if frame.relative_time is None or frame.plasma_v is None or "freq" not in frame.columns \
+            or "bridge_i" not in frame.columns or len(frame) < 4:
+        return None
+    freq = float(frame.freq[0])
+    if freq <= 0:
+        return None
+
+    t = frame.relative_time * 1E-6 #the time column is in us
+    sample_rate = (len(t) - 1) / (t[-1] - t[0]) if t[-1] > t[0] else 0
+    #Stay below Nyquist and keep the fit overdetermined
+    harmonics = min(harmonics, int(sample_rate / 2 / freq), (len(t) - 2) // 2)
+    if harmonics < 1:
+        return None
+
+    wt = 2 * math.pi * freq * np.outer(t, np.arange(1, harmonics + 1))
+    basis = np.hstack((np.ones((len(t), 1)), np.cos(wt), np.sin(wt)))
+    signals = np.column_stack((frame.bridge_i, frame.plasma_v))
+    coefficients = np.linalg.lstsq(basis, signals, rcond=None)[0]
+    #a cos(wt) + b sin(wt) is the real part of (a - jb) e^(jwt)
+    phasors = coefficients[1:harmonics + 1] - 1j * coefficients[harmonics + 1:]
+    current, voltage = phasors[:, 0], phasors[:, 1]
+    if not abs(current[0]) or not abs(voltage[0]):
+        return None
+
+    residual = signals[:, 0] - basis @ coefficients[:, 0]
+    fit_error = float(np.sqrt(np.mean(residual ** 2)) / (abs(current[0]) / math.sqrt(2)))
+    return FrameAnalysis(float(frame.time[0]), frame.sequence, freq, float(np.angle(current[0] / voltage[0])),
+                         float(abs(current[0])), float(abs(voltage[0])), np.abs(current[1:]) / abs(current[0]),
+                         fit_error)
+
+
+def resonance_from_phase(freq, phase, q_factor):
+    """f0 of a series resonant load driven at freq with the given current phase:
+    solves Q (f/f0 - f0/f) = -tan(phase) for f0"""
+    tan = math.tan(phase)
+    x = (tan + math.sqrt(tan * tan + 4 * q_factor * q_factor)) / (2 * q_factor) #f0/f
+    return freq * x
+
+
+def fit_resonance(freqs, phases):
+    """Least-squares fit of tan(phase) = a f + b / f over frames at different frequencies, with
+    a = -Q/f0 and b = Q f0. Returns (f0, Q), or None if the data does not describe a resonance"""
+    freqs = np.asarray(freqs)
+    phases = np.asarray(phases)
+    usable = np.abs(phases) < MAX_FIT_PHASE
+    if usable.sum() < 3:
+        return None
+    freqs, tan = freqs[usable], np.tan(phases[usable])
+    (a, b), *_ = np.linalg.lstsq(np.column_stack((freqs, 1 / freqs)), tan, rcond=None)
+    if a >= 0 or b <= 0:
+        return None
+    return math.sqrt(-b / a), math.sqrt(-a * b)
+
+
+class ResonanceAnalyzer:
+    """Analyzes frames on its own thread. submit() never blocks: frames arriving while the queue
+    is full are dropped and counted. The newest ResonanceEstimate is kept in latest.
+
+    sidecar_path: CSV file receiving one line per analyzed frame (SIDECAR_HEADER)
+    drive:        optional callable taking a frequency in Hz, e.g. a set_freq wrapper. It is called
+                  at most every drive_interval seconds, when the estimate is further than deadband Hz
+                  from the drive frequency, with steps of at most max_step Hz and set-points kept
+                  within min_freq..max_freq. Frames with a poor fit (MAX_DRIVE_FIT_ERROR), a small
+                  current (MIN_DRIVE_AMPLITUDE) or a phase near +-90 degrees are not followed.
+    """
+    def __init__(self, sidecar_path=None, drive=None, q_factor=DEFAULT_Q, max_queue=64,
+                 drive_interval=1.0, deadband=50, max_step=2000, min_freq=MIN_DRIVE_FREQ, max_freq=MAX_DRIVE_FREQ):
+        self.drive = drive
+        self.min_freq = min_freq
+        self.max_freq = max_freq
+        self.drive_interval = drive_interval
+        self.deadband = deadband
+        self.max_step = max_step
+        self.q_factor = q_factor
+        self.fitted = False
+
+        self.latest = None
+        self.analyzed = 0
+        self.dropped = 0
+        self.drive_steps = 0
+        self.drive_skipped = 0 #estimates not followed because the frame was not trustworthy
+        self.error = None #last failure on the analysis thread
+        self._history = collections.deque(maxlen=HISTORY_FRAMES)
+        self._next_drive = 0
+        self._queue = queue.Queue(maxsize=max_queue)
+
+        self.sidecar = None
+        if sidecar_path:
+            self.sidecar = open(sidecar_path, "w")
+            self.sidecar.write(SIDECAR_HEADER + "\n")
+
+        self._thread = threading.Thread(target=self._run, name="ResonanceAnalyzer", daemon=True)
+        self._thread.start()
+
+    def submit(self, frame):
+        try:
+            self._queue.put_nowait(frame)
+        except queue.Full:
+            self.dropped += 1
+
+    def suggestion(self):
+        """The frequency (Hz) the plasma should be driven at according to the latest estimate, or None"""
+        estimate = self.latest
+        return estimate.resonance if estimate is not None else None
+
+    def summary(self):
+        """One line for a status bar"""
+        estimate = self.latest
+        if estimate is None:
+            return "resonance: -"
+        analysis = estimate.analysis
+        thd = math.sqrt(float(np.sum(analysis.harmonics ** 2))) if len(analysis.harmonics) else 0.0
+        return "resonance %.2f kHz (%s Q %.1f)  phase %.1f deg  THD %.1f%%" % (
+            estimate.resonance / 1000, "fitted" if estimate.fitted else "assumed", estimate.q_factor,
+            math.degrees(analysis.phase), 100 * thd)
+
+    def close(self):
+        """Analyzes the frames still queued, stops the thread and closes the sidecar log"""
+        self._queue.put(None)
+        self._thread.join()
+        if self.sidecar is not None:
+            self.sidecar.close()
+
+    def _run(self):
+        last_flush = time.monotonic()
+        while True:
+            frame = self._queue.get()
+            if frame is None:
+                return
+            try:
+                with Tracing.span("resonance", "analysis"):
+                    self._analyze(frame)
+                if self.sidecar is not None and time.monotonic() - last_flush >= 1:
+                    self.sidecar.flush()
+                    last_flush = time.monotonic()
+            except Exception as e:
+                #Keep analyzing, the owner finds the error in self.error
+                self.error = e
+
+    def _analyze(self, frame):
+        analysis = analyze_frame(frame)
+        if analysis is None:
+            return
+        self.analyzed += 1
+        self._history.append((analysis.freq, analysis.phase, analysis.current_amplitude))
+
+        freqs = [freq for freq, _, _ in self._history]
+        if max(freqs) - min(freqs) > MIN_FIT_SPREAD * max(freqs):
+            fit = fit_resonance(freqs, [phase for _, phase, _ in self._history])
+            if fit is not None:
+                self.q_factor = fit[1]
+                self.fitted = True
+        resonance = resonance_from_phase(analysis.freq, analysis.phase, self.q_factor)
+        self.latest = ResonanceEstimate(analysis, resonance, self.q_factor, self.fitted)
+
+        if self.sidecar is not None:
+            self.sidecar.write("%.2f,%s,%.0f,%.3f,%.1f,%.3f,%g,%g,%.4f,%s\n" % (
+                analysis.time, "" if analysis.sequence is None else analysis.sequence, analysis.freq,
+                math.degrees(analysis.phase), resonance, self.q_factor, analysis.current_amplitude,
+                analysis.voltage_amplitude, analysis.fit_error,
+                ",".join(["%.4f" % h for h in analysis.harmonics] + [""] * (HARMONICS - 1 - len(analysis.harmonics)))))
+
+        now = time.monotonic()
+        if self.drive is None or now < self._next_drive or abs(resonance - analysis.freq) <= self.deadband:
+            return
+        largest = max(amplitude for _, _, amplitude in self._history)
+        if analysis.fit_error > MAX_DRIVE_FIT_ERROR or abs(analysis.phase) >= MAX_FIT_PHASE \
+                or analysis.current_amplitude < MIN_DRIVE_AMPLITUDE * largest:
+            self.drive_skipped += 1
+            return
+        step = max(-self.max_step, min(self.max_step, resonance - analysis.freq))
+        setpoint = max(self.min_freq, min(self.max_freq, analysis.freq + step))
+        if setpoint != analysis.freq:
+            self.drive(setpoint)
+            self.drive_steps += 1
+        self._next_drive = now + self.drive_interval
@@ -0,0 +1,111 @@
+## Fixed-rate deadline scheduler for the periodic polls of the acquisition thread.
+## Each task keeps its own deadline grid (start + k*interval), so intervals do not drift with
+## the time spent in other tasks. Tasks that are due together run in priority order, and the
+## thread sleeps on the stop event until the next deadline instead of spinning.
+
+import threading
+import time
+import traceback
+
+import Tracing
+
+
+class ScheduledTask:
+    def __init__(self, name, interval, fn, priority, enabled, deadline):
+        self.name = name
+        self.interval = interval
+        self.fn = fn
+        self.priority = priority
+        self.enabled = enabled
+        self.deadline = deadline
+
+        self.runs = 0
+        self.overruns = 0       #deadlines skipped because the task could not keep up
+        self.total_jitter = 0.0 #sum of (start - deadline) over all runs
+        self.max_jitter = 0.0
+        self.max_duration = 0.0
+        self.errors = 0         #runs that raised
+        self.last_error = None
+
+    def stats(self):
+        return {"interval": self.interval, "runs": self.runs, "overruns": self.overruns, "errors": self.errors,
+                "mean_jitter": self.total_jitter / self.runs if self.runs else 0.0,
+                "max_jitter": self.max_jitter, "max_duration": self.max_duration}
+
+
+class Scheduler:
+    """Runs tasks at fixed rates until stop_event is set.
+
+    priority: lower runs first when several tasks are due at the same time
+    enabled:  optional callable, the task is skipped (and not counted) while it returns False
+    A task that overruns its interval is not run back to back to catch up: the missed
+    deadlines are skipped and counted in its overruns.
+    A task that raises is counted in its errors (the exception is kept in last_error and
+    printed the first time) and runs again at its next deadline; the other tasks go on.
+    """
+    def __init__(self, stop_event=None, clock=time.monotonic):
+        self.stop_event = stop_event if stop_event is not None else threading.Event()
+        self.clock = clock
+        self.tasks = []
+
+    def add(self, name, interval, fn, priority=0, enabled=None, start_delay=0):
+        task = ScheduledTask(name, interval, fn, priority, enabled, self.clock() + start_delay)
+        self.tasks.append(task)
+        self.tasks.sort(key=lambda task: task.priority)
+        return task
+
+    """Runs the tasks that are due, in priority order. Returns the seconds until the next deadline"""
+    def run_pending(self):
+        for task in self.tasks:
+            start = self.clock()
+            if start < task.deadline:
+                continue
+            if task.enabled is not None and not task.enabled():
+                #Keep the grid, but do not count the skipped deadlines as overruns
+                task.deadline += task.interval * ((start - task.deadline) // task.interval + 1)
+                continue
+
+            try:
+                with Tracing.span(task.name, "scheduler"):
+                    task.fn()
+            except Exception as e:
+                task.errors += 1
+                task.last_error = e
+                if task.errors == 1:
+                    traceback.print_exc()
+            end = self.clock()
+
+            jitter = start - task.deadline
+            task.runs += 1
+            task.total_jitter += jitter
+            task.max_jitter = max(task.max_jitter, jitter)
+            task.max_duration = max(task.max_duration, end - start)
+
+            task.deadline += task.interval
+            if task.deadline <= end:
+                missed = (end - task.deadline) // task.interval + 1
+                task.overruns += int(missed)
+                task.deadline += missed * task.interval
+
+            if self.stop_event.is_set():
+                break
+
+        return max(min(task.deadline for task in self.tasks) - self.clock(), 0) if self.tasks else None
+
+    """Runs until stop_event is set, sleeping until the next deadline between tasks"""
+    def run(self):
+        while not self.stop_event.is_set():
+            wait = self.run_pending()
+            if wait is None:
+                self.stop_event.wait()
+            elif wait > 0:
+                self.stop_event.wait(wait)
+
+    def stats(self):
+        return {task.name: task.stats() for task in self.tasks}
+
+    """One line per task, for logging when a session ends. separator joins the lines"""
+    def summary(self, separator="\n"):
+        return separator.join("%s: %d runs, %d overruns, %d errors, jitter mean %.1f ms max %.1f ms, longest run %.1f ms" % (
+            task.name, task.runs, task.overruns, task.errors, 1000 * stats["mean_jitter"], 1000 * stats["max_jitter"],
+            1000 * stats["max_duration"]) for task, stats in ((task, task.stats()) for task in self.tasks))
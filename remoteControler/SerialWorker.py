@@ -0,0 +1,116 @@
+## Dedicated I/O thread that owns a serial port and serves a prioritized command queue.
+## Every caller gets a concurrent.futures.Future back, so the GUI thread and the live
+## plasma thread never touch the port directly and never contend for a lock.
+
+import functools
+import itertools
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+import Tracing
+
+
+#Lower numbers are served first. Commands of equal priority run in submission order
+PRIORITY_SAFETY = 0     #Stop plasma / system shutdown
+PRIORITY_CONTROL = 1    #User commands and state queries
+PRIORITY_TELEMETRY = 2  #Periodic polls (log data, supply voltages, frequency)
+
+_PRIORITY_STOP = 3      #Queued behind everything else so pending commands still run
+
+
+class SerialWorker(threading.Thread):
+    def __init__(self, name="SerialWorker"):
+        super().__init__(name=name, daemon=True)
+        self._queue = queue.PriorityQueue()
+        self._sequence = itertools.count()
+        self._stopping = False
+
+        #Called repeatedly while no command is waiting, e.g. to read data the device pushes
+        #unrequested. It must return within a few ms, since commands queued meanwhile wait for it
+        self.idle = None
+        self.idle_error = None
+
+
+    """Queues function(*args, **kwargs) to run on the worker thread.
+    Returns a Future holding the result or the raised exception"""
+    def submit(self, priority, function, *args, **kwargs):
+        future = Future()
+        if self._stopping:
+            future.set_exception(RuntimeError("Serial worker has been stopped"))
+            return future
+
+        #While tracing, the time spent in the queue is recorded from the submitting thread on
+        submitted = (time.perf_counter_ns(), threading.get_native_id()) if Tracing.enabled() else None
+        self._queue.put((priority, next(self._sequence), future, function, args, kwargs, submitted))
+        return future
+
+
+    """True when called from the worker thread itself"""
+    def in_worker(self):
+        return threading.current_thread() is self
+
+
+    """Returns the number of commands waiting to be served"""
+    def pending(self):
+        return self._queue.qsize()
+
+
+    def run(self):
+        while True:
+            idle = self.idle
+            if idle is None:
+                _, _, future, function, args, kwargs, submitted = self._queue.get()
+            else:
+                try:
+                    _, _, future, function, args, kwargs, submitted = self._queue.get_nowait()
+                except queue.Empty:
+                    try:
+                        idle()
+                    except Exception as e:
+                        #Keep serving commands, the owner finds the error in idle_error
+                        self.idle_error = e
+                        self.idle = None
+                    continue
+
+            if function is None:
+                break
+
+            if not future.set_running_or_notify_cancel():
+                continue #Cancelled while waiting in the queue
+
+            tracer = Tracing.tracer()
+            if tracer is not None and submitted is not None:
+                tracer.async_span("queued " + function.__name__, "queue", submitted[0], time.perf_counter_ns(),
+                                  submitted[1])
+            try:
+                with Tracing.span(function.__name__, "command"):
+                    result = function(*args, **kwargs)
+                future.set_result(result)
+            except BaseException as e:
+                future.set_exception(e)
+
+
+    """Stops the worker once the commands already queued have been served"""
+    def stop(self, timeout=None):
+        if self._stopping:
+            return
+        self._stopping = True
+        self._queue.put((_PRIORITY_STOP, next(self._sequence), None, None, None, None, None))
+        if self.is_alive() and not self.in_worker():
+            self.join(timeout)
+
+
+def command(priority):
+    """Decorator for methods of an object with a `worker` attribute. Calling the method
+    submits it to the worker and returns a Future. Calls made from the worker thread
+    (e.g. one command built from others) run inline and return the plain result."""
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            if self.worker.in_worker():
+                return method(self, *args, **kwargs)
+            return self.worker.submit(priority, method, self, *args, **kwargs)
+        return wrapper
+    return decorator
@@ -0,0 +1,199 @@
+## Opt-in tracing of the acquisition path, written in the Chrome trace-event JSON format
+## (open the file in https://ui.perfetto.dev or chrome://tracing).
+## Spans are recorded per thread, so the GUI thread, the acquisition thread, the serial worker
+## and the log writer show up as separate tracks; the time commands spend queued for the serial
+## worker is shown as async "queue" spans. While tracing is off, span() returns a shared no-op
+## context manager, so instrumented code costs one function call.
+##
+## An optional sampling profiler records the Python stack of every thread at a fixed interval and
+## writes them as folded stacks (one "thread;outer;...;inner count" line per stack) for flame
+## graph tools such as speedscope or flamegraph.pl.
+##
+## Usage: python main.py --trace trace.json [--profile]
+##        python serialLog.py --trace trace.json [--profile] ...
+
+import collections
+import contextlib
+import json
+import os
+import sys
+import threading
+import time
+
+
+#Memory the kept events may take, the oldest are discarded beyond that. An event is a small dict
+#(with its args and the floats in it) of about 570 bytes, measured with tracemalloc
+MAX_TRACE_BYTES = 100*1024*1024
+EVENT_BYTES = 570
+MAX_EVENTS = MAX_TRACE_BYTES // EVENT_BYTES
+
+#Seconds between stack samples of the sampling profiler
+SAMPLE_INTERVAL = 5/1000
+
+_tracer = None
+_NULL_SPAN = contextlib.nullcontext()
+
+
+class _Span:
+    __slots__ = ("tracer", "name", "category", "args", "start")
+
+    def __init__(self, tracer, name, category, args):
+        self.tracer = tracer
+        self.name = name
+        self.category = category
+        self.args = args
+
+    def __enter__(self):
+        self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, *exc):
+        self.tracer.complete(self.name, self.category, self.start, time.perf_counter_ns(), self.args)
+
+
+class Tracer:
+    """Collects trace events from any thread. deque.append is atomic, so recording takes no lock"""
+    def __init__(self, path, max_events=MAX_EVENTS):
+        self.path = path
+        self.pid = os.getpid()
+        self.origin = time.perf_counter_ns()
+        self.events = collections.deque(maxlen=max_events)
+        self.threads = {} #native thread id -> name, for the track names
+        self._async_ids = iter(range(1, sys.maxsize))
+
+    def _tid(self):
+        tid = threading.get_native_id()
+        if tid not in self.threads:
+            self.threads[tid] = threading.current_thread().name
+        return tid
+
+    def _us(self, ns):
+        return (ns - self.origin) / 1000
+
+    def complete(self, name, category, start, end, args=None, tid=None):
+        """A span from start to end (perf_counter_ns) on the calling thread, or on tid"""
+        event = {"name": name, "cat": category, "ph": "X", "ts": self._us(start), "dur": (end - start) / 1000,
+                 "pid": self.pid, "tid": self._tid() if tid is None else tid}
+        if args:
+            event["args"] = args
+        self.events.append(event)
+
+    def async_span(self, name, category, start, end, tid, args=None):
+        """A span that starts on one thread and ends on another, e.g. a command waiting in a queue"""
+        event_id = next(self._async_ids)
+        begin = {"name": name, "cat": category, "ph": "b", "id": event_id, "ts": self._us(start),
+                 "pid": self.pid, "tid": tid}
+        if args:
+            begin["args"] = args
+        self.events.append(begin)
+        self.events.append({"name": name, "cat": category, "ph": "e", "id": event_id, "ts": self._us(end),
+                            "pid": self.pid, "tid": self._tid()})
+
+    def instant(self, name, category, args=None):
+        event = {"name": name, "cat": category, "ph": "i", "s": "t", "ts": self._us(time.perf_counter_ns()),
+                 "pid": self.pid, "tid": self._tid()}
+        if args:
+            event["args"] = args
+        self.events.append(event)
+
+    def counter(self, name, values):
+        """A counter track, e.g. a queue depth. values maps series names to numbers"""
+        self.events.append({"name": name, "ph": "C", "ts": self._us(time.perf_counter_ns()), "pid": self.pid,
+                            "args": values})
+
+    def write(self, path=None):
+        metadata = [{"name": "thread_name", "ph": "M", "pid": self.pid, "tid": tid, "args": {"name": name}}
+                    for tid, name in list(self.threads.items())]
+        with open(path or self.path, "w") as file:
+            json.dump({"traceEvents": metadata + list(self.events), "displayTimeUnit": "ms"}, file)
+
+
+class SamplingProfiler(threading.Thread):
+    """Samples the Python stack of every other thread each interval seconds and counts the stacks"""
+    def __init__(self, interval=SAMPLE_INTERVAL):
+        super().__init__(name="SamplingProfiler", daemon=True)
+        self.interval = interval
+        self.stacks = collections.Counter()
+        self.samples = 0
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == self.ident:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append("%s (%s:%d)" % (code.co_name, os.path.basename(code.co_filename), code.co_firstlineno))
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)))
+                self.stacks[";".join(reversed(stack))] += 1
+            self.samples += 1
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+    def write_folded(self, path):
+        with open(path, "w") as file:
+            for stack, count in self.stacks.most_common():
+                file.write("%s %d\n" % (stack, count))
+
+
+_profiler = None
+
+
+def enable(path, profile=False, sample_interval=SAMPLE_INTERVAL):
+    """Starts recording spans, to be written to path by disable(). With profile the sampling
+    profiler runs as well and its stacks go to path with the extension .folded"""
+    global _tracer, _profiler
+    _tracer = Tracer(path)
+    if profile:
+        _profiler = SamplingProfiler(sample_interval)
+        _profiler.start()
+
+
+def disable():
+    """Stops tracing and writes the trace (and the profile). Returns the path of the trace, or None"""
+    global _tracer, _profiler
+    tracer, _tracer = _tracer, None
+    if _profiler is not None:
+        _profiler.stop()
+        _profiler.write_folded(os.path.splitext(tracer.path)[0] + ".folded")
+        _profiler = None
+    if tracer is None:
+        return None
+    tracer.write()
+    return tracer.path
+
+
+@contextlib.contextmanager
+def tracing(path, profile=False, sample_interval=SAMPLE_INTERVAL):
+    """enable() for the duration of a with block; does nothing if path is None"""
+    if path is None:
+        yield
+        return
+    enable(path, profile, sample_interval)
+    try:
+        yield
+    finally:
+        disable()
+
+
+def enabled():
+    return _tracer is not None
+
+
+def tracer():
+    """The active Tracer, or None, for recording events other than spans"""
+    return _tracer
+
+
+def span(name, category="host", **args):
+    """Context manager recording a span around its block on the calling thread, while tracing is enabled"""
+    tracer = _tracer
+    if tracer is None:
+        return _NULL_SPAN
+    return _Span(tracer, name, category, args)
@@ -0,0 +1,104 @@
+## Fixed-memory, multi-resolution history of slow readouts (frequency, supply voltages).
+## Every series is a cascade of ring buffers: raw samples, then per-second and per-minute
+## min/mean/max. Each level feeds the next when one of its buckets completes, so memory is
+## set by the level capacities alone and does not grow with the length of a run.
+
+import threading
+import time
+
+import numpy as np
+
+
+#(bucket period in seconds, capacity) per level. Period 0 keeps every sample
+#Raw: last 600 samples, per-second: last hour, per-minute: last 24 hours
+DEFAULT_LEVELS = ((0, 600), (1, 3600), (60, 1440))
+
+
+class TrendLevel:
+    """Ring buffer of (time, min, mean, max) buckets"""
+    def __init__(self, period, capacity):
+        self.period = period
+        self.capacity = capacity
+        self._data = np.full((4, capacity), np.nan)
+        self._next = 0   #slot of the next bucket
+        self.count = 0   #buckets stored, up to capacity
+
+        #Bucket being accumulated
+        self._bucket = None
+        self._low = self._high = self._total = 0.0
+        self._samples = 0
+
+    """Adds a sample or a finished bucket of a finer level. Returns the bucket completed by
+    this call as (start time, min, total, max, samples), or None"""
+    def add(self, t, low, total, high, samples=1):
+        if self.period == 0:
+            self._store(t, low, total / samples, high)
+            return (t, low, total, high, samples)
+
+        bucket = t // self.period
+        completed = None
+        if self._bucket is not None and bucket != self._bucket:
+            completed = self._flush()
+        if self._samples == 0:
+            self._bucket = bucket
+            self._low, self._high, self._total = low, high, total
+        else:
+            self._low = min(self._low, low)
+            self._high = max(self._high, high)
+            self._total += total
+        self._samples += samples
+        return completed
+
+    def _flush(self):
+        completed = (self._bucket * self.period, self._low, self._total, self._high, self._samples)
+        self._store(completed[0], self._low, self._total / self._samples, self._high)
+        self._samples = 0
+        return completed
+
+    def _store(self, t, low, mean, high):
+        self._data[:, self._next] = (t, low, mean, high)
+        self._next = (self._next + 1) % self.capacity
+        self.count = min(self.count + 1, self.capacity)
+
+    """Stored buckets, oldest first, as a copy: (time, min, mean, max) arrays"""
+    def snapshot(self):
+        if self.count < self.capacity:
+            data = self._data[:, :self.count].copy()
+        else:
+            data = np.roll(self._data, -self._next, axis=1)
+        return tuple(data)
+
+
+class TrendSeries:
+    def __init__(self, levels=DEFAULT_LEVELS):
+        self.levels = [TrendLevel(period, capacity) for period, capacity in levels]
+
+    def add(self, t, value):
+        bucket = (t, value, value, value, 1)
+        for level in self.levels:
+            bucket = level.add(*bucket)
+            if bucket is None:
+                break
+
+
+class TrendHistory:
+    """Named TrendSeries. Written by the acquisition thread, read by the GUI thread"""
+    def __init__(self, names, levels=DEFAULT_LEVELS):
+        self.names = tuple(names)
+        self.periods = tuple(period for period, _ in levels)
+        self._series = {name: TrendSeries(levels) for name in self.names}
+        self._lock = threading.Lock()
+
+    def add(self, name, value, t=None):
+        t = time.time() if t is None else t
+        with self._lock:
+            self._series[name].add(t, float(value))
+
+    """Returns (time, min, mean, max) arrays of one level of a series, oldest first"""
+    def snapshot(self, name, level):
+        with self._lock:
+            return self._series[name].levels[level].snapshot()
+
+    """Approximate memory held by the history in bytes. Fixed once constructed"""
+    def nbytes(self):
+        return sum(level._data.nbytes for series in self._series.values() for level in series.levels)
@@ -1,14 +1,57 @@
 ## Author Nolan Olaso
 ## Launches Plasma Control GUI
+## python main.py --view [log]   opens the offline log viewer instead
+## python main.py --port <port>  uses this serial port instead of the first board found (PortDiscovery)
+## python main.py --link-stats <path>  also writes the serial link statistics there (.json, Prometheus text otherwise)
+## python main.py --trace <path> [--profile]  records a Chrome trace of the session (see Tracing), and stack samples with --profile
+## python main.py --devices [<port> <port> ...] [--log run.plog]  one dashboard for several controllers, all boards found without ports
 
 import sys
-from PySide6.QtWidgets import QApplication, QMainWindow
-from GUI_Logic import GUILogic
+from PySide6.QtWidgets import QApplication
+
+import Tracing
 
 if __name__ == "__main__":
     app = QApplication(sys.argv)
-    window = GUILogic()
+    #Taken out of sys.argv, so they can be given along with any of the other options
+    if "--trace" in sys.argv[1:-1]:
+        i = sys.argv.index("--trace")
+        trace_path = sys.argv[i + 1]
+        del sys.argv[i:i + 2]
+        profile = "--profile" in sys.argv
+        if profile:
+            sys.argv.remove("--profile")
+        Tracing.enable(trace_path, profile)
+
+    if "--view" in sys.argv[1:]:
+        from LogViewer import open_viewer
+        paths = [arg for arg in sys.argv[1:] if arg != "--view"]
+        viewer = open_viewer(paths[0] if paths else None)
+        sys.exit(app.exec() if viewer else 0)
+
+    if "--devices" in sys.argv[1:]:
+        from FleetDashboard import FleetDashboard
+        args = sys.argv[sys.argv.index("--devices") + 1:]
+        log_path = None
+        if "--log" in args[:-1]:
+            log_path = args[args.index("--log") + 1]
+            args = args[:args.index("--log")] + args[args.index("--log") + 2:]
+        if not args:
+            from PortDiscovery import discover
+            args = [board.port for board in discover()]
+        window = FleetDashboard(args, log_path)
+        window.show()
+        ret = app.exec()
+        window.shutdown_system()
+        Tracing.disable()
+        sys.exit(ret)
+
+    from GUI_Logic import GUILogic
+    port = sys.argv[sys.argv.index("--port") + 1] if "--port" in sys.argv[1:-1] else None
+    link_stats_path = sys.argv[sys.argv.index("--link-stats") + 1] if "--link-stats" in sys.argv[1:-1] else None
+    window = GUILogic(port, link_stats_path)
     window.show()
     ret = app.exec()
     window.shutdown_system()
+    Tracing.disable()
     sys.exit(ret)
@@ -1,28 +1,12 @@
 ## Created by: Qt User Interface Compiler version 6.8.2
 ## With significant edits from author Nolan Olaso
 
-from PySide6.QtCore import (QCoreApplication, QDate, QDateTime, QLocale,
-    QMetaObject, QObject, QPoint, QRect,
-    QSize, QTime, QUrl, Qt)
-from PySide6.QtGui import (QBrush, QColor, QConicalGradient, QCursor,
-    QFont, QFontDatabase, QGradient, QIcon,
-    QImage, QKeySequence, QLinearGradient, QPainter,
-    QPalette, QPixmap, QRadialGradient, QTransform)
-from PySide6.QtWidgets import (QApplication, QCheckBox, QFrame, QGroupBox,
-    QLabel, QLineEdit, QMainWindow, QMenuBar,
-    QPushButton, QSizePolicy, QStatusBar, QWidget)
-from matplotlib.backends.backend_qtagg import FigureCanvasQTAgg as FigureCanvas
-from matplotlib.figure import Figure
-import numpy as np
-
-# Class for Matplotlib integration
-class MplCanvas(FigureCanvas):
-    def __init__(self, parent=None, width=4, height=3, dpi=100):
-        fig = Figure(figsize=(width, height), dpi=dpi)
-        self.ax1 = fig.add_subplot(111)
-        self.ax2 = self.ax1.twinx()
-        super().__init__(fig)
-        self.setParent(parent)
+from PySide6.QtCore import QCoreApplication, QMetaObject, QRect
+from PySide6.QtWidgets import (QCheckBox, QComboBox, QFrame, QGroupBox,
+    QLabel, QLineEdit, QMenuBar, QPushButton, QStatusBar, QWidget)
+
+# The plots (PlotCanvas, matplotlib) are not imported here. Loading matplotlib's Qt backend takes
+# longer than building the rest of the window, so setupCanvases() creates them on first use.
 
 # Ui_MainWindow defines the layout and components of the main window
 class Ui_MainWindow(object):
@@ -125,9 +109,8 @@ class Ui_MainWindow(object):
         self.label_live_data_plotting.setObjectName(u"label_live_data_plotting")
         self.label_live_data_plotting.setGeometry(QRect(140, 0, 101, 20)) # Position
 
-        #Live date plotting
-        self.canvas = MplCanvas(self.frame_q2, width=4, height=3, dpi=50)
-        self.canvas.setGeometry(QRect(10, 30, 361, 211))
+        #Live date plotting, created by setupCanvases()
+        self.canvas = None
 
         # Test: plot a sine wave
         """
@@ -299,6 +282,20 @@ class Ui_MainWindow(object):
         self.label_temperature_readout.setObjectName(u"label_temperature_readout")
         self.label_temperature_readout.setGeometry(QRect(230, 10, 131, 16)) # Position
         self.label_temperature_readout.setText(QCoreApplication.translate("MainWindow", u"Temperature Readouts:", None))
+        self.label_temperature_readout.hide() # No temperature readouts yet, the trend panel uses this space
+
+        # Trend history panel
+        self.trend_series_selection = QComboBox(self.frame_q4)
+        self.trend_series_selection.setObjectName(u"trend_series_selection")
+        self.trend_series_selection.setGeometry(QRect(200, 8, 171, 22)) # Position
+        self.trend_series_selection.addItems(["Frequency (kHz)", "3.3 V Supply (V)", "15 V Supply (V)", "High V Supply (V)"])
+
+        self.trend_window_selection = QComboBox(self.frame_q4)
+        self.trend_window_selection.setObjectName(u"trend_window_selection")
+        self.trend_window_selection.setGeometry(QRect(200, 34, 171, 22)) # Position
+        self.trend_window_selection.addItems(["Last 600 samples", "Last hour (1 s)", "Last day (1 min)"])
+
+        self.trend_canvas = None # created by setupCanvases()
         
         MainWindow.setCentralWidget(self.centralwidget)
         self.frame_q1.raise_()
@@ -323,6 +320,21 @@ class Ui_MainWindow(object):
         QMetaObject.connectSlotsByName(MainWindow)
     # setupUi
 
+    # Creates the live plot and trend canvases. Separate from setupUi so matplotlib is only
+    # imported once a plot is needed; does nothing if they already exist
+    def setupCanvases(self):
+        if self.canvas is not None:
+            return
+        from PlotCanvas import MplCanvas, TrendCanvas
+
+        self.canvas = MplCanvas(self.frame_q2, width=4, height=3, dpi=50)
+        self.canvas.setGeometry(QRect(10, 30, 361, 211))
+        self.canvas.show()
+
+        self.trend_canvas = TrendCanvas(self.frame_q4, width=2, height=2, dpi=50)
+        self.trend_canvas.setGeometry(QRect(195, 60, 181, 186))
+        self.trend_canvas.show()
+
     def retranslateUi(self, MainWindow):
         MainWindow.setWindowTitle(QCoreApplication.translate("MainWindow", u"MainWindow", None))
         self.version_history.setText(QCoreApplication.translate("MainWindow", u"Plasma Control Team Version 1.1", None))
@@ -1,75 +1,195 @@
-#Provides a text based interface with the plasma controller and allows for logging data to a CSV
-
-import serial
+#Headless acquisition: starts the plasma and streams the ADC1/2 log frames to a file or stdout.
+#Uses the same PlasmaSerialInterface and log writers as the GUI, without importing PySide6 or
+#matplotlib, so it starts quickly and can run unattended as a service (stop with Ctrl+C or SIGTERM).
+#
+#Usage: python serialLog.py [--port /dev/ttyACM0] [--output log.csv|log.plog|-] [--duration s]
+
+import argparse
+import signal
 import sys
+import threading
 import time
 
-ser = serial.Serial('/dev/ttyACM0', 8593750, timeout=0.1)
-
-#Check if device is connected
-ser.write(b"\r")
-
-#TODO check for device preamble####
-data = ser.readline()
-if not data:
-    print("device not found... exiting")
-    print("DEBUG: " + str(data))
-    exit()
-
-ser.reset_input_buffer()
-#######################
-
-
-#Wait for user to provide logging file name and start plasma
-
-log_choice = input("Log plasma? (Y/n): ")
-
-if not log_choice == "n":
-    filename = input("Chose a filename to save as: ")
-    file = open(filename, "wb")
-
-print("press control+C to safely shut down")
-
-start = input("press enter to start plasma")
-
-if not start == "":
-    print("exiting")
-    exit()
-
-#power on supplies
-ser.write(b"p\r\n")
-time.sleep(0.25)
-
-#set deadtime to minimum
-ser.write(b"d")
-time.sleep(0.25)
-ser.write(b"1\r")
-time.sleep(0.25)
-
-#start h-bridge
-ser.write(b"s")
-time.sleep(0.25)
-ser.write(b"1\r")
-time.sleep(0.25)
-
-
-#start freq adjust
-ser.write(b"y")
-
-ser.reset_input_buffer()
-
-
-try:
-    while True:
-        data = ser.readline()
-        file.write(data)
-        print("DEBUG: " + str(data))
-
-except KeyboardInterrupt:
-    ser.write(b"q\r")
-    time.sleep(0.1)
-    ser.write(b"s\r")
-    time.sleep(0.1)
-    ser.write(b"0\r")
-    file.close()
-    exit()
+import PlasmaException
+import Tracing
+from PlasmaSerialInterface import PlasmaSerialInterface
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Headless plasma data logger")
+    parser.add_argument("--port", help="serial port of the controller, default the first board found")
+    parser.add_argument("--output", default="-",
+                        help="log file (.plog for the binary format, CSV otherwise), - for stdout")
+    parser.add_argument("--duration", type=float, default=0, help="seconds to run, 0 runs until stopped")
+    parser.add_argument("--freq", type=float, help="fixed frequency in kHz, disables auto frequency")
+    parser.add_argument("--no-start", action="store_true",
+                        help="log a plasma that is already running, and leave it running on exit")
+    parser.add_argument("--pacing", choices=("adaptive", "fixed"), default="adaptive")
+    parser.add_argument("--text-frames", action="store_true",
+                        help="request the firmware's text frames instead of the smaller binary frames")
+    parser.add_argument("--columns", help="comma separated log columns to record (see LogFrame.LOG_COLUMNS), default all")
+    parser.add_argument("--decimation", type=int, default=1, help="record every n-th sample of each frame")
+    parser.add_argument("--link-stats", metavar="PATH",
+                        help="write the serial link statistics there every second, as JSON (.json) or Prometheus text")
+    parser.add_argument("--resonance", action="store_true",
+                        help="estimate the resonance from the frames, logged to <output>.resonance.csv (see Resonance)")
+    parser.add_argument("--drive-resonance", action="store_true",
+                        help="with --resonance, turn auto frequency off and set the frequency to the estimate")
+    parser.add_argument("--trace", metavar="PATH", help="record a Chrome trace of the session there (see Tracing)")
+    parser.add_argument("--profile", action="store_true", help="with --trace, also sample the stacks of all threads")
+    parser.add_argument("--rotate-size", type=float, metavar="MB",
+                        help="start a new CSV segment after this many MB (uncompressed), 0 disables")
+    parser.add_argument("--rotate-interval", type=float, metavar="S",
+                        help="start a new CSV segment every S seconds, 0 disables. "
+                             "Compressed logs (.csv.gz, .csv.zst) rotate hourly or at 512 MB by default")
+    return parser.parse_args(argv)
+
+
+def status(message):
+    #stdout may carry the log itself, so progress goes to stderr
+    print(message, file=sys.stderr, flush=True)
+
+
+def open_output(args):
+    from DataLog import BackgroundLogWriter, CsvLogWriter, open_log_writer
+    if args.output == "-":
+        return BackgroundLogWriter(CsvLogWriter(sys.stdout.buffer))
+    max_bytes = int(args.rotate_size * 1024 * 1024) if args.rotate_size is not None else None
+    return BackgroundLogWriter(open_log_writer(args.output, max_bytes, args.rotate_interval), fsync_interval=10)
+
+
+def start(interface, args):
+    if args.no_start:
+        return
+    interface.start_session(args.freq).result()
+
+
+def run(args, stop_event):
+    interface = PlasmaSerialInterface(args.port, threading.Event(), pacing=args.pacing,
+                                      binary_frames=not args.text_frames)
+    log = None
+    resonance = None
+    frames = 0
+    try:
+        if not interface.initialize().result():
+            status("device not found on " + (args.port or "any serial port"))
+            return 1
+
+        log = open_output(args)
+        from LogFrame import LOG_COLUMNS, channel_mask, mask_columns
+        columns = args.columns.split(",") if args.columns else LOG_COLUMNS
+        if args.resonance and args.columns:
+            from Resonance import ANALYSIS_COLUMNS
+            columns = [name for name in LOG_COLUMNS if name in columns or name in ANALYSIS_COLUMNS]
+        unknown = set(columns) - set(LOG_COLUMNS)
+        if unknown:
+            raise PlasmaException.PlasmaException("Unknown log columns: " + ", ".join(sorted(unknown)))
+        if (columns != LOG_COLUMNS or args.decimation != 1) and \
+                not interface.set_log_selection(channel_mask(columns), args.decimation).result():
+            raise PlasmaException.PlasmaException("The firmware did not accept the log selection")
+        columns = mask_columns(interface.log_channels)
+
+        start(interface, args)
+        status("logging to " + ("stdout" if args.output == "-" else args.output))
+        log.write_header(interface.query_log_header().result())
+
+        #The CSV writer stores text frames as received, only binary logs and binary frames need parsing
+        from DataLog import BinaryLogWriter
+        from FrameReader import is_binary_frame
+        from LogFrame import parse_log_frame
+        if isinstance(log.writer, BinaryLogWriter) or args.resonance:
+            parse = lambda data: parse_log_frame(data, columns)
+        else:
+            parse = lambda data: parse_log_frame(data) if is_binary_frame(data) else None
+
+        if args.resonance:
+            from DataLog import sidecar_log_path
+            from Resonance import ResonanceAnalyzer
+            drive = None
+            if args.drive_resonance:
+                interface.set_auto_freq(False).result()
+                drive = lambda hz: interface.set_freq(hz / 1000) #queued, the analysis does not wait for the reply
+            resonance = ResonanceAnalyzer(sidecar_log_path(args.output, "resonance.csv") if args.output != "-" else None,
+                                          drive)
+
+        #The firmware pushes the frames, stream_frames() returns after 0.1 s without one
+        #so the stop conditions are still checked while the plasma is not active
+        interface.start_streaming().result()
+        end_time = time.monotonic() + args.duration if args.duration else None
+        def done():
+            return stop_event.is_set() or (end_time is not None and time.monotonic() >= end_time)
+
+        def record(data):
+            try:
+                frame = parse(data)
+            except ValueError:
+                #A malformed frame is counted and skipped, the run goes on
+                interface.link_stats.error("bad_frame")
+                return 0
+            log.write_frame(data, frame)
+            if resonance is not None:
+                resonance.submit(frame)
+            return 1
+
+        stats_time = time.monotonic()
+        while not done():
+            for data in interface.stream_frames(0.1):
+                frames += record(data)
+                if done():
+                    break
+            if args.link_stats and time.monotonic() - stats_time >= 1:
+                interface.write_link_stats(args.link_stats)
+                stats_time = time.monotonic()
+
+        interface.stop_streaming().result()
+        for data in interface.stream_frames():
+            frames += record(data)
+        if interface.frames_dropped:
+            status("%d frames dropped before they were logged" % interface.frames_dropped)
+        if interface.frames_lost or interface.frames_corrupt:
+            status("%d frames lost on the serial link, %d failed their CRC check" % (
+                interface.frames_lost, interface.frames_corrupt))
+        return 0
+
+    except PlasmaException.PlasmaException as e:
+        status("error: " + str(e))
+        return 1
+
+    finally:
+        #Closed first, so it does not set the frequency of a plasma being stopped
+        if resonance is not None:
+            resonance.close()
+            status(resonance.summary() + ("  (%d frequency steps)" % resonance.drive_steps if resonance.drive else ""))
+        if interface.initialized and not args.no_start:
+            interface.stop_plasma().result()
+            interface.system_shutdown().result()
+        if log is not None:
+            try:
+                log.close()
+            except IOError as e:
+                status("error: " + str(e))
+            if log.dropped:
+                status("%d frames not logged, the disk did not keep up (deepest queue %d)" % (log.dropped, log.max_depth))
+        interface.close()
+        if args.link_stats:
+            interface.write_link_stats(args.link_stats)
+        status(interface.link_stats.summary())
+        status("%d frames logged" % (frames - (log.dropped if log is not None else 0)))
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    stop_event = threading.Event()
+
+    #Ctrl+C and SIGTERM (service stop) end the loop, the plasma is then shut down in run()
+    def request_stop(signum, frame):
+        stop_event.set()
+    signal.signal(signal.SIGINT, request_stop)
+    signal.signal(signal.SIGTERM, request_stop)
+
+    with Tracing.tracing(args.trace, args.profile):
+        return run(args, stop_event)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,108 @@
+## Startup time benchmark for the GUI. Exits non-zero when startup regresses, so it can gate CI
+## or be run by hand after touching imports or GUILogic.__init__.
+##
+## Each run starts a fresh interpreter against a PlasmaSimulator and measures:
+##   shown   process start -> window shown and the event loop running
+##   ready   process start -> PlasmaSerialInterface.initialize() finished in the background
+## It fails if the median "shown" time is above --max-seconds, above the saved baseline by more
+## than --tolerance, or if matplotlib was already imported when the window appeared.
+##
+## Usage: python startup_benchmark.py [--runs 5] [--max-seconds 1.0] [--baseline file] [--save-baseline]
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+from PlasmaSimulator import PlasmaSimulator
+
+
+#Runs in the child interpreter. Prints one JSON line with the timings
+CHILD = r"""
+import sys, time
+start = time.perf_counter()
+from PySide6.QtCore import QTimer
+from PySide6.QtWidgets import QApplication
+import GUI_Logic
+GUI_Logic.GUILogic.show_warning_popup = lambda self, message: print(message, file=sys.stderr)
+
+app = QApplication(sys.argv)
+window = GUI_Logic.GUILogic(sys.argv[1])
+result = {}
+
+def shown():
+    result["shown"] = time.perf_counter() - start
+    result["matplotlib_loaded"] = "matplotlib" in sys.modules
+
+def ready(initialized):
+    result["ready"] = time.perf_counter() - start
+    QTimer.singleShot(0, app.quit)
+
+window.device_ready.connect(ready)
+window.show()
+QTimer.singleShot(0, shown)
+QTimer.singleShot(10000, app.quit)
+app.exec()
+window.shutdown_system()
+print(__import__("json").dumps(result))
+"""
+
+
+def run_once(port):
+    env = dict(os.environ)
+    env.setdefault("QT_QPA_PLATFORM", "offscreen")
+    here = os.path.dirname(os.path.abspath(__file__))
+    process = subprocess.run([sys.executable, "-c", CHILD, port], cwd=here, env=env,
+                             capture_output=True, text=True, timeout=60)
+    lines = process.stdout.strip().splitlines()
+    if process.returncode or not lines:
+        raise RuntimeError("Benchmark run failed:\n" + process.stderr)
+    return json.loads(lines[-1])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="GUI startup time benchmark")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--max-seconds", type=float, default=1.0, help="limit for the median time to show the window")
+    parser.add_argument("--baseline", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), ".startup_baseline.json"))
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed slowdown against the baseline (0.25 = 25%%)")
+    parser.add_argument("--save-baseline", action="store_true", help="store this run's median as the baseline")
+    args = parser.parse_args(argv)
+
+    with PlasmaSimulator() as simulator:
+        results = [run_once(simulator.port) for _ in range(args.runs)]
+
+    shown = statistics.median(result["shown"] for result in results)
+    ready = [result["ready"] for result in results if "ready" in result]
+    print("window shown:  median %.3f s  (min %.3f, max %.3f)" % (
+        shown, min(r["shown"] for r in results), max(r["shown"] for r in results)))
+    if ready:
+        print("device ready:  median %.3f s" % statistics.median(ready))
+
+    failures = []
+    if any(result["matplotlib_loaded"] for result in results):
+        failures.append("matplotlib was imported before the window was shown")
+    if len(ready) != len(results):
+        failures.append("device initialization did not finish in %d of %d runs" % (len(results) - len(ready), len(results)))
+    if shown > args.max_seconds:
+        failures.append("window took %.3f s to show, limit is %.3f s" % (shown, args.max_seconds))
+
+    if args.save_baseline:
+        with open(args.baseline, "w") as file:
+            json.dump({"shown": shown}, file)
+        print("baseline saved to " + args.baseline)
+    elif os.path.exists(args.baseline):
+        with open(args.baseline) as file:
+            baseline = json.load(file)["shown"]
+        if shown > baseline * (1 + args.tolerance):
+            failures.append("window took %.3f s to show, baseline is %.3f s" % (shown, baseline))
+
+    for failure in failures:
+        print("FAIL: " + failure)
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())